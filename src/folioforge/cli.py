@@ -1,12 +1,17 @@
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from enum import Enum
 from pathlib import Path
 from typing import Annotated, Any
 
 import typer
 
-from folioforge.extraction.docling import DoclingExtractor
+from folioforge.extraction.docling import DoclingExtractor, DoclingPreset
 from folioforge.extraction.gemini import GeminiExtractor
 from folioforge.extraction.ocr.paddle import PaddleOcrExtractor
+from folioforge.extraction.ocr.protocol import OcrExtractor
+from folioforge.extraction.ocr.text_layer import PdfTextLayerExtractor
 from folioforge.extraction.protocol import Extractor
 from folioforge.extraction.two_phase import TwoPhaseExtractor
 from folioforge.output.html import HtmlGenerator
@@ -14,18 +19,28 @@ from folioforge.output.json import JsonGenerator
 from folioforge.output.markdown import MarkdownGenerator
 from folioforge.output.passthrough import PassthroughGenerator
 from folioforge.output.protocol import OutputGenerator
+from folioforge.pipeline.batching import MicroBatcher
+from folioforge.pipeline.cache import ExtractionCache
 from folioforge.pipeline.dask import DaskPipelineExecutor
+from folioforge.pipeline.factory import ExtractorFactory
+from folioforge.pipeline.process import ProcessPipelineExecutor
 from folioforge.pipeline.protocol import PipelineExecutor
 from folioforge.pipeline.simple import SimplePipelineExecutor
+from folioforge.pipeline.staged import StagedPipelineExecutor
 from folioforge.postprocessor.debug import DebugPostprocessor
+from folioforge.postprocessor.protocol import Postprocessor
+from folioforge.preprocessor.image import BlankPageFilter
 from folioforge.preprocessor.pdf import PDFPreprocessor
 from folioforge.preprocessor.protocol import Preprocessor
+from folioforge.preprocessor.store import PageStore
 
 app = typer.Typer()
 
 
 class PipelineTypes(str, Enum):
     simple = "simple"
+    staged = "staged"
+    process = "process"
     dask = "dask"
 
 
@@ -54,6 +69,13 @@ def get_preprocessor():
     return [PreprocessorTypes.pdf]
 
 
+def get_ocr_extractor(render_scale: float | None, text_layer: bool, full_page: bool) -> ExtractorFactory[OcrExtractor]:
+    ocr: ExtractorFactory[OcrExtractor] = ExtractorFactory(PaddleOcrExtractor, render_scale=render_scale, full_page=full_page)
+    if text_layer:
+        return ExtractorFactory(PdfTextLayerExtractor, fallback=ocr)
+    return ocr
+
+
 @app.command()
 def convert(
     paths: Annotated[list[Path], typer.Argument(help="path of PDFs to convert")],
@@ -65,31 +87,67 @@ def convert(
     format: Annotated[OutputFormat, typer.Option(help="what format to create results in")] = OutputFormat.markdown,
     debug: Annotated[bool, typer.Option(help="turn on debug mode, stores annotated images in output folder")] = False,
     confidence: Annotated[float, typer.Option(help="the minimum confidence threshold for layout detection")] = 0.2,
+    stream: Annotated[
+        bool, typer.Option(help="render pages just in time and only keep them in memory until they're extracted (with --debug, converted)")
+    ] = False,
+    shard_size: Annotated[int | None, typer.Option(help="render PDFs in parallel, split into page ranges of this size")] = None,
+    workers: Annotated[int, typer.Option(help="processes rendering documents (staged) or extracting pages (process) at the same time")] = 4,
+    scheduler: Annotated[str | None, typer.Option(help="address of a dask scheduler to use instead of a local cluster (dask)")] = None,
+    grayscale: Annotated[bool, typer.Option(help="render pages in grayscale")] = False,
+    adaptive_resolution: Annotated[
+        bool,
+        typer.Option(
+            help="render PDF pages at the layout model's input size and re-render OCR'd areas from the PDF (doclayout_yolo), boxes are"
+            " in pixels of the smaller pages then and image preprocessors don't apply to OCR"
+        ),
+    ] = False,
+    text_layer: Annotated[bool, typer.Option(help="use the embedded PDF text where usable and only OCR the rest (doclayout_yolo)")] = False,
+    raw_pages: Annotated[bool, typer.Option(help="store pages uncompressed and memory map them, faster but needs more disk space")] = False,
+    page_budget: Annotated[int | None, typer.Option(help="disk space in MB for pages, extracted pages are deleted beyond it")] = None,
+    skip_blank: Annotated[bool, typer.Option(help="don't extract pages without ink, e.g. separator sheets")] = False,
+    dedup: Annotated[
+        int | None,
+        typer.Option(help="extract duplicate pages once, pages that look alike are duplicates if at most this many of 64 hash bits differ"),
+    ] = None,
+    full_page_ocr: Annotated[bool, typer.Option(help="OCR whole pages at once instead of each area (doclayout_yolo)")] = False,
+    docling_preset: Annotated[
+        DoclingPreset | None, typer.Option(help="docling pipeline preset, fast skips OCR of PDFs and uses fast table structure")
+    ] = None,
+    source_pdf: Annotated[
+        bool, typer.Option(help="convert pages from the original PDF instead of the page images (docling, marker)")
+    ] = False,
+    batch_size: Annotated[
+        int | None, typer.Option(help="extract pages in batches of up to this size, tuned to the extractor's speed")
+    ] = None,
+    concurrency: Annotated[int, typer.Option(help="the maximum number of requests in flight (gemini)")] = 8,
+    requests_per_minute: Annotated[float | None, typer.Option(help="the maximum rate of requests (gemini)")] = None,
+    pages_per_request: Annotated[int, typer.Option(help="pages to send in a single request (gemini)")] = 1,
+    cache: Annotated[Path | None, typer.Option(help="folder to cache extraction results in, reused for unchanged pages")] = None,
     out: Annotated[Path | None, typer.Option(help="output folder, print to stdout if not supplied")] = None,
 ):
     """Convert PDF documents to text."""
     # optional imports
 
     executor_cls: type[PipelineExecutor]
+    executor_args: dict[str, Any] = {}
     match pipeline:
         case PipelineTypes.simple:
             executor_cls = SimplePipelineExecutor
+        case PipelineTypes.staged:
+            executor_cls = StagedPipelineExecutor
+            executor_args["preprocess_workers"] = workers
+        case PipelineTypes.process:
+            executor_cls = ProcessPipelineExecutor
+            executor_args["workers"] = workers
         case PipelineTypes.dask:
             executor_cls = DaskPipelineExecutor
+            executor_args["address"] = scheduler
 
-    preprocessors: list[Preprocessor] = []
-    if preprocessor is not None:
-        for p in preprocessor:
-            match p:
-                case PreprocessorTypes.pdf:
-                    preprocessors.append(PDFPreprocessor())
-                case PreprocessorTypes.pymupdf:
-                    try:
-                        from folioforge.preprocessor.pdf import PymupdfPreprocessor
-                    except ImportError as e:
-                        raise ImportError("pymupdf preprocessor requires 'pymupdf' extra to be installed") from e
-
-                    preprocessors.append(PymupdfPreprocessor())
+    # layout models downscale pages to their input size anyway, so pdfium pages can be rendered at that size and only the areas
+    # that get OCR'd re-rendered at full resolution
+    adaptive_resolution = adaptive_resolution and PreprocessorTypes.pdf in preprocessor
+    layout_size: int | None = None
+    ocr_render_scale = 4 if adaptive_resolution else None
 
     extractor_cls: type[Extractor]
     extractor_args: dict[str, Any] = {}
@@ -97,6 +155,8 @@ def convert(
         case ExtractorTypes.docling:
             extractor_cls = DoclingExtractor
             extractor_args["min_confidence"] = confidence
+            extractor_args["use_source_pdf"] = source_pdf
+            extractor_args["options"] = docling_preset
         case ExtractorTypes.doclayout_yolo_doclaynet:
             try:
                 from folioforge.extraction.layout.doclayout_yolo import DoclayoutYOLODocLayNet
@@ -104,8 +164,10 @@ def convert(
                 raise ImportError("doclayout_yolo_doclaynet extractor requires 'doclayout_yolo' extra to be installed") from e
 
             extractor_cls = TwoPhaseExtractor
-            extractor_args["layout_detector"] = DoclayoutYOLODocLayNet(min_confidence=confidence)
-            extractor_args["ocr_extractor"] = PaddleOcrExtractor()
+            extractor_args["layout_detector"] = ExtractorFactory(DoclayoutYOLODocLayNet, min_confidence=confidence)
+            extractor_args["ocr_extractor"] = get_ocr_extractor(ocr_render_scale, text_layer, full_page_ocr)
+            if adaptive_resolution:
+                layout_size = DoclayoutYOLODocLayNet.imgsz
         case ExtractorTypes.doclayout_yolo_d4la:
             try:
                 from folioforge.extraction.layout.doclayout_yolo import DoclayoutYOLOD4LA
@@ -113,8 +175,10 @@ def convert(
                 raise ImportError("doclayout_yolo_dl4a extractor requires 'doclayout_yolo' extra to be installed") from e
 
             extractor_cls = TwoPhaseExtractor
-            extractor_args["layout_detector"] = DoclayoutYOLOD4LA(min_confidence=confidence)
-            extractor_args["ocr_extractor"] = PaddleOcrExtractor()
+            extractor_args["layout_detector"] = ExtractorFactory(DoclayoutYOLOD4LA, min_confidence=confidence)
+            extractor_args["ocr_extractor"] = get_ocr_extractor(ocr_render_scale, text_layer, full_page_ocr)
+            if adaptive_resolution:
+                layout_size = DoclayoutYOLOD4LA.imgsz
         case ExtractorTypes.doclayout_yolo_docstructbench:
             try:
                 from folioforge.extraction.layout.doclayout_yolo import DoclayoutYOLODocStructBench
@@ -122,8 +186,10 @@ def convert(
                 raise ImportError("doclayout_yolo_docstructbench extractor requires 'doclayout_yolo' extra to be installed") from e
 
             extractor_cls = TwoPhaseExtractor
-            extractor_args["layout_detector"] = DoclayoutYOLODocStructBench(min_confidence=confidence)
-            extractor_args["ocr_extractor"] = PaddleOcrExtractor()
+            extractor_args["layout_detector"] = ExtractorFactory(DoclayoutYOLODocStructBench, min_confidence=confidence)
+            extractor_args["ocr_extractor"] = get_ocr_extractor(ocr_render_scale, text_layer, full_page_ocr)
+            if adaptive_resolution:
+                layout_size = DoclayoutYOLODocStructBench.imgsz
         case ExtractorTypes.marker:
             try:
                 from folioforge.extraction.marker import MarkerPDFExtractor
@@ -132,8 +198,51 @@ def convert(
 
             extractor_cls = MarkerPDFExtractor
             extractor_args["min_confidence"] = confidence
+            extractor_args["use_source_pdf"] = source_pdf
         case ExtractorTypes.gemini:
             extractor_cls = GeminiExtractor
+            extractor_args["concurrency"] = concurrency
+            extractor_args["requests_per_minute"] = requests_per_minute
+            extractor_args["pages_per_request"] = pages_per_request
+
+    # what has to be cleaned up after the run
+    resources = ExitStack()
+
+    store = None
+    if raw_pages or page_budget is not None:
+        max_bytes = page_budget * 2**20 if page_budget is not None else None
+        directory = Path(resources.enter_context(tempfile.TemporaryDirectory(prefix="folioforge")))
+        store = PageStore(directory, raw=raw_pages, max_bytes=max_bytes)
+
+    preprocessors: list[Preprocessor] = []
+    if preprocessor is not None:
+        for p in preprocessor:
+            match p:
+                case PreprocessorTypes.pdf:
+                    # the dask pipeline distributes shards over its workers itself
+                    render_executor = None
+                    if shard_size is not None and pipeline == PipelineTypes.simple:
+                        render_executor = resources.enter_context(ProcessPoolExecutor())
+                    preprocessors.append(
+                        PDFPreprocessor(
+                            in_memory=stream,
+                            lazy=stream,
+                            shard_size=shard_size,
+                            executor=render_executor,
+                            max_size=layout_size,
+                            grayscale=grayscale,
+                            store=store,
+                        )
+                    )
+                case PreprocessorTypes.pymupdf:
+                    try:
+                        from folioforge.preprocessor.pdf import PymupdfPreprocessor
+                    except ImportError as e:
+                        raise ImportError("pymupdf preprocessor requires 'pymupdf' extra to be installed") from e
+
+                    preprocessors.append(PymupdfPreprocessor(in_memory=stream, lazy=stream, grayscale=grayscale, store=store))
+    if skip_blank:
+        preprocessors.append(BlankPageFilter())
 
     format_cls: type[OutputGenerator]
     match format:
@@ -146,27 +255,47 @@ def convert(
         case OutputFormat.html:
             format_cls = HtmlGenerator
 
-    postprocessors = None
+    postprocessors: list[Postprocessor] | None = None
 
     if debug:
         postprocessors = [DebugPostprocessor()]
 
+    batcher = None
+    if batch_size is not None:
+        batcher = MicroBatcher(max_size=batch_size)
+    elif source_pdf:
+        # the PDF is converted once per batch, so batches should hold as many pages of a document as possible
+        batcher = MicroBatcher(max_size=64, max_wait=None, adaptive=False)
+    elif extractor == ExtractorTypes.gemini:
+        # pages of a batch are requested concurrently
+        batcher = MicroBatcher(max_size=concurrency * pages_per_request, max_wait=None, adaptive=False)
+
     executor = executor_cls.setup(
-        preprocessors=preprocessors, extractor=extractor_cls(**extractor_args), postprocessors=postprocessors, format=format_cls()
+        preprocessors=preprocessors,
+        # models are loaded by the executor, once per process
+        extractor=ExtractorFactory(extractor_cls, **extractor_args),
+        postprocessors=postprocessors,
+        format=format_cls(),
+        cache=ExtractionCache(cache) if cache is not None else None,
+        store=store,
+        dedup_max_distance=dedup,
+        batcher=batcher,
+        **executor_args,
     )
 
-    result = executor.execute(paths)
-    if out is None:
-        for r in result:
-            print(r[1])
-    else:
+    if out is not None:
         out.mkdir(parents=True, exist_ok=True)
-        for r in result:
-            (out / r[0].path.stem).write_text(r[1])
+    with resources, executor:
+        # results are written as soon as they're done, in any order when going to files
+        for r in executor.execute_iter(paths, ordered=out is None):
+            if out is None:
+                print(r[1], flush=True)
+            else:
+                (out / r[0].path.stem).write_text(r[1])
 
 
 def default_evaluation_extractors() -> list[ExtractorTypes]:
-    # we exclude gemini because it's reeeeally slow
+    # we exclude gemini because it needs an API key and is billed per request
     return [e for e in ExtractorTypes if e != ExtractorTypes.gemini]
 
 
@@ -232,7 +361,11 @@ def evaluate(
             case ExtractorTypes.gemini:
                 extractor_cls = GeminiExtractor
         executor = SimplePipelineExecutor.setup(
-            preprocessors=preprocessors, extractor=extractor_cls(**extractor_args), format=HtmlGenerator(full=False)
+            preprocessors=preprocessors,
+            extractor=extractor_cls(**extractor_args),
+            format=HtmlGenerator(full=False),
+            # requests for pages of a batch are made concurrently
+            batcher=MicroBatcher(max_size=8, max_wait=None, adaptive=False) if extractor == ExtractorTypes.gemini else None,
         )
         result.extend(executor.execute(paths))
 
@@ -1,22 +1,93 @@
+from enum import Enum
+from io import BytesIO
 from pathlib import Path
 from typing import cast
 
 import cv2
+from docling.datamodel.accelerator_options import AcceleratorOptions
+from docling.datamodel.base_models import BasePageElement, DocumentStream, InputFormat
 from docling.datamodel.base_models import Table as DoclingTable
-from docling.document_converter import DocumentConverter
+from docling.datamodel.pipeline_options import PdfPipelineOptions, TableFormerMode
+from docling.document_converter import DocumentConverter, ImageFormatOption, PdfFormatOption
 from docling_core.types.doc.labels import DocItemLabel
+from pydantic import BaseModel
 
 from folioforge.extraction.protocol import Extractor
 from folioforge.models.document import Area, BoundingBox, DocumentEntry, Heading, Image, Table, TableCell
 from folioforge.models.labels import Label
 
 
+class DoclingPreset(str, Enum):
+    fast = "fast"
+    balanced = "balanced"
+    accurate = "accurate"
+
+
+class DoclingOptions(BaseModel):
+    """Options for docling's PDF pipeline, the defaults are docling's own.
+
+    ocr(bool): OCR bitmaps in PDFs, not needed for digital PDFs. Page images are always OCR'd.
+    table_structure(bool): detect the cells of tables.
+    accurate_tables(bool): use the accurate instead of the fast TableFormer model for table structure.
+    picture_classification(bool): classify pictures, e.g. as charts or logos.
+    num_threads(int | None): threads for docling's models, docling's default (or DOCLING_NUM_THREADS) if not set.
+    """
+
+    ocr: bool = True
+    table_structure: bool = True
+    accurate_tables: bool = True
+    picture_classification: bool = False
+    num_threads: int | None = None
+
+    @classmethod
+    def preset(cls, preset: DoclingPreset) -> "DoclingOptions":
+        match preset:
+            case DoclingPreset.fast:
+                return cls(ocr=False, accurate_tables=False)
+            case DoclingPreset.balanced:
+                return cls(accurate_tables=False)
+            case DoclingPreset.accurate:
+                return cls()
+
+    def pipeline_options(self, ocr: bool) -> PdfPipelineOptions:
+        options = PdfPipelineOptions(
+            do_ocr=ocr, do_table_structure=self.table_structure, do_picture_classification=self.picture_classification
+        )
+        options.table_structure_options.mode = TableFormerMode.ACCURATE if self.accurate_tables else TableFormerMode.FAST
+        if self.num_threads is not None:
+            options.accelerator_options = AcceleratorOptions(num_threads=self.num_threads)
+        return options
+
+
 class DoclingExtractor(Extractor):
+    """Extraction with docling.
+
+    options(DoclingOptions | DoclingPreset | None): pipeline options or the name of a preset, docling's defaults if not set.
+    use_source_pdf(bool): convert pages rendered from a PDF (with source, page and scale set) from the PDF itself instead of the
+        page images. All pages of a batch that come from the same PDF are converted together, so docling can use the embedded
+        text and batch pages internally. Works best with batches that hold many pages of a document (see MicroBatcher).
+    """
+
     supports_pickle = True
+    cache_fields = ("min_confidence", "use_source_pdf", "options")
 
-    def __init__(self, min_confidence: float = 0.2) -> None:
+    def __init__(
+        self, min_confidence: float = 0.2, use_source_pdf: bool = False, options: DoclingOptions | DoclingPreset | None = None
+    ) -> None:
         self.min_confidence = min_confidence
-        self.converter = DocumentConverter()
+        self.use_source_pdf = use_source_pdf
+        if options is None:
+            options = DoclingOptions()
+        elif isinstance(options, DoclingPreset):
+            options = DoclingOptions.preset(options)
+        self.options = options
+        self.converter = DocumentConverter(
+            format_options={
+                InputFormat.PDF: PdfFormatOption(pipeline_options=options.pipeline_options(options.ocr)),
+                # page images have no text without OCR
+                InputFormat.IMAGE: ImageFormatOption(pipeline_options=options.pipeline_options(True)),
+            }
+        )
 
     def __map_label(self, label: DocItemLabel) -> Label:
         match label:
@@ -44,16 +115,51 @@ class DoclingExtractor(Extractor):
                 return Label.OTHER
 
     def extract(self, entry: DocumentEntry) -> DocumentEntry:
-        result = next(self.converter.convert_all(source=[entry.path]))
-        img = cv2.imread(str(entry.path))
-        assert img is not None
-        image_index = 0
+        return self.extract_batch([entry])[0]
+
+    def extract_batch(self, entries: list[DocumentEntry]) -> list[DocumentEntry]:
+        by_source: dict[Path, list[DocumentEntry]] = {}
+        for entry in entries:
+            if self.use_source_pdf and entry.source is not None and entry.page is not None and entry.scale is not None:
+                by_source.setdefault(entry.source, []).append(entry)
+            else:
+                self._extract_image(entry)
+        for source, pages in by_source.items():
+            self._extract_pdf(source, pages)
+        return entries
+
+    def _extract_image(self, entry: DocumentEntry) -> None:
+        source: Path | DocumentStream = entry.path
+        if entry.image is not None or entry.path.suffix == ".npy":
+            # docling only takes encoded documents, this saves the round-trip through the file system at least
+            png = cv2.imencode(".png", entry.load_image())[1].tobytes()
+            source = DocumentStream(name=entry.path.with_suffix(".png").name, stream=BytesIO(png))
+        result = next(self.converter.convert_all(source=[source]))
+        self._add_elements(entry, result.assembled.elements, 1.0)
+        entry.converted = result.document.export_to_markdown()
+
+    def _extract_pdf(self, source: Path, entries: list[DocumentEntry]) -> None:
+        """Convert the pages of entries from the source PDF in one go, using its text layer and docling's page batching."""
+        pages = {cast(int, entry.page): entry for entry in entries}
+        # docling's page numbers are 1-based and the range is inclusive
+        result = self.converter.convert(source, page_range=(min(pages) + 1, max(pages) + 1))
+        elements: dict[int, list[BasePageElement]] = {}
         for unit in result.assembled.elements:
+            elements.setdefault(unit.page_no, []).append(unit)
+        for page, entry in pages.items():
+            # docling's boxes are in PDF points, ours in pixels of the rendered page
+            self._add_elements(entry, elements.get(page, []), cast(float, entry.scale))
+            entry.converted = result.document.export_to_markdown(page_no=page + 1)
+
+    def _add_elements(self, entry: DocumentEntry, elements: list[BasePageElement], factor: float) -> None:
+        img = None
+        image_index = 0
+        for unit in elements:
             if unit.cluster.confidence < self.min_confidence:
                 continue
             bbox = unit.cluster.bbox
             label = self.__map_label(unit.label)
-            bbox = BoundingBox(x0=bbox.l, y0=bbox.t, x1=bbox.r, y1=bbox.b)
+            bbox = BoundingBox(x0=bbox.l, y0=bbox.t, x1=bbox.r, y1=bbox.b).scaled(factor)
             area: Area
             match label:
                 case Label.TABLE:
@@ -63,7 +169,7 @@ class DoclingExtractor(Extractor):
                     for c in table.table_cells:
                         cell_bbox = None
                         if c.bbox:
-                            cell_bbox = BoundingBox(x0=c.bbox.l, y0=c.bbox.t, x1=c.bbox.r, y1=c.bbox.b)
+                            cell_bbox = BoundingBox(x0=c.bbox.l, y0=c.bbox.t, x1=c.bbox.r, y1=c.bbox.b).scaled(factor)
                         cell = TableCell(
                             bbox=cell_bbox,
                             row_span=c.row_span,
@@ -82,8 +188,10 @@ class DoclingExtractor(Extractor):
                         bbox=bbox, label=Label.TABLE, confidence=unit.cluster.confidence, headers=headers, cells=cells, converted=None
                     )
                 case Label.IMAGE:
-                    cropped = img[int(bbox.y0) : int(bbox.y1), int(bbox.x0) : int(bbox.x1), :]
-                    img_path = Path(entry.path).parent / f"image_{entry.path.stem}_{image_index}.png"
+                    if img is None:
+                        img = entry.load_image()
+                    cropped = img[int(bbox.y0) : int(bbox.y1), int(bbox.x0) : int(bbox.x1)]
+                    img_path = entry.crop_path(f"image_{entry.path.stem}_{image_index}.png")
                     cv2.imwrite(str(img_path), cropped)
                     area = Image(bbox=bbox, label=label, confidence=unit.cluster.confidence, converted=unit.text, path=img_path)
                     image_index += 1
@@ -99,5 +207,3 @@ class DoclingExtractor(Extractor):
                         converted=unit.text,
                     )
             entry.layout.append(area)
-        entry.converted = result.document.export_to_markdown()
-        return entry
@@ -1,8 +1,15 @@
+import hashlib
 import json
 import logging
+import math
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from pathlib import Path
-from typing import Any
+from typing import Any, Protocol
 
 import cv2
 import google.generativeai as genai
@@ -67,46 +74,232 @@ If a image has no text, provide an empty array.
 The JSON output should be clean, directly parsable, and match the format of the example provided. (example.png and example.json files )
 """
 
+MULTI_PAGE_PROMPT = """
+The following {pages} images are separate pages. Analyze each of them as described above and respond with a JSON array with one element per
+page, in the order of the images, where each element is the array of text blocks of that page.
+"""
 
-class GeminiExtractor(Extractor):
-    def __init__(self, api_key: str = os.getenv("GEMINI_API_KEY", ""), retries: int = 3) -> None:
+_NUMBER = {"type": "number"}
+_INTEGER = {"type": "integer"}
+_CELL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "row_span": _INTEGER,
+        "col_span": _INTEGER,
+        "start_row": _INTEGER,
+        "end_row": _INTEGER,
+        "start_col": _INTEGER,
+        "end_col": _INTEGER,
+        "converted": {"type": "string"},
+    },
+    "required": ["row_span", "col_span", "start_row", "end_row", "start_col", "end_col", "converted"],
+}
+# the response schema for a page, matching PROMPT
+PAGE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "label": {"type": "string", "enum": [label.name for label in Label]},
+            "boundingBox": {
+                "type": "object",
+                "properties": {"x": _NUMBER, "y": _NUMBER, "width": _NUMBER, "height": _NUMBER},
+                "required": ["x", "y", "width", "height"],
+            },
+            "text": {"type": "string"},
+            "headers": {"type": "array", "items": _CELL_SCHEMA},
+            "cells": {"type": "array", "items": _CELL_SCHEMA},
+        },
+        "required": ["label", "boundingBox", "text"],
+    },
+}
+
+
+class GeminiClient(Protocol):
+    """The model API used by GeminiExtractor, can be replaced e.g. by a local stand-in for testing."""
+
+    def upload(self, data: bytes, mime_type: str, name: str | None = None) -> Any:
+        """Upload a file to refer to in prompts. Files with a name are uploaded repeatedly, an earlier upload may be reused."""
+        ...
+
+    def generate(self, parts: list[Any], schema: dict[str, Any] | None = None) -> str:
+        """Generate a response to the prompt parts (text and uploaded files), as JSON matching schema if given."""
+        ...
+
+
+class GenaiClient(GeminiClient):
+    # named uploads of this process, by name
+    _uploads: dict[str, Any] = {}
+
+    def __init__(self, api_key: str, model_name: str) -> None:
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model_name="gemini-2.5-flash")
-        self.example_file_upload = genai.upload_file(path=Path(__file__).parent.parent / "assets" / "example.png")
+        self.model_name = model_name
+        self.model = genai.GenerativeModel(model_name=model_name)
+
+    def upload(self, data: bytes, mime_type: str, name: str | None = None) -> Any:
+        if name is None:
+            return genai.upload_file(path=BytesIO(data), mime_type=mime_type)
+        if name not in self._uploads:
+            try:
+                # uploaded files are kept for two days, so earlier runs may have uploaded it already
+                self._uploads[name] = genai.get_file(f"files/{name}")
+            except Exception:
+                self._uploads[name] = genai.upload_file(path=BytesIO(data), mime_type=mime_type, name=name)
+        return self._uploads[name]
+
+    def generate(self, parts: list[Any], schema: dict[str, Any] | None = None) -> str:
+        config = None
+        if schema is not None:
+            config = genai.GenerationConfig(response_mime_type="application/json", response_schema=schema)
+        return self.model.generate_content(parts, generation_config=config).text
+
+
+class RateLimiter:
+    """Spaces out requests to at most requests_per_minute, shared by all threads."""
+
+    def __init__(self, requests_per_minute: float | None) -> None:
+        self.requests_per_minute = requests_per_minute
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self) -> None:
+        if not self.requests_per_minute:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + 60 / self.requests_per_minute
+        time.sleep(start - now)
+
+
+class GeminiExtractor(Extractor):
+    """Extraction with a few-shot prompt to Gemini.
+
+    Requests are latency bound, so batches are extracted concurrently, within the rate limit of the API.
+
+    client(GeminiClient | None): the model API, the Gemini API with api_key if not set.
+    retries(int): attempts per page, failed requests and unparseable responses are retried with exponential backoff.
+    concurrency(int): the maximum number of requests in flight.
+    requests_per_minute(float | None): the maximum rate of requests, unlimited if not set.
+    backoff(float): seconds to wait before the first retry, doubled (with jitter) for each further one.
+    max_pixels(int | None): pages with more pixels are downscaled to this before uploading, bounding boxes are relative anyway.
+    jpeg_quality(int | None): upload pages as JPEG with this quality instead of PNG, which is much smaller for scans.
+    pages_per_request(int): pages to send in a single request, fewer round trips but longer responses.
+    """
+
+    MODEL_NAME = "gemini-2.5-flash"
+    # bump when changing PROMPT or the example, so that cached results of the old prompt aren't reused
+    PROMPT_VERSION = 2
+    supports_pickle = False
+    cache_fields = ("MODEL_NAME", "PROMPT_VERSION", "max_pixels", "jpeg_quality", "pages_per_request")
+
+    def __init__(
+        self,
+        api_key: str = os.getenv("GEMINI_API_KEY", ""),
+        retries: int = 3,
+        client: GeminiClient | None = None,
+        concurrency: int = 8,
+        requests_per_minute: float | None = None,
+        backoff: float = 1.0,
+        max_pixels: int | None = 3_000_000,
+        jpeg_quality: int | None = None,
+        pages_per_request: int = 1,
+    ) -> None:
+        self.client = client if client is not None else GenaiClient(api_key, self.MODEL_NAME)
+        example = (Path(__file__).parent.parent / "assets" / "example.png").read_bytes()
+        # the example is the same for all instances and runs, so it's uploaded once under a name derived from its content
+        self.example_file_upload = self.client.upload(
+            example, "image/png", name=f"folioforge-example-{hashlib.sha1(example).hexdigest()[:16]}"
+        )
         self.example_json_string = (Path(__file__).parent.parent / "assets" / "example.json").read_text()
         self.retries = retries
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.backoff = backoff
+        self.max_pixels = max_pixels
+        self.jpeg_quality = jpeg_quality
+        self.pages_per_request = pages_per_request
+
+    def extract_batch(self, entries: list[DocumentEntry]) -> list[DocumentEntry]:
+        size = max(self.pages_per_request, 1)
+        requests = [entries[i : i + size] for i in range(0, len(entries), size)]
+        if len(requests) <= 1 or self.concurrency <= 1:
+            for request in requests:
+                self._extract_pages(request)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(requests))) as pool:
+                list(pool.map(self._extract_pages, requests))
+        return entries
 
     def extract(self, entry: DocumentEntry) -> DocumentEntry:
-        page_upload = genai.upload_file(path=str(entry.path))
+        self._extract_pages([entry])
+        return entry
 
+    def encode_page(self, entry: DocumentEntry) -> tuple[bytes, str]:
+        """Encode the page for upload within the pixel budget, returns the data and its mime type."""
+        if self.jpeg_quality is None and entry.image is None and entry.path.suffix == ".png":
+            # the page file can be uploaded as it is if it's small enough, check the size without decoding it
+            data = entry.path.read_bytes()
+            # width and height from the IHDR chunk
+            width, height = int.from_bytes(data[16:20]), int.from_bytes(data[20:24])
+            if self.max_pixels is None or width * height <= self.max_pixels:
+                return data, "image/png"
+        img = entry.load_image()
+        pixels = img.shape[0] * img.shape[1]
+        if self.max_pixels is not None and pixels > self.max_pixels:
+            factor = math.sqrt(self.max_pixels / pixels)
+            size = (int(img.shape[1] * factor), int(img.shape[0] * factor))
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        if self.jpeg_quality is not None:
+            return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])[1].tobytes(), "image/jpeg"
+        return cv2.imencode(".png", img)[1].tobytes(), "image/png"
+
+    def _extract_pages(self, entries: list[DocumentEntry]) -> None:
+        pages_data = [self.encode_page(entry) for entry in entries]
+        # pages uploaded so far, kept when a later upload or the request fails
+        page_uploads: list[Any] = []
         prompt_parts = [
             # First user message: The instruction and the example file
             PROMPT,
             self.example_file_upload,
             # First model response: The perfect JSON output for the example
             self.example_json_string,
-            page_upload,
         ]
-        retries = self.retries
+        schema = PAGE_SCHEMA
+        if len(entries) > 1:
+            prompt_parts.append(MULTI_PAGE_PROMPT.format(pages=len(entries)))
+            schema = {"type": "array", "items": PAGE_SCHEMA}
+        names = ", ".join(entry.path.name for entry in entries)
 
+        attempt = 0
         while True:
-            print("Querying Gemini model with few-shot OCR prompt...")
-            response = self.model.generate_content(prompt_parts)
-            cleaned_text = self.clean_json_response(response.text)
+            attempt += 1
             try:
-                page_blocks = json.loads(cleaned_text)
-            except json.JSONDecodeError:
-                retries -= 1
-                if retries == 0:
-                    logging.warning(f"Couldn't get a valid json response from Gemini for page {entry.path.name}")
-                    return entry
-                continue
-            break
-
-        img = cv2.imread(str(entry.path))
-        assert img is not None
-        entry.layout = [self.convert_block(block, img, entry, chunk_id) for chunk_id, block in enumerate(page_blocks)]
-        return entry
+                # uploads are requests as well
+                for data, mime_type in pages_data[len(page_uploads) :]:
+                    self.rate_limiter.wait()
+                    page_uploads.append(self.client.upload(data, mime_type))
+                self.rate_limiter.wait()
+                logging.debug(f"Querying Gemini model with few-shot OCR prompt for {names}...")
+                response = json.loads(self.clean_json_response(self.client.generate([*prompt_parts, *page_uploads], schema)))
+                pages = [response] if len(entries) == 1 else response
+                if len(pages) != len(entries):
+                    raise ValueError(f"expected {len(entries)} pages, got {len(pages)}")
+                break
+            except ValueError:
+                # invalid JSON or not matching the request
+                if attempt >= self.retries:
+                    logging.warning(f"Couldn't get a valid json response from Gemini for {names}")
+                    return
+            except Exception:
+                # e.g. rate limit or server errors, of the uploads or the request
+                if attempt >= self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+        for entry, page_blocks in zip(entries, pages, strict=True):
+            img = entry.load_image()
+            entry.layout = [self.convert_block(block, img, entry, chunk_id) for chunk_id, block in enumerate(page_blocks)]
 
     def convert_block(self, block: dict[str, Any], img: NDArray, entry: DocumentEntry, chunk: int) -> Area:
         rows, cols = img.shape[:2]
@@ -150,7 +343,7 @@ class GeminiExtractor(Extractor):
                     ]
                 return Table(bbox=bbox, label=Label.TABLE, confidence=1.0, headers=headers, cells=cells, converted=block["text"])
             case "IMAGE":
-                img_path = Path(entry.path).parent / f"image_{entry.path.stem}_{chunk}.png"
+                img_path = entry.crop_path(f"image_{entry.path.stem}_{chunk}.png")
                 cropped = img[int(bbox.y0) : int(bbox.y1), int(bbox.x0) : int(bbox.x1)]
                 cv2.imwrite(str(img_path), cropped)
                 return Image(bbox=bbox, label=Label.IMAGE, confidence=1.0, converted=None, path=img_path)
@@ -6,30 +6,57 @@ from folioforge.models.document import Area, BoundingBox, DocumentEntry, Heading
 from folioforge.models.labels import Label
 
 
+def _area(label: Label, bbox: BoundingBox, confidence: float) -> Area:
+    match label:
+        case Label.TABLE:
+            return Table(bbox=bbox, label=label, confidence=confidence, headers=[], cells=[], converted=None)
+        case Label.IMAGE:
+            return Image(bbox=bbox, label=label, confidence=confidence, converted=None)
+        case Label.TITLE:
+            return Heading(level=1, bbox=bbox, label=label, confidence=confidence, converted=None)
+        case Label.SECTION_HEADER:
+            return Heading(level=2, bbox=bbox, label=label, confidence=confidence, converted=None)
+        case _:
+            return Area(
+                bbox=bbox,
+                label=label,
+                confidence=confidence,
+                converted=None,
+            )
+
+
 class DoclayoutYOLODocLayNet(LayoutDetector):
     repo_id = "juliozhao/DocLayout-YOLO-DocLayNet-Docsynth300K_pretrained"
     filename = "doclayout_yolo_doclaynet_imgsz1120_docsynth_pretrain.pt"
     imgsz = 1120
     supports_pickle = True
+    cache_fields = ("repo_id", "filename", "imgsz", "min_confidence")
 
     def __init__(self, min_confidence: float = 0.2):
         self.min_confidence = min_confidence
         filepath = hf_hub_download(self.repo_id, self.filename)
         self.model = YOLOv10(filepath)
+        # labels by class index of the model
+        self.labels = [self.map_label(self.model.names[i]) for i in range(len(self.model.names))]
 
     def detect(self, document: DocumentEntry) -> DocumentEntry:
-        predictions = self.model.predict(document.path, imgsz=self.imgsz, conf=self.min_confidence)
-        boxes = predictions[0].summary()
-        for box in boxes:
-            bbox = BoundingBox(x0=box["box"]["x1"], y0=box["box"]["y1"], x1=box["box"]["x2"], y1=box["box"]["y2"])
-            confidence = box["confidence"]
-
-            area = self.map_label(box["name"], bbox, confidence)
-            document.layout.append(area)
+        return self.detect_batch([document])[0]
 
-        return document
+    def detect_batch(self, documents: list[DocumentEntry]) -> list[DocumentEntry]:
+        if not documents:
+            return documents
+        # a list of images is loaded and run through the model as a single batch
+        predictions = self.model.predict([d.load_image() for d in documents], imgsz=self.imgsz, conf=self.min_confidence, verbose=False)
+        for document, prediction in zip(documents, predictions, strict=True):
+            boxes = prediction.boxes
+            # one transfer per tensor instead of going through the per box dicts of summary()
+            for (x0, y0, x1, y1), confidence, cls in zip(
+                boxes.xyxy.cpu().tolist(), boxes.conf.cpu().tolist(), boxes.cls.cpu().int().tolist(), strict=True
+            ):
+                document.layout.append(_area(self.labels[cls], BoundingBox(x0=x0, y0=y0, x1=x1, y1=y1), confidence))
+        return documents
 
-    def map_label(self, label: str, bbox: BoundingBox, confidence: float) -> Area:
+    def map_label(self, label: str) -> Label:
         matched_label: Label
         match label:
             case "Caption":
@@ -54,22 +81,7 @@ class DoclayoutYOLODocLayNet(LayoutDetector):
                 matched_label = Label.FOOTNOTE
             case _:
                 matched_label = Label.OTHER
-        match matched_label:
-            case Label.TABLE:
-                return Table(bbox=bbox, label=matched_label, confidence=confidence, headers=[], cells=[], converted=None)
-            case Label.IMAGE:
-                return Image(bbox=bbox, label=matched_label, confidence=confidence, converted=None)
-            case Label.TITLE:
-                return Heading(level=1, bbox=bbox, label=matched_label, confidence=confidence, converted=None)
-            case Label.SECTION_HEADER:
-                return Heading(level=2, bbox=bbox, label=matched_label, confidence=confidence, converted=None)
-            case _:
-                return Area(
-                    bbox=bbox,
-                    label=matched_label,
-                    confidence=confidence,
-                    converted=None,
-                )
+        return matched_label
 
 
 class DoclayoutYOLOD4LA(DoclayoutYOLODocLayNet):
@@ -77,7 +89,7 @@ class DoclayoutYOLOD4LA(DoclayoutYOLODocLayNet):
     filename = "doclayout_yolo_d4la_imgsz1600_docsynth_pretrain.pt"
     imgsz = 1600
 
-    def map_label(self, label: str, bbox: BoundingBox, confidence: float) -> Area:
+    def map_label(self, label: str) -> Label:
         # https://openaccess.thecvf.com/content/ICCV2023/supplemental/Da_Vision_Grid_Transformer_ICCV_2023_supplemental.pdf
         matched_label: Label
         match label:
@@ -103,22 +115,7 @@ class DoclayoutYOLOD4LA(DoclayoutYOLODocLayNet):
                 matched_label = Label.FOOTNOTE
             case _:
                 matched_label = Label.OTHER
-        match matched_label:
-            case Label.TABLE:
-                return Table(bbox=bbox, label=matched_label, confidence=confidence, headers=[], cells=[], converted=None)
-            case Label.IMAGE:
-                return Image(bbox=bbox, label=matched_label, confidence=confidence, converted=None)
-            case Label.TITLE:
-                return Heading(level=1, bbox=bbox, label=matched_label, confidence=confidence, converted=None)
-            case Label.SECTION_HEADER:
-                return Heading(level=2, bbox=bbox, label=matched_label, confidence=confidence, converted=None)
-            case _:
-                return Area(
-                    bbox=bbox,
-                    label=matched_label,
-                    confidence=confidence,
-                    converted=None,
-                )
+        return matched_label
 
 
 class DoclayoutYOLODocStructBench(DoclayoutYOLODocLayNet):
@@ -126,7 +123,7 @@ class DoclayoutYOLODocStructBench(DoclayoutYOLODocLayNet):
     filename = "doclayout_yolo_docstructbench_imgsz1024.pt"
     imgsz = 1024
 
-    def map_label(self, label: str, bbox: BoundingBox, confidence: float) -> Area:
+    def map_label(self, label: str) -> Label:
         # https://arxiv.org/pdf/2410.12628 Appendix A.1
         matched_label: Label
         match label:
@@ -144,19 +141,4 @@ class DoclayoutYOLODocStructBench(DoclayoutYOLODocLayNet):
                 matched_label = Label.FOOTNOTE
             case _:
                 matched_label = Label.OTHER
-        match matched_label:
-            case Label.TABLE:
-                return Table(bbox=bbox, label=matched_label, confidence=confidence, headers=[], cells=[], converted=None)
-            case Label.IMAGE:
-                return Image(bbox=bbox, label=matched_label, confidence=confidence, converted=None)
-            case Label.TITLE:
-                return Heading(level=1, bbox=bbox, label=matched_label, confidence=confidence, converted=None)
-            case Label.SECTION_HEADER:
-                return Heading(level=2, bbox=bbox, label=matched_label, confidence=confidence, converted=None)
-            case _:
-                return Area(
-                    bbox=bbox,
-                    label=matched_label,
-                    confidence=confidence,
-                    converted=None,
-                )
+        return matched_label
@@ -5,5 +5,11 @@ from folioforge.models.document import DocumentEntry
 
 class LayoutDetector(Protocol):
     supports_pickle: bool
+    # attributes that affect the results, see Extractor.cache_fields
+    cache_fields: tuple[str, ...] = ()
 
     def detect(self, document: DocumentEntry) -> DocumentEntry: ...
+
+    def detect_batch(self, documents: list[DocumentEntry]) -> list[DocumentEntry]:
+        """Detect the layout of several pages, detectors that can run them through their model at once override this."""
+        return [self.detect(document) for document in documents]
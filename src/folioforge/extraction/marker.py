@@ -1,4 +1,6 @@
+import threading
 from pathlib import Path
+from typing import Any, cast
 
 import cv2
 from bs4 import BeautifulSoup
@@ -6,6 +8,7 @@ from marker.config.parser import ConfigParser
 from marker.converters.pdf import PdfConverter
 from marker.models import create_model_dict
 from marker.renderers.chunk import FlatBlockOutput
+from numpy import ndarray
 
 from folioforge.extraction.protocol import Extractor
 from folioforge.models.document import Area, BoundingBox, DocumentEntry, Heading, Image, ListItem, Table, TableCell, Text
@@ -13,10 +16,21 @@ from folioforge.models.labels import Label
 
 
 class MarkerPDFExtractor(Extractor):
+    """Extraction with marker.
+
+    use_source_pdf(bool): convert pages rendered from a PDF (with source, page and scale set) from the PDF itself instead of the
+        page images. All pages of a batch that come from the same PDF are converted together, so marker can batch them and only
+        sets up the document once. Works best with batches that hold many pages of a document (see MicroBatcher).
+
+    Conversions are serialized, as the page range to convert is passed through the shared configuration of the converter.
+    """
+
     supports_pickle = True
+    cache_fields = ("min_confidence", "use_source_pdf")
 
-    def __init__(self, min_confidence: float = 0.2) -> None:
+    def __init__(self, min_confidence: float = 0.2, use_source_pdf: bool = False) -> None:
         self.min_confidence = min_confidence
+        self.use_source_pdf = use_source_pdf
         self.config = {"output_format": "chunks", "detection_line_min_confidence": self.min_confidence}
         self.parsed_config = ConfigParser(self.config)
         self.converter = PdfConverter(
@@ -26,18 +40,63 @@ class MarkerPDFExtractor(Extractor):
             renderer=self.parsed_config.get_renderer(),
             llm_service=self.parsed_config.get_llm_service(),
         )
+        # guards the converter and its configuration
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {**self.__dict__, "_lock": None}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
 
     def extract(self, entry: DocumentEntry) -> DocumentEntry:
-        result = self.converter(str(entry.path))
-        entry.layout = []
+        return self.extract_batch([entry])[0]
+
+    def extract_batch(self, entries: list[DocumentEntry]) -> list[DocumentEntry]:
+        by_source: dict[Path, list[DocumentEntry]] = {}
+        for entry in entries:
+            if self.use_source_pdf and entry.source is not None and entry.page is not None and entry.scale is not None:
+                by_source.setdefault(entry.source, []).append(entry)
+            else:
+                with self._lock:
+                    result = self.converter(str(entry.write_image()))
+                self._add_chunks(entry, result.blocks, 1.0)
+        for source, pages in by_source.items():
+            self._extract_pdf(source, pages)
+        return entries
+
+    def _extract_pdf(self, source: Path, entries: list[DocumentEntry]) -> None:
+        """Convert the pages of entries from the source PDF in one go."""
+        pages = {cast(int, entry.page): entry for entry in entries}
+        # the page range is read by the PDF provider when the document is built
+        with self._lock:
+            self.converter.config["page_range"] = sorted(pages)
+            try:
+                result = self.converter(str(source))
+            finally:
+                del self.converter.config["page_range"]
+        chunks: dict[int, list[FlatBlockOutput]] = {}
         for chunk in result.blocks:
+            chunks.setdefault(chunk.page, []).append(chunk)
+        for page, entry in pages.items():
+            # marker's boxes are in PDF points, ours in pixels of the rendered page
+            self._add_chunks(entry, chunks.get(page, []), cast(float, entry.scale))
+
+    def _add_chunks(self, entry: DocumentEntry, chunks: list[FlatBlockOutput], factor: float) -> None:
+        entry.layout = []
+        # decoded once per page for all of its pictures
+        img = None
+        for chunk in chunks:
             if not chunk.html:
                 continue
-            entry.layout.extend(self._chunk_to_areas(chunk, entry))
-
-        return entry
+            if factor != 1.0:
+                chunk = chunk.model_copy(update={"bbox": [v * factor for v in chunk.bbox]})
+            if img is None and chunk.block_type in ("Picture", "PictureGroup", "Figure", "FigureGroup"):
+                img = entry.load_image()
+            entry.layout.extend(self._chunk_to_areas(chunk, entry, img))
 
-    def _chunk_to_areas(self, chunk: FlatBlockOutput, entry: DocumentEntry) -> list[Area]:
+    def _chunk_to_areas(self, chunk: FlatBlockOutput, entry: DocumentEntry, img: ndarray | None) -> list[Area]:
         match chunk.block_type:
             case "SectionHeader":
                 return [self._convert_header(chunk)]
@@ -46,7 +105,8 @@ class MarkerPDFExtractor(Extractor):
                 return [self._convert_table(chunk)]
 
             case "Picture" | "PictureGroup" | "Figure" | "FigureGroup":
-                return [self._convert_image(chunk, entry)]
+                assert img is not None
+                return [self._convert_image(chunk, entry, img)]
 
             case "ListGroup":
                 return self._convert_list(chunk)
@@ -111,10 +171,8 @@ class MarkerPDFExtractor(Extractor):
             converted=chunk.html,
         )
 
-    def _convert_image(self, chunk: FlatBlockOutput, entry: DocumentEntry) -> Area:
-        img = cv2.imread(str(entry.path))
-        assert img is not None
-        img_path = Path(entry.path).parent / f"image_{entry.path.stem}_{chunk.id.replace('/', '_')}.png"
+    def _convert_image(self, chunk: FlatBlockOutput, entry: DocumentEntry, img: ndarray) -> Area:
+        img_path = entry.crop_path(f"image_{entry.path.stem}_{chunk.id.replace('/', '_')}.png")
         cropped = img[int(chunk.bbox[1]) : int(chunk.bbox[3]), int(chunk.bbox[0]) : int(chunk.bbox[2])]
         cv2.imwrite(str(img_path), cropped)
         return Image(
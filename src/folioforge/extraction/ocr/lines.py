@@ -0,0 +1,49 @@
+import numpy as np
+
+from folioforge.models.document import Area, BoundingBox, Image, Table, TableCell
+
+
+def _boxes(bboxes: list[BoundingBox]) -> np.ndarray:
+    return np.array([[b.x0, b.y0, b.x1, b.y1] for b in bboxes], dtype=np.float64).reshape(-1, 4)
+
+
+def overlap(lines: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """Fraction of the area of each line (n x 4, x0 y0 x1 y1) that lies within each box (m x 4), as an n x m matrix."""
+    x0 = np.maximum(lines[:, None, 0], boxes[None, :, 0])
+    y0 = np.maximum(lines[:, None, 1], boxes[None, :, 1])
+    x1 = np.minimum(lines[:, None, 2], boxes[None, :, 2])
+    y1 = np.minimum(lines[:, None, 3], boxes[None, :, 3])
+    intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    line_area = (lines[:, 2] - lines[:, 0]) * (lines[:, 3] - lines[:, 1])
+    return intersection / np.maximum(line_area, 1e-9)[:, None]
+
+
+def assign_lines(lines: np.ndarray, texts: list[str], layout: list[Area], min_overlap: float = 0.5) -> None:
+    """Fill the layout areas and table cells with the text lines of an OCR pass over the whole page.
+
+    Each line goes to the box that contains the largest part of it, table cells take precedence over areas. Lines with less than
+    min_overlap of their area in any box are dropped, they're outside of the detected layout. Lines are expected in reading order.
+    Areas that already have text, e.g. from the PDF text layer, are left as they are.
+    """
+    cells: list[TableCell] = [c for a in layout if isinstance(a, Table) for c in a.headers + a.cells if c.bbox and c.converted is None]
+    areas = [a for a in layout if not isinstance(a, Image) and a.converted is None]
+    assigned_cells: list[list[str]] = [[] for _ in cells]
+    assigned_areas: list[list[str]] = [[] for _ in areas]
+
+    remaining = np.arange(len(texts))
+    for bboxes, assigned in (([c.bbox for c in cells if c.bbox], assigned_cells), ([a.bbox for a in areas], assigned_areas)):
+        if not bboxes or not len(remaining):
+            continue
+        ratio = overlap(lines[remaining], _boxes(bboxes))
+        best = ratio.argmax(axis=1)
+        matched = ratio[np.arange(len(remaining)), best] >= min_overlap
+        for line, target in zip(remaining[matched].tolist(), best[matched].tolist(), strict=True):
+            assigned[target].append(texts[line])
+        remaining = remaining[~matched]
+
+    for cell, cell_texts in zip(cells, assigned_cells, strict=True):
+        cell.converted = " ".join(cell_texts)
+    for area, area_texts in zip(areas, assigned_areas, strict=True):
+        # tables with cells get their text from the cells
+        if not isinstance(area, Table) or not (area.cells or area.headers):
+            area.converted = " ".join(area_texts)
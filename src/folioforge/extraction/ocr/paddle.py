@@ -1,52 +1,188 @@
-from itertools import groupby
-from pathlib import Path
+from collections.abc import Callable
+from itertools import batched, groupby
 
 import cv2
+import numpy as np
 from numpy import ndarray
-from paddleocr import PaddleOCR, TableStructureRecognition
+from paddleocr import TableStructureRecognition, TextDetection, TextRecognition
 
+from folioforge.extraction.ocr.lines import assign_lines
 from folioforge.extraction.ocr.protocol import OcrExtractor
-from folioforge.models.document import BoundingBox, DocumentEntry, Image, Table, TableCell
+from folioforge.models.document import Area, BoundingBox, DocumentEntry, Image, Table, TableCell
+from folioforge.preprocessor.image import ink_density
+from folioforge.preprocessor.pdf import PageRegionRenderer
 
 
 class PaddleOcrExtractor(OcrExtractor):
+    """OCR with PaddleOCR on the crops of the detected layout areas.
+
+    Text lines are detected in each crop, and the lines of all areas and table cells of a page, or of several pages with
+    extract_batch, are then recognized in batches instead of calling the recognition model once per crop.
+
+    render_scale(float | None): if set, crops of PDF pages are re-rendered from the source at this resolution (pixels per PDF
+        point) instead of being cut from the page image. This allows rendering pages at a low resolution for layout detection.
+    min_ink_density(float | None): areas and table cells with a lower fraction of ink pixels are blank and not OCR'd.
+    batch_size(int): how many crops (for detection) or text lines (for recognition) are passed to the models at once.
+    full_page(bool): instead of cropping areas and cells, run OCR once on the whole page and assign each text line to the area or
+        table cell containing it (see assign_lines). This doesn't clip characters at the borders of tight cells either.
+    min_line_overlap(float): in full page mode, the fraction of a text line that has to lie within an area or cell to be assigned.
+    table_padding(float): padding around the cells found by table structure recognition, in PDF points. Pages without a scale
+        (i.e. images) are taken to be at 4 pixels per point.
+    """
+
     supports_pickle = False
+    cache_fields = ("render_scale", "min_ink_density", "full_page", "min_line_overlap", "table_padding")
 
-    def __init__(self):
-        self.ocr = PaddleOCR(use_doc_orientation_classify=False, use_doc_unwarping=False, use_textline_orientation=False)
+    def __init__(
+        self,
+        render_scale: float | None = None,
+        min_ink_density: float | None = 0.001,
+        batch_size: int = 32,
+        full_page: bool = False,
+        min_line_overlap: float = 0.5,
+        table_padding: float = 1.25,
+    ):
+        self.render_scale = render_scale
+        self.min_ink_density = min_ink_density
+        self.batch_size = batch_size
+        self.full_page = full_page
+        self.min_line_overlap = min_line_overlap
+        self.table_padding = table_padding
+        # the models of the PaddleOCR pipeline, used separately to batch recognition across crops
+        self.text_detection = TextDetection(model_name="PP-OCRv5_server_det")
+        self.text_recognition = TextRecognition(model_name="PP-OCRv5_server_rec")
         self.table_ocr = TableStructureRecognition(model_name="SLANet")
 
     def extract(self, entry: DocumentEntry) -> DocumentEntry:
-        img = cv2.imread(str(entry.path))
-        assert img is not None
-        entry.layout = sorted(entry.layout, key=lambda a: (a.bbox.y0, a.bbox.x0))
-        image_index = 0
-        for area in entry.layout:
-            cropped_img = img[int(area.bbox.y0) : int(area.bbox.y1), int(area.bbox.x0) : int(area.bbox.x1), :]
-            if isinstance(area, Image):
-                img_path = Path(entry.path).parent / f"image_{entry.path.stem}_{image_index}.png"
-                cv2.imwrite(str(img_path), cropped_img)
-                area.path = img_path
-                image_index += 1
+        return self.extract_batch([entry])[0]
+
+    def extract_batch(self, documents: list[DocumentEntry]) -> list[DocumentEntry]:
+        # crops to recognize and where the text goes
+        targets: list[Area | TableCell] = []
+        crops: list[ndarray] = []
+        tables: list[Table] = []
+        # whole pages to OCR in full page mode, with the resolution of their images relative to the page image
+        pages: list[tuple[DocumentEntry, float]] = []
+        page_imgs: list[ndarray] = []
+        for entry in documents:
+            crop = self._cropper(entry)
+            # in pixels of the page image
+            padding = self.table_padding * (entry.scale or 4)
+            try:
+                entry.layout = sorted(entry.layout, key=lambda a: (a.bbox.y0, a.bbox.x0))
+                image_index = 0
+                for area in entry.layout:
+                    if isinstance(area, Image):
+                        img_path = entry.crop_path(f"image_{entry.path.stem}_{image_index}.png")
+                        cv2.imwrite(str(img_path), crop(area.bbox))
+                        area.path = img_path
+                        image_index += 1
+                        continue
+                    if self.full_page:
+                        if isinstance(area, Table):
+                            self.detect_table_structure(crop(area.bbox), area, crop.factor, padding)
+                            tables.append(area)
+                        continue
+                    cropped_img = crop(area.bbox)
+                    if self._is_blank(cropped_img):
+                        area.skipped = "blank"
+                        area.converted = ""
+                    elif isinstance(area, Table):
+                        self.detect_table_structure(cropped_img, area, crop.factor, padding)
+                        self._collect_cells(area, crop, targets, crops)
+                        tables.append(area)
+                    else:
+                        targets.append(area)
+                        crops.append(cropped_img)
+                if self.full_page:
+                    pages.append((entry, crop.factor))
+                    page_imgs.append(crop.page())
+            finally:
+                crop.close()
+
+        for target, text in zip(targets, self.recognize(crops), strict=True):
+            target.converted = text
+        for (entry, factor), (lines, texts) in zip(pages, self.recognize_lines(page_imgs), strict=True):
+            assign_lines(lines / factor, texts, entry.layout, self.min_line_overlap)
+        for table in tables:
+            # in full page mode, tables without detected cells get the lines within them
+            if not self.full_page or table.cells or table.headers:
+                table.converted = _table_text(table)
+        for entry in documents:
+            entry.converted = "\n".join(area.converted or "" for area in entry.layout)
+        return documents
+
+    def recognize(self, crops: list[ndarray]) -> list[str]:
+        """Recognize the text of each crop, its lines joined in reading order."""
+        return [" ".join(texts) for _, texts in self.recognize_lines(crops)]
+
+    def recognize_lines(self, imgs: list[ndarray]) -> list[tuple[ndarray, list[str]]]:
+        """Detect and recognize the text lines of each image, returning their boxes (x0, y0, x1, y1) and texts.
+
+        Lines are detected image by image (in batches of batch_size images), and the lines of all images are recognized together.
+        """
+        imgs = [cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if img.ndim == 2 else img for img in imgs]
+        boxes: list[ndarray] = []
+        for batch in batched(imgs, self.batch_size):
+            for output in self.text_detection.predict(list(batch), batch_size=self.batch_size):
+                polys = np.asarray(output["dt_polys"], dtype=np.float64).reshape(-1, 4, 2)
+                boxes.append(_reading_order(np.concatenate([polys.min(axis=1), polys.max(axis=1)], axis=1)))
+        lines = [
+            img[int(max(y0, 0)) : int(y1), int(max(x0, 0)) : int(x1)]
+            for img, img_boxes in zip(imgs, boxes, strict=True)
+            for x0, y0, x1, y1 in img_boxes
+        ]
+        texts = [output["rec_text"] for output in self.text_recognition.predict(lines, batch_size=self.batch_size)] if lines else []
+        results = []
+        for img_boxes in boxes:
+            results.append((img_boxes, texts[: len(img_boxes)]))
+            texts = texts[len(img_boxes) :]
+        return results
+
+    def _is_blank(self, img: ndarray) -> bool:
+        return self.min_ink_density is not None and ink_density(img) < self.min_ink_density
+
+    def _cropper(self, entry: DocumentEntry) -> "_Cropper":
+        if self.render_scale is not None and entry.source is not None and entry.page is not None and entry.scale is not None:
+            return _Cropper(entry, PageRegionRenderer(entry.source, entry.page, self.render_scale))
+        return _Cropper(entry, None)
+
+    def _collect_cells(
+        self, table: Table, crop: Callable[[BoundingBox], ndarray], targets: list[Area | TableCell], crops: list[ndarray]
+    ) -> None:
+        for cell in table.headers + table.cells:
+            if not cell.bbox:
+                continue
+            cell_img = crop(cell.bbox)
+            if self._is_blank(cell_img):
+                cell.converted = ""
                 continue
-            elif isinstance(area, Table):
-                self.extract_table(cropped_img, img, area)
-            else:
-                output = self.ocr.ocr(cropped_img)
-                area.converted = " ".join(output[0]["rec_texts"])
-        entry.converted = "\n".join(area.converted or "" for area in entry.layout)
-        return entry
-
-    def extract_table(self, cropped_image: ndarray, full_image: ndarray, table: Table, padding: int = 5) -> None:
+            targets.append(cell)
+            crops.append(cell_img)
+
+    def extract_table(
+        self, cropped_image: ndarray, crop: Callable[[BoundingBox], ndarray], table: Table, factor: float = 1.0, padding: float = 5
+    ) -> None:
+        """Recognize a table, crop is used to get the images of the cells and factor is the resolution of the crops relative to the page."""
+        self.detect_table_structure(cropped_image, table, factor, padding)
+        targets: list[Area | TableCell] = []
+        crops: list[ndarray] = []
+        self._collect_cells(table, crop, targets, crops)
+        for target, text in zip(targets, self.recognize(crops), strict=True):
+            target.converted = text
+        table.converted = _table_text(table)
+
+    def detect_table_structure(self, cropped_image: ndarray, table: Table, factor: float = 1.0, padding: float = 5) -> None:
+        """Detect the cells of a table, if layout detection only detected the table as a whole."""
         if not table.cells:
             # layout detection only detected the whole table, so we do table detection now
             output = self.table_ocr.predict(cropped_image)[0]
             bboxes = [
                 BoundingBox(
-                    x0=min(b[0], b[2], b[4], b[6]) + table.bbox.x0 - padding,
-                    y0=min(b[1], b[3], b[5], b[7]) + table.bbox.y0 - padding,
-                    x1=max(b[0], b[2], b[4], b[6]) + table.bbox.x0 + padding,
-                    y1=max(b[1], b[3], b[5], b[7]) + table.bbox.y0 + padding,
+                    x0=min(b[0], b[2], b[4], b[6]) / factor + table.bbox.x0 - padding,
+                    y0=min(b[1], b[3], b[5], b[7]) / factor + table.bbox.y0 - padding,
+                    x1=max(b[0], b[2], b[4], b[6]) / factor + table.bbox.x0 + padding,
+                    y1=max(b[1], b[3], b[5], b[7]) / factor + table.bbox.y0 + padding,
                 )
                 for b in output["bbox"]
             ]
@@ -80,21 +216,54 @@ class PaddleOcrExtractor(OcrExtractor):
             table.headers = [c for c in cells if c.start_row == 0]
             table.cells = [c for c in cells if c.start_row != 0]
 
-        for header in table.headers:
-            if not header.bbox:
-                continue
-            output = self.ocr.predict(full_image[int(header.bbox.y0) : int(header.bbox.y1), int(header.bbox.x0) : int(header.bbox.x1), :])
-            header.converted = " ".join(output[0]["rec_texts"])
-        for cell in table.cells:
-            if not cell.bbox:
-                continue
-            output = self.ocr.predict(full_image[int(cell.bbox.y0) : int(cell.bbox.y1), int(cell.bbox.x0) : int(cell.bbox.x1), :])
-            cell.converted = " ".join(output[0]["rec_texts"])
-
-        table.converted = (
-            ",".join(header.converted or "" for header in table.headers)
-            + "\n"
-            + "\n".join(
-                (",".join((cell.converted or "" for cell in group)) for _, group in groupby(table.cells, key=lambda c: c.start_row))
-            )
-        )
+
+def _reading_order(boxes: ndarray, tolerance: float = 10) -> ndarray:
+    """Sort line boxes top to bottom, and left to right within a row (boxes whose tops differ by less than tolerance), like PaddleOCR."""
+    order = sorted(range(len(boxes)), key=lambda i: (boxes[i][1], boxes[i][0]))
+    for i in range(len(order) - 1):
+        for j in range(i, -1, -1):
+            a, b = boxes[order[j]], boxes[order[j + 1]]
+            if abs(b[1] - a[1]) >= tolerance or a[0] <= b[0]:
+                break
+            order[j], order[j + 1] = order[j + 1], order[j]
+    return boxes[order]
+
+
+def _table_text(table: Table) -> str:
+    return (
+        ",".join(header.converted or "" for header in table.headers)
+        + "\n"
+        + "\n".join((",".join((cell.converted or "" for cell in group)) for _, group in groupby(table.cells, key=lambda c: c.start_row)))
+    )
+
+
+class _Cropper:
+    """Cuts areas out of a page, either from the page image or by re-rendering them from the source PDF."""
+
+    def __init__(self, entry: DocumentEntry, renderer: PageRegionRenderer | None) -> None:
+        self.entry = entry
+        self.renderer = renderer
+        self.img: ndarray | None = None
+        # resolution of the crops relative to the page image
+        self.factor = 1.0
+        if renderer is not None and entry.scale is not None:
+            self.factor = renderer.scale / entry.scale
+
+    def __call__(self, bbox: BoundingBox) -> ndarray:
+        if self.renderer is not None and self.entry.scale is not None:
+            return self.renderer.render(bbox.scaled(1 / self.entry.scale))
+        if self.img is None:
+            self.img = self.entry.load_image()
+        return self.img[int(max(bbox.y0, 0)) : int(bbox.y1), int(max(bbox.x0, 0)) : int(bbox.x1), :]
+
+    def page(self) -> ndarray:
+        """The whole page, at the resolution of the crops."""
+        if self.renderer is not None and self.entry.scale is not None:
+            return self.renderer.render(BoundingBox(x0=0, y0=0, x1=self.renderer.width, y1=self.renderer.height))
+        if self.img is None:
+            self.img = self.entry.load_image()
+        return self.img
+
+    def close(self) -> None:
+        if self.renderer is not None:
+            self.renderer.close()
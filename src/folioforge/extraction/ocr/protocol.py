@@ -5,5 +5,11 @@ from folioforge.models.document import DocumentEntry
 
 class OcrExtractor(Protocol):
     supports_pickle: bool
+    # attributes that affect the results, see Extractor.cache_fields
+    cache_fields: tuple[str, ...] = ()
 
     def extract(self, document: DocumentEntry) -> DocumentEntry: ...
+
+    def extract_batch(self, documents: list[DocumentEntry]) -> list[DocumentEntry]:
+        """OCR several pages, extractors that can batch model calls across pages override this."""
+        return [self.extract(document) for document in documents]
@@ -0,0 +1,108 @@
+import unicodedata
+
+import pypdfium2 as pypdfium
+
+from folioforge.extraction.ocr.protocol import OcrExtractor
+from folioforge.models.document import Area, DocumentEntry, Image, Table
+from folioforge.preprocessor.pdf import PDFIUM_LOCK
+
+
+def text_quality(text: str) -> float:
+    """Fraction of non-whitespace characters that are valid text."""
+    # missing ToUnicode maps and broken font encodings show up as replacement, control or private use characters
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return 0.0
+    valid = sum(1 for c in chars if c != "\ufffd" and unicodedata.category(c) not in ("Cc", "Co", "Cn", "Cs"))
+    return valid / len(chars)
+
+
+class PdfTextLayerExtractor(OcrExtractor):
+    """Fills layout areas from the embedded text layer of born-digital PDFs and only runs OCR where there's no usable text.
+
+    Needs entries rendered from a PDF (with source, page and scale set), everything else goes to the fallback.
+    Images and tables always go to the fallback, as they need crops and table structure recognition respectively.
+
+    fallback(OcrExtractor | None): OCR for scanned pages and areas without usable embedded text.
+    min_page_chars(int): pages with fewer embedded characters than this are treated as scanned and OCR'd completely.
+    min_page_quality(float): pages whose embedded text has a lower fraction of valid characters are OCR'd completely.
+    min_page_coverage(float): if a lower fraction of a page's text areas has usable embedded text, the page is OCR'd completely,
+        e.g. scanned pages that only have a stamp or header in their text layer.
+    min_area_chars(int): areas with fewer embedded characters than this are OCR'd, e.g. text inside images.
+    min_area_quality(float): areas whose embedded text has a lower fraction of valid characters are OCR'd.
+    """
+
+    cache_fields = (
+        "fallback",
+        "min_page_chars",
+        "min_page_quality",
+        "min_page_coverage",
+        "min_area_chars",
+        "min_area_quality",
+    )
+
+    def __init__(
+        self,
+        fallback: OcrExtractor | None = None,
+        min_page_chars: int = 20,
+        min_page_quality: float = 0.9,
+        min_page_coverage: float = 0.5,
+        min_area_chars: int = 1,
+        min_area_quality: float = 0.95,
+    ) -> None:
+        self.fallback = fallback
+        self.min_page_chars = min_page_chars
+        self.min_page_quality = min_page_quality
+        self.min_page_coverage = min_page_coverage
+        self.min_area_chars = min_area_chars
+        self.min_area_quality = min_area_quality
+        self.supports_pickle = fallback is None or fallback.supports_pickle
+
+    def extract(self, document: DocumentEntry) -> DocumentEntry:
+        return self.extract_batch([document])[0]
+
+    def extract_batch(self, documents: list[DocumentEntry]) -> list[DocumentEntry]:
+        unresolved = [
+            document.model_copy(update={"layout": areas}) for document in documents if (areas := self._extract_text_layer(document))
+        ]
+        if unresolved and self.fallback is not None:
+            # the fallback works on the same area objects, so its results end up on the original entries
+            self.fallback.extract_batch(unresolved)
+        for document in documents:
+            document.layout = sorted(document.layout, key=lambda a: (a.bbox.y0, a.bbox.x0))
+            document.converted = "\n".join(area.converted or "" for area in document.layout)
+        return documents
+
+    def _extract_text_layer(self, document: DocumentEntry) -> list[Area]:
+        """Fill areas from the text layer, returning the areas that still need OCR."""
+        candidates = [a for a in document.layout if a.converted is None and not isinstance(a, Image | Table)]
+        others = [a for a in document.layout if a.converted is None and isinstance(a, Image | Table)]
+        if not candidates or document.source is None or document.page is None or document.scale is None:
+            return candidates + others
+
+        with PDFIUM_LOCK:
+            pdf = pypdfium.PdfDocument(document.source)
+            try:
+                page = pdf[document.page]
+                # boxes are in the orientation of the rendered page, which only maps directly to the text page if it's not rotated
+                if page.get_rotation() != 0:
+                    return candidates + others
+                left, _, _, top = page.get_cropbox()
+                textpage = page.get_textpage()
+                if textpage.count_chars() < self.min_page_chars or text_quality(textpage.get_text_range()) < self.min_page_quality:
+                    return candidates + others
+
+                texts: dict[int, str] = {}
+                for i, area in enumerate(candidates):
+                    bbox = area.bbox.scaled(1 / document.scale)
+                    # pdfium's page coordinates have their origin at the bottom left
+                    text = textpage.get_text_bounded(left + bbox.x0, top - bbox.y1, left + bbox.x1, top - bbox.y0)
+                    if len(text.strip()) >= self.min_area_chars and text_quality(text) >= self.min_area_quality:
+                        texts[i] = " ".join(text.split())
+                if len(texts) < self.min_page_coverage * len(candidates):
+                    return candidates + others
+                for i, text in texts.items():
+                    candidates[i].converted = text
+                return [area for i, area in enumerate(candidates) if i not in texts] + others
+            finally:
+                pdf.close()
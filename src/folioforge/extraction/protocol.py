@@ -5,7 +5,16 @@ from folioforge.models.document import DocumentEntry
 
 class Extractor(Protocol):
     supports_pickle: bool
+    # whether worker processes can be forked from a process with the extractor built, sharing its models. Not the case for
+    # extractors running torch or paddle models, as forking may hang in OpenMP or fail to initialize CUDA in the workers.
+    supports_fork: bool = False
+    # attributes that affect the results, which ExtractionCache keys them by (see extractor_fingerprint)
+    cache_fields: tuple[str, ...] = ()
 
     def __init__(self, min_confidence: float = 0.2) -> None: ...
 
     def extract(self, entry: DocumentEntry) -> DocumentEntry: ...
+
+    def extract_batch(self, entries: list[DocumentEntry]) -> list[DocumentEntry]:
+        """Extract several pages, extractors that can batch model calls override this."""
+        return [self.extract(entry) for entry in entries]
@@ -7,6 +7,8 @@ from folioforge.models.document import DocumentEntry
 class TwoPhaseExtractor(Extractor):
     """An extractor that does layout detection and ocr phases separately."""
 
+    cache_fields = ("layout_detector", "ocr_extractor")
+
     def __init__(self, layout_detector: LayoutDetector, ocr_extractor: OcrExtractor) -> None:
         self.layout_detector = layout_detector
         self.ocr_extractor = ocr_extractor
@@ -16,3 +18,7 @@ class TwoPhaseExtractor(Extractor):
         entry = self.layout_detector.detect(entry)
         entry = self.ocr_extractor.extract(entry)
         return entry
+
+    def extract_batch(self, entries: list[DocumentEntry]) -> list[DocumentEntry]:
+        """Extract several pages, running layout detection and OCR on all of them at once."""
+        return self.ocr_extractor.extract_batch(self.layout_detector.detect_batch(entries))
@@ -1,16 +1,50 @@
+import os
+import tempfile
+from collections.abc import Callable, Iterable, Iterator
 from pathlib import Path
 
-from pydantic import BaseModel, SerializeAsAny, field_serializer
+import cv2
+import numpy as np
+from pydantic import BaseModel, ConfigDict, Field, SerializeAsAny, field_serializer
 
 from folioforge.models.labels import Label
 
 
+def read_page_image(path: Path, grayscale: bool = False) -> np.ndarray:
+    """Read a page image file, raw .npy pages are memory mapped so that crops only read the part of the file they need."""
+    if path.suffix == ".npy":
+        img = np.load(path, mmap_mode="r")
+        if grayscale and img.ndim == 3:
+            return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if not grayscale and img.ndim == 2:
+            return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        return img
+    img = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+    assert img is not None
+    return img
+
+
+def write_page_image(path: Path, img: np.ndarray) -> None:
+    """Write a page image file, encoded according to its suffix or raw for .npy."""
+    if path.suffix == ".npy":
+        # readers might have the old page memory mapped, so it's replaced instead of overwritten
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, img)
+        os.replace(tmp, path)
+    else:
+        cv2.imwrite(str(path), img)
+
+
 class BoundingBox(BaseModel):
     x0: float
     y0: float
     x1: float
     y1: float
 
+    def scaled(self, factor: float) -> "BoundingBox":
+        return BoundingBox(x0=self.x0 * factor, y0=self.y0 * factor, x1=self.x1 * factor, y1=self.y1 * factor)
+
 
 class Area(BaseModel):
     """An area is a detected region in a document."""
@@ -19,6 +53,8 @@ class Area(BaseModel):
     label: Label
     confidence: float
     converted: str | None
+    # why the area wasn't extracted, e.g. "blank"
+    skipped: str | None = Field(default=None, exclude_if=lambda v: v is None)
 
     @field_serializer("label")
     def serialize_label(self, v) -> str:
@@ -60,9 +96,51 @@ class Text(Area):
 class DocumentEntry(BaseModel):
     """Represents a single entry in a document (e.g. page)"""
 
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     path: Path
     layout: list[SerializeAsAny[Area]]
     converted: str | None
+    # source document and index of the page in it, if known
+    source: Path | None = Field(default=None, exclude=True)
+    page: int | None = Field(default=None, exclude=True)
+    # resolution of the page image in pixels per PDF point (1/72 inch), if known. Bounding boxes are in page image pixels,
+    # dividing them by scale gives resolution independent coordinates, e.g. to re-render regions at a different resolution.
+    scale: float | None = Field(default=None, exclude=True)
+    # decoded page image (BGR or grayscale), when set it takes precedence over the file at `path`
+    image: np.ndarray | None = Field(default=None, exclude=True, repr=False)
+    # why the page wasn't extracted, e.g. "blank"
+    skipped: str | None = Field(default=None, exclude_if=lambda v: v is None)
+    # where to write image crops of the page, if not next to the page file, e.g. when pages are in a PageStore
+    crop_dir: Path | None = Field(default=None, exclude=True)
+
+    def crop_path(self, name: str) -> Path:
+        """Path of an image crop of the page, in crop_dir or next to the page file."""
+        return (self.crop_dir or self.path.parent) / name
+
+    def load_image(self, grayscale: bool = False) -> np.ndarray:
+        """Get the page image, using the in-memory buffer if present and reading it from `path` otherwise."""
+        if self.image is None:
+            return read_page_image(self.path, grayscale)
+        if grayscale and self.image.ndim == 3:
+            return cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        if not grayscale and self.image.ndim == 2:
+            return cv2.cvtColor(self.image, cv2.COLOR_GRAY2BGR)
+        return self.image
+
+    def update_image(self, img: np.ndarray) -> None:
+        """Replace the page image, in memory if the entry holds a buffer and on disk otherwise."""
+        if self.image is not None:
+            self.image = img
+        else:
+            write_page_image(self.path, img)
+
+    def write_image(self) -> Path:
+        """Make sure the page image exists as an encoded file, for tools that can only read image files."""
+        path = self.path.with_suffix(".png") if self.path.suffix == ".npy" else self.path
+        if not path.exists():
+            cv2.imwrite(str(path), self.load_image())
+        return path
 
 
 class DocumentReference(BaseModel):
@@ -71,3 +149,22 @@ class DocumentReference(BaseModel):
     path: Path
     items: list[DocumentEntry]
     converted: str | None
+    # entries that haven't been produced yet, e.g. pages that are only rendered once they're iterated over
+    pending: Iterable[DocumentEntry] | None = Field(default=None, exclude=True, repr=False)
+    # [start, stop) pages of the source document this reference covers, if it's a shard of a larger document
+    page_range: tuple[int, int] | None = Field(default=None, exclude=True)
+
+    def iter_items(self) -> Iterator[DocumentEntry]:
+        """Iterate over all entries, producing pending ones on demand and moving them to `items`."""
+        yield from self.items
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            for entry in pending:
+                self.items.append(entry)
+                yield entry
+
+    def map_items(self, fn: Callable[[DocumentEntry], DocumentEntry]) -> None:
+        """Apply fn to all entries, pending entries are only mapped once they're produced."""
+        self.items = [fn(entry) for entry in self.items]
+        if self.pending is not None:
+            self.pending = map(fn, self.pending)
@@ -13,6 +13,8 @@ class MarkdownGenerator(OutputGenerator[str]):
         result = []
 
         for entry in document.items:
+            if entry.skipped is not None:
+                result.append(f"<!-- {entry.path.stem} skipped: {entry.skipped} -->")
             for area in sorted(entry.layout, key=lambda a: (a.bbox.y0, a.bbox.x0)):
                 result.append(self.convert_element(area))
             result.append("\n")
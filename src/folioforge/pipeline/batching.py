@@ -0,0 +1,159 @@
+import queue
+import threading
+import time
+from collections.abc import Callable, Container, Iterable, Iterator
+
+from folioforge.extraction.protocol import Extractor
+from folioforge.models.document import DocumentEntry
+from folioforge.pipeline.cache import ExtractionCache
+from folioforge.pipeline.dedup import PageDeduplicator, copy_result
+
+# marks the end of the input of _timed_batches
+_END = object()
+
+
+class MicroBatcher:
+    """Groups a stream of pages into batches for Extractor.extract_batch, up to a maximum size and waiting time.
+
+    With adaptive batching, the batch size is tuned from the observed latency: it starts at min_size and doubles as long as
+    this increases throughput (pages per second), and falls back to the best measured size when it doesn't.
+
+    max_size(int): the largest batch to build.
+    max_wait(float | None): seconds to wait for a batch to fill up, e.g. while pages are still being rendered, before passing on
+        a partial batch. The input is then iterated in a thread, which reads ahead by up to max_size items, so that a partial
+        batch is passed on when max_wait expires even while the input blocks.
+    adaptive(bool): tune the batch size between min_size and max_size, otherwise batches are always max_size.
+    min_size(int): the smallest batch size to try when adapting.
+    """
+
+    def __init__(self, max_size: int = 8, max_wait: float | None = 0.5, adaptive: bool = True, min_size: int = 1) -> None:
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.adaptive = adaptive
+        self.min_size = min(min_size, max_size)
+        self.size = self.min_size if adaptive else max_size
+        # smoothed throughput by batch size
+        self._throughput: dict[int, float] = {}
+
+    def batches[T](self, items: Iterable[T]) -> Iterator[list[T]]:
+        if self.max_wait is not None:
+            yield from self._timed_batches(items, self.max_wait)
+            return
+        batch: list[T] = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self.size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _timed_batches[T](self, items: Iterable[T], max_wait: float) -> Iterator[list[T]]:
+        pulled: queue.Queue = queue.Queue(maxsize=self.max_size)
+        stopped = threading.Event()
+        errors: list[BaseException] = []
+
+        def put(item: object) -> bool:
+            # gives up once the batches aren't consumed anymore
+            while not stopped.is_set():
+                try:
+                    pulled.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def pull() -> None:
+            try:
+                for item in items:
+                    if not put(item):
+                        return
+            except BaseException as e:
+                errors.append(e)
+            put(_END)
+
+        threading.Thread(target=pull, daemon=True).start()
+        batch: list[T] = []
+        deadline = 0.0
+        try:
+            while True:
+                try:
+                    item = pulled.get(timeout=max(deadline - time.monotonic(), 0) if batch else None)
+                except queue.Empty:
+                    yield batch
+                    batch = []
+                    continue
+                if item is _END:
+                    break
+                if not batch:
+                    deadline = time.monotonic() + max_wait
+                batch.append(item)
+                if len(batch) >= self.size or time.monotonic() >= deadline:
+                    yield batch
+                    batch = []
+            if errors:
+                raise errors[0]
+            if batch:
+                yield batch
+        finally:
+            stopped.set()
+
+    def record(self, size: int, seconds: float) -> None:
+        """Record how long a batch took to process, to tune the batch size."""
+        if not self.adaptive:
+            return
+        # recorded by the size of the batch, which differs from the current size for partial batches and those built before
+        # it last changed
+        throughput = size / max(seconds, 1e-9)
+        previous = self._throughput.get(size)
+        self._throughput[size] = throughput if previous is None else 0.7 * previous + 0.3 * throughput
+
+        best = max(self._throughput, key=lambda s: self._throughput[s])
+        larger = min(self.size * 2, self.max_size)
+        if best == self.size and larger not in self._throughput:
+            self.size = larger
+        else:
+            self.size = best
+
+    def process[T, R](self, items: Iterable[T], fn: Callable[[list[T]], list[R]]) -> Iterator[tuple[list[T], list[R]]]:
+        """Apply fn to batches of items, timing each call to tune the batch size."""
+        for batch in self.batches(items):
+            started = time.monotonic()
+            results = fn(batch)
+            self.record(len(batch), time.monotonic() - started)
+            yield batch, results
+
+
+def extract_entries(
+    extractor: Extractor, entries: list[DocumentEntry], cache: ExtractionCache | None = None, exclude: Container[int] = ()
+) -> list[DocumentEntry]:
+    """Extract the entries that aren't skipped or excluded (by index) as one batch, through the cache if there is one."""
+    results = list(entries)
+    todo = [i for i, entry in enumerate(entries) if entry.skipped is None and i not in exclude]
+    if todo:
+        batch = [entries[i] for i in todo]
+        extracted = extractor.extract_batch(batch) if cache is None else cache.extract_batch(extractor, batch)
+        for i, entry in zip(todo, extracted, strict=True):
+            results[i] = entry
+    return results
+
+
+def extract_unique(
+    extractor: Extractor, entries: list[DocumentEntry], cache: ExtractionCache | None, dedup: PageDeduplicator[DocumentEntry] | None
+) -> list[DocumentEntry]:
+    """Extract a batch of entries, copying the result of an earlier page (of this or a previous batch) to near-duplicates of it."""
+    duplicates: dict[int, DocumentEntry] = {}
+    if dedup is not None:
+        for i, entry in enumerate(entries):
+            if entry.skipped is not None:
+                continue
+            signature = dedup.signature(entry)
+            if (original := dedup.find(signature)) is not None:
+                duplicates[i] = original
+            else:
+                # extractors fill in the entries they're given, so this holds the result once the batch is extracted
+                dedup.add(signature, entry)
+    results = extract_entries(extractor, entries, cache, exclude=duplicates)
+    for i, original in duplicates.items():
+        results[i] = copy_result(original, results[i])
+    return results
@@ -0,0 +1,193 @@
+import base64
+import hashlib
+import json
+import os
+import tempfile
+from enum import Enum
+from pathlib import Path
+from typing import Any, cast
+
+from pydantic import Base64Bytes, BaseModel
+
+from folioforge.extraction.protocol import Extractor
+from folioforge.models.document import Area, DocumentEntry, Heading, Image, ListItem, Table, Text
+from folioforge.models.labels import Label
+
+# area types by name, as layouts are serialized as plain areas
+_AREA_TYPES: dict[str, type[Area]] = {cls.__name__: cls for cls in (Area, Text, Heading, ListItem, Table, Image)}
+
+
+def extractor_fingerprint(obj: Any) -> dict[str, Any]:
+    """Collect the configuration of an extractor that affects its results, i.e. its type and the attributes in cache_fields.
+
+    Nested folioforge objects (e.g. the OCR of a TwoPhaseExtractor) are fingerprinted the same way and models by their
+    fields. Operational settings like batch sizes or concurrency are left out of cache_fields, so changing them keeps the cache.
+    """
+    fingerprint: dict[str, Any] = {"type": f"{type(obj).__module__}.{type(obj).__qualname__}"}
+    for name in getattr(obj, "cache_fields", ()):
+        value = getattr(obj, name)
+        if isinstance(value, Enum):
+            fingerprint[name] = value.value
+        elif value is None or isinstance(value, str | int | float | bool):
+            fingerprint[name] = value
+        elif isinstance(value, Path):
+            fingerprint[name] = str(value)
+        elif isinstance(value, BaseModel):
+            fingerprint[name] = value.model_dump(mode="json")
+        else:
+            fingerprint[name] = extractor_fingerprint(value)
+    return fingerprint
+
+
+def page_hash(entry: DocumentEntry) -> str:
+    """Hash the content of a page, i.e. the in-memory image if there is one and the page file otherwise."""
+    digest = hashlib.sha256()
+    if entry.image is not None:
+        digest.update(f"{entry.image.shape}{entry.image.dtype}".encode())
+        digest.update(entry.image.tobytes())
+    else:
+        digest.update(entry.path.read_bytes())
+    return digest.hexdigest()
+
+
+class CachedResult(BaseModel):
+    """The extraction result of a page as it's stored in the cache, JSON instead of pickle so that loading it can't run code."""
+
+    # name of the page file the result was extracted from, without suffix
+    page: str
+    # areas with their type
+    layout: list[dict[str, Any]]
+    converted: str | None
+    # image crops by file name
+    images: dict[str, Base64Bytes]
+
+    @classmethod
+    def of(cls, entry: DocumentEntry) -> "CachedResult":
+        images = {
+            # Base64Bytes decodes what it's given
+            area.path.name: base64.b64encode(area.path.read_bytes())
+            for area in entry.layout
+            if isinstance(area, Image) and area.path is not None and area.path.exists()
+        }
+        layout = [{"type": type(area).__name__, **area.model_dump(mode="json")} for area in entry.layout]
+        return cls(page=entry.path.stem, layout=layout, converted=entry.converted, images=images)
+
+    def areas(self) -> list[Area]:
+        areas = []
+        for data in self.layout:
+            data = dict(data)
+            area_cls = _AREA_TYPES[data.pop("type")]
+            # labels are serialized by name
+            areas.append(area_cls.model_validate({**data, "label": Label[data["label"]]}))
+        return areas
+
+
+class ExtractionCache:
+    """Persistent, content-addressed cache of extraction results for single pages.
+
+    Results are keyed by the page content and the extractor configuration, so unchanged pages aren't extracted again even if
+    the document around them changed. Results are stored as files in a directory, which can be shared between processes and
+    dask workers (e.g. on a network file system) as writes are atomic.
+
+    directory(Path): where to store the results.
+    max_bytes(int | None): once the cache grows beyond this size, the least recently used results are evicted.
+    low_water(float): fraction of max_bytes to evict down to, so that the directory is only scanned again once a number of
+        results have been added rather than on every one.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int | None = 1 << 30, low_water: float = 0.9) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._size: int | None = None
+
+    def key(self, extractor: Extractor, entry: DocumentEntry) -> str:
+        config = json.dumps(extractor_fingerprint(extractor), sort_keys=True)
+        return hashlib.sha256(f"{page_hash(entry)}:{config}".encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get(self, key: str, entry: DocumentEntry) -> DocumentEntry | None:
+        """Fill entry with the cached result for key, returns None if there is none."""
+        path = self._path(key)
+        try:
+            cached = CachedResult.model_validate_json(path.read_bytes())
+            layout = cached.areas()
+            # bump the modification time, which is what eviction goes by
+            os.utime(path)
+        except (FileNotFoundError, ValueError, KeyError):
+            # missing, partially written by an older version or otherwise unreadable
+            return None
+        # restore image crops next to the current page, the ones of the original run might be gone. Crops are named after their
+        # page, which can be a different one with the same content.
+        for area in layout:
+            if isinstance(area, Image) and area.path is not None and area.path.name in cached.images:
+                content = cached.images[area.path.name]
+                area.path = entry.crop_path(area.path.name.replace(cached.page, entry.path.stem, 1))
+                area.path.write_bytes(content)
+        entry.layout = layout
+        entry.converted = cached.converted
+        return entry
+
+    def put(self, key: str, entry: DocumentEntry) -> None:
+        data = CachedResult.of(entry).model_dump_json().encode()
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # a result that's overwritten doesn't add to the size
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        if self.max_bytes is not None:
+            if self._size is None:
+                self._size = sum(p.stat().st_size for p in self.directory.glob("*/*.json"))
+            else:
+                self._size += len(data) - replaced
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used results until the cache is below low_water * max_bytes."""
+        files = []
+        for p in self.directory.glob("*/*.json"):
+            try:
+                stat = p.stat()
+            except FileNotFoundError:
+                # evicted by someone else sharing the directory
+                continue
+            files.append((stat.st_mtime, stat.st_size, p))
+        files.sort()
+        size = sum(f[1] for f in files)
+        for _, file_size, p in files:
+            if self.max_bytes is None or size <= self.low_water * self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            size -= file_size
+        self._size = size
+
+    def extract(self, extractor: Extractor, entry: DocumentEntry) -> DocumentEntry:
+        """Extract entry, using the cached result if there is one."""
+        key = self.key(extractor, entry)
+        if (cached := self.get(key, entry)) is not None:
+            return cached
+        entry = extractor.extract(entry)
+        self.put(key, entry)
+        return entry
+
+    def extract_batch(self, extractor: Extractor, entries: list[DocumentEntry]) -> list[DocumentEntry]:
+        """Extract entries, passing the ones that aren't cached to the extractor as one batch."""
+        keys = [self.key(extractor, entry) for entry in entries]
+        results = [self.get(key, entry) for key, entry in zip(keys, entries, strict=True)]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            for i, entry in zip(missing, extractor.extract_batch([entries[i] for i in missing]), strict=True):
+                self.put(keys[i], entry)
+                results[i] = entry
+        return cast(list[DocumentEntry], results)
@@ -1,37 +1,163 @@
 import tempfile
+from collections.abc import Container, Generator, Iterable, Iterator
 from functools import partial
 from pathlib import Path
 from typing import TypeVar, cast
 
 import dask.bag as db
-from dask.distributed import Client
+from dask.distributed import Client, WorkerPlugin, as_completed
 
 from folioforge.extraction.protocol import Extractor
 from folioforge.models.document import DocumentEntry, DocumentReference
 from folioforge.output.protocol import OutputGenerator
-from folioforge.pipeline.protocol import PipelineExecutor
+from folioforge.pipeline.batching import MicroBatcher, extract_entries
+from folioforge.pipeline.cache import ExtractionCache
+from folioforge.pipeline.dedup import PageDeduplicator, Signature, copy_result
+from folioforge.pipeline.factory import ExtractorFactory, resolve
+from folioforge.pipeline.protocol import PipelineExecutor, finish_documents, needs_images
 from folioforge.postprocessor.protocol import Postprocessor
-from folioforge.preprocessor.protocol import Preprocessor
+from folioforge.preprocessor.protocol import Preprocessor, ShardingPreprocessor
+from folioforge.preprocessor.store import PageStore
 
+# index of the document in the paths to execute and of the page in the document
+type PageKey = tuple[int, int]
 
-def expand(r: DocumentReference) -> list[tuple[Path, DocumentEntry]]:
-    return [(r.path, i) for i in r.items]
+
+class _Counted:
+    """Tells the client how many pages a shard of a document has, so that it knows when all of them are extracted."""
+
+    def __init__(self, document: int, pages: int, dropped: bool) -> None:
+        self.document = document
+        self.pages = pages
+        self.dropped = dropped
+
+
+type PageItem = tuple[PageKey, DocumentEntry] | _Counted
+
+
+def _process(processor: Preprocessor, outdir: Path, document: tuple[int, DocumentReference | None]) -> tuple[int, DocumentReference | None]:
+    # documents dropped by an earlier preprocessor are passed on as None, for the client to know they won't have pages
+    index, reference = document
+    return index, processor.process(reference, outdir) if reference is not None else None
+
+
+def expand(document: tuple[int, DocumentReference | None]) -> list[PageItem]:
+    index, r = document
+    if r is None:
+        return [_Counted(index, 0, True)]
+    # shards of a document have the page numbers of the whole document
+    entries: list[PageItem] = [((index, i if entry.page is None else entry.page), entry) for i, entry in enumerate(r.iter_items())]
+    return [*entries, _Counted(index, len(entries), False)]
+
+
+def is_page(item: PageItem) -> bool:
+    return not isinstance(item, _Counted)
+
+
+def assemble(path: Path, entries: list[tuple[PageKey, DocumentEntry]]) -> DocumentReference:
+    # entries of a document can come from different partitions, so page order needs to be restored
+    items = [entry for _, entry in sorted(entries, key=lambda e: e[0])]
+    return DocumentReference(path=path, items=items, converted="\n\n".join(i.converted or "" for i in items))
+
+
+def collect(paths: list[Path], shards: list[int], chunks: Iterable[list[PageItem]], ordered: bool = True) -> Iterator[DocumentReference]:
+    """Put extracted pages back together into documents, yielding each one as soon as all of its pages are in.
+
+    shards(list[int]): the document index of each shard.
+    chunks(Iterable[list[PageItem]]): extracted pages and the page counts of the shards, in any order and grouping.
+    """
+    shards_left = [shards.count(i) for i in range(len(paths))]
+    expected = [0] * len(paths)
+    dropped = [False] * len(paths)
+    entries: list[list[tuple[PageKey, DocumentEntry]]] = [[] for _ in paths]
+    # documents complete after the last chunk, and those waiting for an earlier one when ordered
+    complete: list[int] = []
+    waiting: set[int] = set()
+    next_index = 0
+    for chunk in chunks:
+        for item in chunk:
+            if isinstance(item, _Counted):
+                index = item.document
+                shards_left[index] -= 1
+                expected[index] += item.pages
+                dropped[index] |= item.dropped
+            else:
+                index = item[0][0]
+                entries[index].append(item)
+            if shards_left[index] == 0 and len(entries[index]) == expected[index]:
+                complete.append(index)
+        if ordered:
+            waiting.update(complete)
+            complete = []
+            while next_index in waiting:
+                waiting.remove(next_index)
+                complete.append(next_index)
+                next_index += 1
+        for index in complete:
+            if not dropped[index]:
+                yield assemble(paths[index], entries[index])
+            entries[index] = []
+        complete = []
+
+
+def _sign(dedup: PageDeduplicator, entry: tuple[PageKey, DocumentEntry]) -> tuple[PageKey, Signature | None]:
+    return entry[0], None if entry[1].skipped is not None else dedup.signature(entry[1])
+
+
+class ResidentExtractorPlugin(WorkerPlugin):
+    """Builds the extractor of a factory when a worker starts, so that its first task doesn't have to wait for models to load."""
+
+    def __init__(self, factory: ExtractorFactory[Extractor]) -> None:
+        self.factory = factory
+        # registering the plugin again for the same factory replaces it
+        self.name = f"folioforge-extractor-{factory.key}"
+
+    def setup(self, worker) -> None:
+        self.factory.get()
+
+    def teardown(self, worker) -> None:
+        self.factory.release()
 
 
 T = TypeVar("T")
 
 
 class DaskPipelineExecutor[T](PipelineExecutor):
+    """Runs the pipeline on a dask cluster.
+
+    The client is created on the first execute and reused by later ones, so workers stay warm (e.g. with extractors built from a
+    factory). Use the executor as a context manager, or close it, to shut the client down again.
+
+    address(str | None): address of the scheduler of an existing cluster, a local cluster with n_workers workers (with
+        threads_per_worker threads each) is started if neither address nor client are given.
+    client(Client | None): an existing client to use, it's left open on close.
+
+    cache(ExtractionCache | None): reuse extraction results of pages seen in earlier runs.
+    store(PageStore | None): page store to release pages to once they're extracted.
+    dedup_max_distance(int | None): if set, pages that look the same as another page of the batch (see PageDeduplicator) aren't
+        extracted again but get a copy of its result. All pages are kept in worker memory until they're hashed.
+    batcher(MicroBatcher | None): group the pages of a partition into batches with this, instead of extracting them one by one.
+
+    The extractor can be given as an ExtractorFactory, which is built once on each worker (shared by its threads) instead of being
+    pickled with the tasks. Extractors that don't support pickling can only be used this way.
+    """
+
     def __init__(
         self,
         preprocessors: list[Preprocessor],
-        extractor: Extractor,
+        extractor: Extractor | ExtractorFactory[Extractor],
         format: OutputGenerator[T],
         postprocessors: list[Postprocessor] | None,
         outdir: Path,
         n_workers: int = 4,
         threads_per_worker: int = 1,
         partitions: int = 2,
+        cache: ExtractionCache | None = None,
+        store: PageStore | None = None,
+        dedup_max_distance: int | None = None,
+        batcher: MicroBatcher | None = None,
+        address: str | None = None,
+        client: Client | None = None,
     ) -> None:
         self.preprocessors = preprocessors
         self.extractor = extractor
@@ -41,21 +167,37 @@ class DaskPipelineExecutor[T](PipelineExecutor):
         self.n_workers = n_workers
         self.threads_per_worker = threads_per_worker
         self.partitions = partitions
+        self.cache = cache
+        self.store = store
+        self.dedup_max_distance = dedup_max_distance
+        self.batcher = batcher
+        self.address = address
+        self._client = client
+        self._owns_client = client is None
+        self._plugin_registered = False
 
-        if not self.extractor.supports_pickle:
-            raise NotImplementedError(f"The extractor {self.extractor} does not support pickling and can't use dask")
+        if not isinstance(self.extractor, ExtractorFactory) and not self.extractor.supports_pickle:
+            raise NotImplementedError(
+                f"The extractor {self.extractor} does not support pickling, it can only be used with dask through an ExtractorFactory"
+            )
 
     @classmethod
     def setup(
         cls,
         preprocessors: list[Preprocessor],
-        extractor: Extractor,
+        extractor: Extractor | ExtractorFactory[Extractor],
         format: OutputGenerator[T],
         postprocessors: list[Postprocessor] | None = None,
         outdir: Path | None = None,
         n_workers: int = 4,
         threads_per_worker: int = 1,
         partitions: int = 2,
+        cache: ExtractionCache | None = None,
+        store: PageStore | None = None,
+        dedup_max_distance: int | None = None,
+        batcher: MicroBatcher | None = None,
+        address: str | None = None,
+        client: Client | None = None,
     ) -> "DaskPipelineExecutor":
         if outdir is None:
             outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
@@ -68,30 +210,120 @@ class DaskPipelineExecutor[T](PipelineExecutor):
             n_workers=n_workers,
             threads_per_worker=threads_per_worker,
             partitions=partitions,
+            cache=cache,
+            store=store,
+            dedup_max_distance=dedup_max_distance,
+            batcher=batcher,
+            address=address,
+            client=client,
         )
 
-    def extract(self, entry: tuple[Path, DocumentEntry]) -> tuple[Path, DocumentEntry]:
-        return (entry[0], self.extractor.extract(entry[1]))
+    @property
+    def client(self) -> Client:
+        if self._client is None:
+            if self.address is not None:
+                self._client = Client(self.address)
+            else:
+                self._client = Client(n_workers=self.n_workers, threads_per_worker=self.threads_per_worker)
+        if isinstance(self.extractor, ExtractorFactory) and not self._plugin_registered:
+            self._client.register_plugin(ResidentExtractorPlugin(self.extractor))
+            self._plugin_registered = True
+        return self._client
+
+    def close(self) -> None:
+        """Close the client if the executor created it, which shuts down its local cluster as well.
+
+        Workers drop the extractor built from a factory either way, so that a cluster that outlives the executor (i.e. with
+        client or address given) doesn't keep its models.
+        """
+        if self._client is not None and self._plugin_registered:
+            assert isinstance(self.extractor, ExtractorFactory)
+            self._client.unregister_worker_plugin(ResidentExtractorPlugin(self.extractor).name)
+            self._plugin_registered = False
+        if self._client is not None and self._owns_client:
+            self._client.close()
+            self._client = None
+
+    def __getstate__(self) -> dict:
+        # the executor is shipped to workers with its methods, the client stays on this side
+        state = self.__dict__.copy()
+        state["_client"] = None
+        return state
+
+    def extract(self, items: Iterable[PageItem], duplicates: Container[PageKey] = frozenset()) -> list[PageItem]:
+        """Extract the pages of a partition, except for the given duplicates, passing on the page counts."""
+        batcher = self.batcher or MicroBatcher(max_size=1, max_wait=None, adaptive=False)
+        results: list[PageItem] = []
+
+        def entries() -> Iterator[tuple[PageKey, DocumentEntry]]:
+            for item in items:
+                if isinstance(item, _Counted):
+                    results.append(item)
+                else:
+                    yield item
+
+        for batch, extracted in batcher.process(entries(), partial(self._extract_batch, duplicates)):
+            for (key, _), entry in zip(batch, extracted, strict=True):
+                # don't ship page buffers back to the client, unless a postprocessor needs them
+                if not needs_images(self.postprocessors):
+                    entry.image = None
+                if self.store is not None:
+                    self.store.release(entry)
+                results.append((key, entry))
+        return results
+
+    def _extract_batch(self, duplicates: Container[PageKey], batch: list[tuple[PageKey, DocumentEntry]]) -> list[DocumentEntry]:
+        # the cache directory needs to be shared between workers for results to be reused across them
+        exclude = {i for i, (key, _) in enumerate(batch) if key in duplicates}
+        return extract_entries(resolve(self.extractor), [entry for _, entry in batch], self.cache, exclude)
 
     def execute(self, paths: list[Path]) -> list[tuple[DocumentReference, T]]:
-        Client(n_workers=self.n_workers, threads_per_worker=self.threads_per_worker)
-        references = db.from_sequence(
-            [DocumentReference(path=path, items=[], converted=None) for path in paths], npartitions=self.partitions
-        )
+        return list(self.execute_iter(paths))
+
+    def execute_iter(self, paths: list[Path], ordered: bool = True) -> Generator[tuple[DocumentReference, T]]:
+        """Execute the pipeline, yielding documents once all partitions with pages of them are extracted.
+
+        With dedup_max_distance, pages can only be extracted once all of them are hashed, and documents are yielded at the end.
+        """
+        client = self.client
+        documents = [(i, DocumentReference(path=path, items=[], converted=None)) for i, path in enumerate(paths)]
+        npartitions = self.partitions
+        if self.preprocessors and isinstance(self.preprocessors[0], ShardingPreprocessor):
+            # split large documents (e.g. into page ranges) so that all workers can take part in preprocessing them
+            sharding = self.preprocessors[0]
+            documents = [(i, shard) for i, document in documents for shard in sharding.shard(document)]
+            npartitions = max(npartitions, len(documents))
+        references = db.from_sequence(documents, npartitions=npartitions)
 
         for processor in self.preprocessors:
-            references = db.map(partial(processor.process, outdir=self.outdir), references)
+            references = references.map(partial(_process, processor, self.outdir))
 
-        # turn into bag of document entries
+        # turn into bag of document entries, along with the page count of each shard
         entries = references.map(expand).flatten().repartition(npartitions=self.partitions)
-        entries = db.map(self.extract, entries)
+        shards = [i for i, _ in documents]
+        if self.dedup_max_distance is None:
+            # pages are put back together on the client, which gets all of them anyway, instead of shuffling them between workers
+            futures = client.compute(entries.map_partitions(self.extract).to_delayed())
+            chunks: Iterable[list[PageItem]] = (future.result() for future in as_completed(futures))
+        else:
+            chunks = [self._execute_deduplicated(client, entries, self.dedup_max_distance)]
+        return finish_documents(collect(paths, shards, chunks, ordered), self.postprocessors, self.format, self.outdir)
 
-        references = entries.groupby(lambda e: e[0]).map(
-            lambda e: DocumentReference(path=e[0], items=[i[1] for i in e[1]], converted="\n\n".join(i[1].converted or "" for i in e[1]))
-        )
-        result = cast(list[DocumentReference], references.compute())
-        if self.postprocessors:
-            for postprocessor in self.postprocessors:
-                result = list(postprocessor.process(result, self.outdir))
+    def _execute_deduplicated(self, client: Client, entries: db.Bag, max_distance: int) -> list[PageItem]:
+        """Extract only one page of each group of duplicates and copy its result to the others on the client."""
+        dedup = PageDeduplicator[PageKey](max_distance)
+        # pages have to be kept around until all of them are hashed, instead of being rendered again for extraction
+        entries = client.persist(entries)
+        signed = cast(list[tuple[PageKey, Signature | None]], entries.filter(is_page).map(partial(_sign, dedup)).compute(scheduler=client))
+        signed_only = [(key, signature) for key, signature in signed if signature is not None]
+        groups = dedup.group([signature for _, signature in signed_only])
+        duplicates = {signed_only[i][0]: signed_only[g][0] for i, g in enumerate(groups) if g != i}
 
-        return self.format.convert(result)
+        extracted = cast(
+            list[PageItem],
+            entries.map_partitions(partial(self.extract, duplicates=duplicates)).compute(scheduler=client),
+        )
+        by_key = dict(item for item in extracted if not isinstance(item, _Counted))
+        for key, original in duplicates.items():
+            copy_result(by_key[original], by_key[key])
+        return extracted
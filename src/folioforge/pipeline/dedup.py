@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+
+from folioforge.models.document import DocumentEntry
+
+# size of the page image, its perceptual hash and its thumbnail
+type Signature = tuple[tuple[int, int], int, np.ndarray]
+
+
+def perceptual_hash(img: np.ndarray) -> int:
+    """64 bit difference hash of an image, images that look the same have hashes with a small hamming distance.
+
+    The image is reduced to 9x8 pixels, each bit is whether a pixel is brighter than its right neighbour. This is robust to scan
+    noise, compression artifacts and small changes in brightness.
+    """
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def thumbnail(img: np.ndarray) -> np.ndarray:
+    """32x32 grayscale thumbnail of an image, to compare the content of pages that have similar perceptual hashes."""
+    return cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA)
+
+
+class PageDeduplicator[T]:
+    """Finds pages that look the same as a page seen before, e.g. cover sheets, boilerplate terms or repeated forms.
+
+    Pages are only compared to pages of the same size, so extraction results (i.e. bounding boxes) can be reused as they are. The
+    perceptual hash only finds candidates, as pages of dense text with the same layout can have hashes just a few bits apart. A
+    candidate is only a duplicate if the thumbnails of both pages are close as well, which scan noise or a shift by a pixel
+    barely changes, but a different text in the same layout does.
+
+    max_distance(int): pages whose perceptual hashes differ in at most this many of 64 bits are candidates.
+    max_difference(float): candidates whose thumbnails differ by at most this many gray levels per pixel on average are
+        duplicates.
+    """
+
+    def __init__(self, max_distance: int = 4, max_difference: float = 2.0) -> None:
+        self.max_distance = max_distance
+        self.max_difference = max_difference
+        self._hashes: dict[tuple[int, int], np.ndarray] = {}
+        self._thumbnails: dict[tuple[int, int], list[np.ndarray]] = {}
+        self._values: dict[tuple[int, int], list[T]] = {}
+
+    def signature(self, entry: DocumentEntry) -> Signature:
+        img = entry.load_image(grayscale=True)
+        return (img.shape[0], img.shape[1]), perceptual_hash(img), thumbnail(img)
+
+    def find(self, signature: Signature) -> T | None:
+        """Get the value added for a page that looks the same, i.e. its hash is within max_distance and its thumbnail close."""
+        shape, page_hash, small = signature
+        hashes = self._hashes.get(shape)
+        if hashes is None:
+            return None
+        distances = np.bitwise_count(hashes ^ np.uint64(page_hash))
+        for candidate in np.flatnonzero(distances <= self.max_distance):
+            difference = np.abs(self._thumbnails[shape][candidate].astype(np.int16) - small).mean()
+            if difference <= self.max_difference:
+                return self._values[shape][candidate]
+        return None
+
+    def add(self, signature: Signature, value: T) -> None:
+        shape, page_hash, small = signature
+        self._hashes[shape] = np.append(self._hashes.get(shape, np.empty(0, dtype=np.uint64)), np.uint64(page_hash))
+        self._thumbnails.setdefault(shape, []).append(small)
+        self._values.setdefault(shape, []).append(value)
+
+    def group(self, signatures: list[Signature]) -> list[int]:
+        """Assign each page the index of the first page it's a duplicate of, or its own index if it's not a duplicate."""
+        dedup = PageDeduplicator[int](self.max_distance, self.max_difference)
+        groups = []
+        for i, signature in enumerate(signatures):
+            original = dedup.find(signature)
+            if original is None:
+                dedup.add(signature, i)
+                original = i
+            groups.append(original)
+        return groups
+
+
+def copy_result(source: DocumentEntry, target: DocumentEntry) -> DocumentEntry:
+    """Copy the extraction result of source to target, image areas keep pointing to the crops of source."""
+    target.layout = [area.model_copy(deep=True) for area in source.layout]
+    target.converted = source.converted
+    return target
@@ -0,0 +1,57 @@
+import threading
+import uuid
+from collections.abc import Callable
+from typing import Any, Final
+
+
+class ExtractorFactory[T]:
+    """A recipe for an extractor (or a component of one, e.g. a layout detector) that is cheap to pickle.
+
+    The extractor is only built by get, at most once per process, and reused by all later calls in the process, including those on
+    unpickled copies of the factory. This way, dask workers load models once instead of receiving them with every task, and
+    extractors that can't be pickled can be used on workers as well. Arguments may be factories themselves, for the components of
+    an extractor, which are built along with it.
+
+    The built extractor is kept until release is called, which executors do when they're closed.
+
+    cls(Callable[..., T]): the extractor class (or any other callable building it).
+    """
+
+    # built extractors of this process, by factory key
+    _instances: dict[str, Any] = {}
+    # reentrant, as factories among the arguments are built while holding it
+    _lock = threading.RLock()
+
+    def __init__(self, cls: Callable[..., T], *args: Any, **kwargs: Any) -> None:
+        # read-only, so that a factory of a subclass is a factory of its base class as well
+        self.cls: Final = cls
+        self.args = args
+        self.kwargs = kwargs
+        # identifies the factory and its copies
+        self.key = uuid.uuid4().hex
+
+    def build(self) -> T:
+        """Build a new extractor, building factories among the arguments as well."""
+        args = [arg.get() if isinstance(arg, ExtractorFactory) else arg for arg in self.args]
+        kwargs = {name: arg.get() if isinstance(arg, ExtractorFactory) else arg for name, arg in self.kwargs.items()}
+        return self.cls(*args, **kwargs)
+
+    def get(self) -> T:
+        """The extractor of this process, built on first use."""
+        with self._lock:
+            if self.key not in self._instances:
+                self._instances[self.key] = self.build()
+            return self._instances[self.key]
+
+    def release(self) -> None:
+        """Drop the extractor of this process, and those of factories among the arguments, so that their models can be freed."""
+        with self._lock:
+            self._instances.pop(self.key, None)
+        for arg in [*self.args, *self.kwargs.values()]:
+            if isinstance(arg, ExtractorFactory):
+                arg.release()
+
+
+def resolve[T](extractor: T | ExtractorFactory[T]) -> T:
+    """The extractor itself, or that of a factory."""
+    return extractor.get() if isinstance(extractor, ExtractorFactory) else extractor
@@ -0,0 +1,190 @@
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, TypeVar
+
+from folioforge.extraction.protocol import Extractor
+from folioforge.models.document import DocumentEntry
+from folioforge.output.protocol import OutputGenerator
+from folioforge.pipeline.batching import MicroBatcher, extract_unique
+from folioforge.pipeline.cache import ExtractionCache
+from folioforge.pipeline.dedup import PageDeduplicator
+from folioforge.pipeline.factory import ExtractorFactory, resolve
+from folioforge.pipeline.simple import SimplePipelineExecutor
+from folioforge.postprocessor.protocol import Postprocessor
+from folioforge.preprocessor.protocol import Preprocessor
+from folioforge.preprocessor.store import PageStore
+
+# what a worker process needs to extract pages, set up by _init_worker
+_worker: dict[str, Any] = {}
+
+
+def _init_worker(extractor: Extractor | ExtractorFactory[Extractor], cache: ExtractionCache | None, dedup_max_distance: int | None) -> None:
+    # with fork, an extractor built before the workers were started is inherited instead of built again
+    _worker["extractor"] = resolve(extractor)
+    _worker["cache"] = cache
+    _worker["dedup"] = PageDeduplicator[DocumentEntry](dedup_max_distance) if dedup_max_distance is not None else None
+
+
+def _extract(entries: list[DocumentEntry]) -> tuple[list[DocumentEntry], float]:
+    """Extract a batch of pages in a worker, returning the results and how long it took."""
+    started = time.monotonic()
+    results = extract_unique(_worker["extractor"], entries, _worker["cache"], _worker["dedup"])
+    for entry in results:
+        # don't ship page buffers back
+        entry.image = None
+    return results, time.monotonic() - started
+
+
+def supports_fork(extractor: Extractor | ExtractorFactory[Extractor]) -> bool:
+    """Whether the extractor can be built before forking workers, without building it to find out."""
+    if isinstance(extractor, ExtractorFactory):
+        return getattr(extractor.cls, "supports_fork", False)
+    return extractor.supports_fork
+
+
+T = TypeVar("T")
+
+
+class ProcessPipelineExecutor[T](SimplePipelineExecutor[T]):
+    """Runs the pipeline in the current process, extracting pages in a pool of worker processes.
+
+    Documents are preprocessed here, as with SimplePipelineExecutor, and their pages are sent to the workers in batches, each
+    worker having its own extractor. The pool is started on the first execute and reused by later ones, use the executor as a
+    context manager, or close it, to shut it down again.
+
+    With preload, extractors that support it (see Extractor.supports_fork) are built here before the workers are forked, so that
+    they share its model weights copy-on-write instead of each loading them. This needs the fork start method (i.e. not on
+    Windows) and the pool to be started before any threads are, as forking a multi-threaded process may deadlock. Otherwise,
+    workers are spawned and each builds its own extractor, from a factory (see ExtractorFactory) or by unpickling it.
+
+    workers(int): worker processes extracting pages.
+    preload(bool): build the extractor before forking the workers, where both fork and the extractor support it.
+    page_window(int): how many pages are extracted together, 2 * workers batches are in flight at a time.
+    batcher(MicroBatcher | None): group pages of all documents into batches with this instead of into page_window sized ones.
+    cache(ExtractionCache | None): reuse extraction results of pages seen in earlier runs.
+    store(PageStore | None): page store to release pages to once they're extracted.
+    dedup_max_distance(int | None): if set, pages that look the same as an earlier page extracted by the same worker (see
+        PageDeduplicator) aren't extracted again but get a copy of its result.
+    """
+
+    def __init__(
+        self,
+        preprocessors: list[Preprocessor],
+        extractor: Extractor | ExtractorFactory[Extractor],
+        format: OutputGenerator[T],
+        postprocessors: list[Postprocessor] | None,
+        outdir: Path,
+        workers: int | None = None,
+        preload: bool = True,
+        page_window: int = 1,
+        cache: ExtractionCache | None = None,
+        store: PageStore | None = None,
+        dedup_max_distance: int | None = None,
+        batcher: MicroBatcher | None = None,
+    ) -> None:
+        # unlike the simple executor, the extractor is only built when the workers are started
+        self.preprocessors = preprocessors
+        self.extractor = extractor
+        self.format = format
+        self.outdir = outdir
+        self.postprocessors = postprocessors
+        self.workers = workers or os.cpu_count() or 1
+        self.preload = preload and supports_fork(extractor) and "fork" in multiprocessing.get_all_start_methods()
+        self.page_window = page_window
+        self.cache = cache
+        self.store = store
+        self.dedup_max_distance = dedup_max_distance
+        self.batcher = batcher
+        self._pool: ProcessPoolExecutor | None = None
+
+        if not self.preload and not isinstance(self.extractor, ExtractorFactory) and not self.extractor.supports_pickle:
+            raise NotImplementedError(
+                f"The extractor {self.extractor} does not support pickling, it can only be used in spawned workers through an "
+                "ExtractorFactory"
+            )
+
+    @classmethod
+    def setup(
+        cls,
+        preprocessors: list[Preprocessor],
+        extractor: Extractor | ExtractorFactory[Extractor],
+        format: OutputGenerator[T],
+        postprocessors: list[Postprocessor] | None = None,
+        outdir: Path | None = None,
+        page_window: int = 1,
+        cache: ExtractionCache | None = None,
+        store: PageStore | None = None,
+        dedup_max_distance: int | None = None,
+        batcher: MicroBatcher | None = None,
+        workers: int | None = None,
+        preload: bool = True,
+    ) -> "ProcessPipelineExecutor":
+        if outdir is None:
+            outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
+        return ProcessPipelineExecutor(
+            preprocessors,
+            extractor,
+            format,
+            postprocessors,
+            outdir,
+            workers=workers,
+            preload=preload,
+            page_window=page_window,
+            cache=cache,
+            store=store,
+            dedup_max_distance=dedup_max_distance,
+            batcher=batcher,
+        )
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            if self.preload:
+                resolve(self.extractor)
+            # with fork, all workers are started on the first submit, before the threads of the pool
+            context = multiprocessing.get_context("fork" if self.preload else "spawn")
+            self._pool = ProcessPoolExecutor(
+                self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(self.extractor, self.cache, self.dedup_max_distance),
+            )
+            if self.preload:
+                # fork the workers now, before threads are started, e.g. by a batcher reading ahead
+                self._pool.submit(int).result()
+        return self._pool
+
+    def close(self) -> None:
+        """Shut down the worker processes, and release the extractor if it was built here from a factory for them."""
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+        if isinstance(self.extractor, ExtractorFactory):
+            self.extractor.release()
+
+    def _extract_pages(
+        self, pages: Iterator[tuple[int, DocumentEntry]]
+    ) -> Iterator[tuple[list[tuple[int, DocumentEntry]], list[DocumentEntry]]]:
+        batcher = self.batcher or MicroBatcher(max_size=self.page_window, max_wait=None, adaptive=False)
+        pending: deque[tuple[list[tuple[int, DocumentEntry]], Future[tuple[list[DocumentEntry], float]]]] = deque()
+
+        def oldest() -> tuple[list[tuple[int, DocumentEntry]], list[DocumentEntry]]:
+            batch, future = pending.popleft()
+            results, seconds = future.result()
+            batcher.record(len(batch), seconds)
+            return batch, results
+
+        pool = self.pool
+        for batch in batcher.batches(pages):
+            pending.append((batch, pool.submit(_extract, [entry for _, entry in batch])))
+            # keep the workers busy while the oldest batch is waited for
+            if len(pending) >= 2 * self.workers:
+                yield oldest()
+        while pending:
+            yield oldest()
@@ -1,9 +1,11 @@
+from collections.abc import Generator, Iterable
 from pathlib import Path
-from typing import Protocol, TypeVar
+from typing import Protocol, Self, TypeVar
 
 from folioforge.extraction.protocol import Extractor
 from folioforge.models.document import DocumentReference
 from folioforge.output.protocol import OutputGenerator
+from folioforge.pipeline.factory import ExtractorFactory
 from folioforge.postprocessor.protocol import Postprocessor
 from folioforge.preprocessor.protocol import Preprocessor
 
@@ -16,9 +18,41 @@ class PipelineExecutor[P](Protocol):
     def setup(
         cls: type[T],
         preprocessors: list[Preprocessor],
-        extractors: list[Extractor],
+        extractor: Extractor | ExtractorFactory[Extractor],
         format: OutputGenerator[P],
         postprocessors: list[Postprocessor] | None = None,
         outdir: Path | None = None,
     ) -> T: ...
     def execute(self, paths: list[Path]) -> list[tuple[DocumentReference, P]]: ...
+
+    def execute_iter(self, paths: list[Path], ordered: bool = True) -> Generator[tuple[DocumentReference, P]]:
+        """Execute the pipeline, yielding each document as soon as it's finished.
+
+        Documents are yielded in the order of paths, or in the order they finish if ordered is False.
+        """
+        yield from self.execute(paths)
+
+    def close(self) -> None:
+        """Release what the executor keeps between execute calls, e.g. a cluster."""
+        return None
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def needs_images(postprocessors: list[Postprocessor] | None) -> bool:
+    """Whether page images need to be kept after extraction for the postprocessors."""
+    return any(postprocessor.needs_images for postprocessor in postprocessors or [])
+
+
+def finish_documents[R](
+    documents: Iterable[DocumentReference], postprocessors: list[Postprocessor] | None, format: OutputGenerator[R], outdir: Path
+) -> Generator[tuple[DocumentReference, R]]:
+    """Postprocess and convert documents one at a time, as they come in."""
+    for postprocessor in postprocessors or []:
+        documents = postprocessor.process(documents, outdir)
+    for document in documents:
+        yield from format.convert([document])
@@ -1,55 +1,155 @@
 import tempfile
-from functools import partial
+from collections.abc import Generator, Iterator
 from pathlib import Path
 from typing import TypeVar
 
 from folioforge.extraction.protocol import Extractor
-from folioforge.models.document import DocumentReference
+from folioforge.models.document import DocumentEntry, DocumentReference
 from folioforge.output.protocol import OutputGenerator
-from folioforge.pipeline.protocol import PipelineExecutor
+from folioforge.pipeline.batching import MicroBatcher, extract_unique
+from folioforge.pipeline.cache import ExtractionCache
+from folioforge.pipeline.dedup import PageDeduplicator
+from folioforge.pipeline.factory import ExtractorFactory, resolve
+from folioforge.pipeline.protocol import PipelineExecutor, finish_documents, needs_images
 from folioforge.postprocessor.protocol import Postprocessor
 from folioforge.preprocessor.protocol import Preprocessor
+from folioforge.preprocessor.store import PageStore
 
 T = TypeVar("T")
 
 
 class SimplePipelineExecutor[T](PipelineExecutor):
+    """Runs the pipeline in the current process.
+
+    page_window(int): how many pages are extracted together, and so how many pages of lazy documents are rendered ahead.
+    batcher(MicroBatcher | None): group pages of all documents into batches with this instead of into page_window sized ones.
+    cache(ExtractionCache | None): reuse extraction results of pages seen in earlier runs.
+    store(PageStore | None): page store to release pages to once they're extracted.
+    dedup_max_distance(int | None): if set, pages that look the same as an earlier page of the batch (see PageDeduplicator) aren't
+        extracted again but get a copy of its result.
+    """
+
     def __init__(
         self,
         preprocessors: list[Preprocessor],
-        extractor: Extractor,
+        extractor: Extractor | ExtractorFactory[Extractor],
         format: OutputGenerator[T],
         postprocessors: list[Postprocessor] | None,
         outdir: Path,
+        page_window: int = 1,
+        cache: ExtractionCache | None = None,
+        store: PageStore | None = None,
+        dedup_max_distance: int | None = None,
+        batcher: MicroBatcher | None = None,
     ) -> None:
         self.preprocessors = preprocessors
-        self.extractor = extractor
+        self.extractor = resolve(extractor)
+        # released on close
+        self.factory = extractor if isinstance(extractor, ExtractorFactory) else None
         self.format = format
         self.outdir = outdir
         self.postprocessors = postprocessors
+        self.page_window = page_window
+        self.cache = cache
+        self.store = store
+        self.dedup_max_distance = dedup_max_distance
+        self.batcher = batcher
 
     @classmethod
     def setup(
         cls,
         preprocessors: list[Preprocessor],
-        extractor: Extractor,
+        extractor: Extractor | ExtractorFactory[Extractor],
         format: OutputGenerator[T],
         postprocessors: list[Postprocessor] | None = None,
         outdir: Path | None = None,
+        page_window: int = 1,
+        cache: ExtractionCache | None = None,
+        store: PageStore | None = None,
+        dedup_max_distance: int | None = None,
+        batcher: MicroBatcher | None = None,
     ) -> "SimplePipelineExecutor":
         if outdir is None:
             outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
-        return SimplePipelineExecutor(preprocessors, extractor, format, postprocessors, outdir)
+        return SimplePipelineExecutor(
+            preprocessors,
+            extractor,
+            format,
+            postprocessors,
+            outdir,
+            page_window=page_window,
+            cache=cache,
+            store=store,
+            dedup_max_distance=dedup_max_distance,
+            batcher=batcher,
+        )
+
+    def close(self) -> None:
+        """Release the extractor if it was built from a factory."""
+        if self.factory is not None:
+            self.factory.release()
 
     def execute(self, paths: list[Path]) -> list[tuple[DocumentReference, T]]:
-        references = [DocumentReference(path=path, items=[], converted=None) for path in paths]
-
-        for processor in self.preprocessors:
-            references = list(filter(None, map(partial(processor.process, outdir=self.outdir), references)))
-        for ref in references:
-            ref.items = list(map(self.extractor.extract, ref.items))
-            ref.converted = "\n\n".join(i.converted or "" for i in ref.items)
-        if self.postprocessors:
-            for postprocessor in self.postprocessors:
-                references = list(postprocessor.process(references, self.outdir))
-        return self.format.convert(references)
+        return list(self.execute_iter(paths))
+
+    def execute_iter(self, paths: list[Path], ordered: bool = True) -> Generator[tuple[DocumentReference, T]]:
+        """Execute the pipeline, yielding documents as soon as they're finished, which is always in the order of paths."""
+        return finish_documents(self._extract_documents(paths), self.postprocessors, self.format, self.outdir)
+
+    def _preprocess(self, paths: list[Path]) -> Iterator[DocumentReference]:
+        for path in paths:
+            reference: DocumentReference | None = DocumentReference(path=path, items=[], converted=None)
+            for processor in self.preprocessors:
+                if reference is None:
+                    break
+                reference = processor.process(reference, self.outdir)
+            if reference is not None:
+                yield reference
+
+    def _extract_pages(
+        self, pages: Iterator[tuple[int, DocumentEntry]]
+    ) -> Iterator[tuple[list[tuple[int, DocumentEntry]], list[DocumentEntry]]]:
+        """Extract pages (with the index of their document) in batches, yielding each batch with its results."""
+        dedup = PageDeduplicator[DocumentEntry](self.dedup_max_distance) if self.dedup_max_distance is not None else None
+        batcher = self.batcher or MicroBatcher(max_size=self.page_window, max_wait=None, adaptive=False)
+        return batcher.process(pages, lambda batch: extract_unique(self.extractor, [e for _, e in batch], self.cache, dedup))
+
+    def _extract_documents(self, paths: list[Path]) -> Iterator[DocumentReference]:
+        # documents are only preprocessed once their pages are needed, and pages of lazy documents are only rendered when
+        # iterated, so at most a batch of page images is held at a time
+        references: list[DocumentReference] = []
+        items: list[list[DocumentEntry]] = []
+        # pages produced per document, for the documents whose pages have all been produced
+        produced: dict[int, int] = {}
+
+        def pages() -> Iterator[tuple[int, DocumentEntry]]:
+            for i, reference in enumerate(self._preprocess(paths)):
+                references.append(reference)
+                items.append([])
+                count = 0
+                for entry in reference.iter_items():
+                    count += 1
+                    yield i, entry
+                produced[i] = count
+
+        finished = 0
+
+        def finish() -> Iterator[DocumentReference]:
+            nonlocal finished
+            while finished in produced and len(items[finished]) == produced[finished]:
+                reference = references[finished]
+                reference.items = items[finished]
+                reference.converted = "\n\n".join(i.converted or "" for i in reference.items)
+                finished += 1
+                yield reference
+
+        keep_images = needs_images(self.postprocessors)
+        for batch, extracted in self._extract_pages(pages()):
+            for (i, page), entry in zip(batch, extracted, strict=True):
+                # results from the cache or worker processes come without the image, the page still has it
+                entry.image = page.image if keep_images else None
+                if self.store is not None:
+                    self.store.release(entry)
+                items[i].append(entry)
+            yield from finish()
+        yield from finish()
@@ -0,0 +1,343 @@
+import copy
+import multiprocessing
+import queue
+import tempfile
+import threading
+from collections import deque
+from collections.abc import Callable, Generator, Iterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Any, TypeVar
+
+from folioforge.extraction.protocol import Extractor
+from folioforge.models.document import DocumentEntry, DocumentReference
+from folioforge.output.protocol import OutputGenerator
+from folioforge.pipeline.batching import MicroBatcher, extract_unique
+from folioforge.pipeline.cache import ExtractionCache
+from folioforge.pipeline.dedup import PageDeduplicator
+from folioforge.pipeline.factory import ExtractorFactory, resolve
+from folioforge.pipeline.protocol import PipelineExecutor, finish_documents, needs_images
+from folioforge.postprocessor.protocol import Postprocessor
+from folioforge.preprocessor.protocol import Preprocessor, ShardingPreprocessor
+from folioforge.preprocessor.store import PageStore
+
+# index of the document in the paths to execute and of the page in the document
+type PageKey = tuple[int, int]
+
+# marks the end of a queue, once for each consumer
+_END = object()
+
+
+class _Stopped(Exception):
+    """Raised in a stage when another one failed."""
+
+
+class _Counted:
+    """Tells the collector how many pages a shard of a document has, once all of them are queued."""
+
+    def __init__(self, document: int, pages: int, dropped: bool) -> None:
+        self.document = document
+        self.pages = pages
+        self.dropped = dropped
+
+
+def _preprocess(preprocessors: list[Preprocessor], outdir: Path, document: DocumentReference) -> DocumentReference | None:
+    for processor in preprocessors:
+        result = processor.process(document, outdir)
+        if result is None:
+            return None
+        document = result
+    # pages of lazy documents are rendered here, by the worker, and have to be for them to be sent back from a process
+    document.items = list(document.iter_items())
+    return document
+
+
+class _Stages:
+    """The threads of the stages of an execution, all stages stop when one of them fails."""
+
+    def __init__(self) -> None:
+        self.failed = threading.Event()
+        self.error: BaseException | None = None
+        self.threads: list[threading.Thread] = []
+
+    def start(self, fn: Callable[..., None], *args: Any) -> threading.Thread:
+        thread = threading.Thread(target=self._run, args=(fn, *args), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return thread
+
+    def _run(self, fn: Callable[..., None], *args: Any) -> None:
+        try:
+            fn(*args)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            if self.error is None:
+                self.error = e
+            self.failed.set()
+
+    def put(self, q: queue.Queue, item: Any) -> None:
+        """Put an item in a queue, waiting while it's full."""
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped()
+
+    def get(self, q: queue.Queue) -> Any:
+        while not self.failed.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        raise _Stopped()
+
+    def iterate(self, q: queue.Queue) -> Iterator[Any]:
+        """Iterate over a queue until its end."""
+        while (item := self.get(q)) is not _END:
+            yield item
+
+    def end_after(self, threads: list[threading.Thread], q: queue.Queue) -> None:
+        """End a queue once the threads producing its items are done."""
+        for thread in threads:
+            thread.join()
+        self.put(q, _END)
+
+    def stop(self) -> None:
+        """Stop all stages, e.g. when results aren't wanted anymore."""
+        self.failed.set()
+
+    def join(self) -> None:
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+T = TypeVar("T")
+
+
+class StagedPipelineExecutor[T](PipelineExecutor):
+    """Runs the pipeline in the current process as concurrent stages joined by bounded queues.
+
+    Documents are preprocessed (e.g. rendered) by a pool of workers, pages are extracted by one or more threads as they come in and
+    finished documents are postprocessed and converted by another pool of threads. So rendering, writing pages, model inference and
+    output overlap instead of running one after the other. As queues are bounded, stages that get ahead of the next one wait instead
+    of piling up pages in memory. Each shard of a document is preprocessed as a whole by one worker, so documents are split into
+    shards of shard_size pages (if the first preprocessor is a ShardingPreprocessor that doesn't have a size of its own) to keep
+    the pages in flight bounded by 2 * preprocess_workers * shard_size, whatever the size of the documents.
+
+    preprocess_workers(int): documents (or shards) preprocessed at the same time.
+    processes(bool): preprocess in worker processes, for CPU bound preprocessing, instead of threads. Preprocessors have to support
+        pickling then. pdfium isn't thread safe: in threads, the pdfium calls of the preprocessors and of PdfTextLayerExtractor are
+        serialized (see PDFIUM_LOCK), but docling and marker call pdfium on their own, so use processes with them.
+    shard_size(int | None): pages per shard of documents whose preprocessor doesn't set a size, None to preprocess them whole.
+    extract_workers(int): threads extracting batches of pages, sharing the extractor (see ExtractorFactory to build it).
+    postprocess_workers(int): threads postprocessing and converting finished documents.
+    queue_size(int): how many pages (and documents) a stage may get ahead of the next one.
+    batcher(MicroBatcher | None): group pages into batches for extraction with this, each extraction thread gets a copy.
+    cache(ExtractionCache | None): reuse extraction results of pages seen in earlier runs.
+    store(PageStore | None): page store to release pages to once they're extracted.
+    dedup_max_distance(int | None): if set, pages that look the same as an earlier page extracted by the same thread (see
+        PageDeduplicator) aren't extracted again but get a copy of its result.
+    """
+
+    def __init__(
+        self,
+        preprocessors: list[Preprocessor],
+        extractor: Extractor | ExtractorFactory[Extractor],
+        format: OutputGenerator[T],
+        postprocessors: list[Postprocessor] | None,
+        outdir: Path,
+        preprocess_workers: int = 4,
+        processes: bool = True,
+        shard_size: int | None = 8,
+        extract_workers: int = 1,
+        postprocess_workers: int = 2,
+        queue_size: int = 16,
+        batcher: MicroBatcher | None = None,
+        cache: ExtractionCache | None = None,
+        store: PageStore | None = None,
+        dedup_max_distance: int | None = None,
+    ) -> None:
+        self.preprocessors = preprocessors
+        self.extractor = resolve(extractor)
+        # released on close
+        self.factory = extractor if isinstance(extractor, ExtractorFactory) else None
+        self.format = format
+        self.postprocessors = postprocessors
+        self.outdir = outdir
+        self.preprocess_workers = preprocess_workers
+        self.processes = processes
+        self.shard_size = shard_size
+        self.extract_workers = extract_workers
+        self.postprocess_workers = postprocess_workers
+        self.queue_size = queue_size
+        self.batcher = batcher
+        self.cache = cache
+        self.store = store
+        self.dedup_max_distance = dedup_max_distance
+
+    @classmethod
+    def setup(
+        cls,
+        preprocessors: list[Preprocessor],
+        extractor: Extractor | ExtractorFactory[Extractor],
+        format: OutputGenerator[T],
+        postprocessors: list[Postprocessor] | None = None,
+        outdir: Path | None = None,
+        preprocess_workers: int = 4,
+        processes: bool = True,
+        shard_size: int | None = 8,
+        extract_workers: int = 1,
+        postprocess_workers: int = 2,
+        queue_size: int = 16,
+        batcher: MicroBatcher | None = None,
+        cache: ExtractionCache | None = None,
+        store: PageStore | None = None,
+        dedup_max_distance: int | None = None,
+    ) -> "StagedPipelineExecutor":
+        if outdir is None:
+            outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
+        return StagedPipelineExecutor(
+            preprocessors,
+            extractor,
+            format,
+            postprocessors,
+            outdir,
+            preprocess_workers=preprocess_workers,
+            processes=processes,
+            shard_size=shard_size,
+            extract_workers=extract_workers,
+            postprocess_workers=postprocess_workers,
+            queue_size=queue_size,
+            batcher=batcher,
+            cache=cache,
+            store=store,
+            dedup_max_distance=dedup_max_distance,
+        )
+
+    def close(self) -> None:
+        """Release the extractor if it was built from a factory."""
+        if self.factory is not None:
+            self.factory.release()
+
+    def execute(self, paths: list[Path]) -> list[tuple[DocumentReference, T]]:
+        return list(self.execute_iter(paths))
+
+    def execute_iter(self, paths: list[Path], ordered: bool = True) -> Generator[tuple[DocumentReference, T]]:
+        documents = [(i, DocumentReference(path=path, items=[], converted=None)) for i, path in enumerate(paths)]
+        if self.preprocessors and isinstance(self.preprocessors[0], ShardingPreprocessor):
+            # shards are preprocessed independently, so that several workers can take part in a large document
+            sharding = self.preprocessors[0]
+            documents = [(i, shard) for i, document in documents for shard in sharding.shard(document, self.shard_size)]
+
+        pages: queue.Queue[tuple[PageKey, DocumentEntry] | object] = queue.Queue(self.queue_size)
+        extracted: queue.Queue[tuple[PageKey, DocumentEntry] | _Counted | object] = queue.Queue(self.queue_size)
+        finished: queue.Queue[tuple[int, DocumentReference] | object] = queue.Queue(self.queue_size)
+        done: queue.Queue[tuple[int, list[tuple[DocumentReference, T]]] | object] = queue.Queue(self.queue_size)
+
+        stages = _Stages()
+        stages.start(self._preprocess_stage, stages, documents, pages, extracted)
+        extractors = [stages.start(self._extract_stage, stages, pages, extracted) for _ in range(self.extract_workers)]
+        stages.start(stages.end_after, extractors, extracted)
+        stages.start(self._collect_stage, stages, paths, [i for i, _ in documents], extracted, finished)
+        outputs = [stages.start(self._output_stage, stages, finished, done) for _ in range(self.postprocess_workers)]
+        stages.start(stages.end_after, outputs, done)
+
+        # results of documents finished ahead of an earlier one, when ordered
+        pending: dict[int, list[tuple[DocumentReference, T]]] = {}
+        next_index = 0
+        try:
+            for index, results in stages.iterate(done):
+                if not ordered:
+                    yield from results
+                    continue
+                pending[index] = results
+                while next_index in pending:
+                    yield from pending.pop(next_index)
+                    next_index += 1
+        finally:
+            # stops what's left of the stages if iteration ended early, and reports the failure of one of them
+            stages.stop()
+            stages.join()
+
+    def _pool(self) -> Executor:
+        if self.processes:
+            # workers are started while the other stages' threads run, which doesn't go well with forking
+            return ProcessPoolExecutor(self.preprocess_workers, mp_context=multiprocessing.get_context("spawn"))
+        return ThreadPoolExecutor(self.preprocess_workers)
+
+    def _preprocess_stage(
+        self, stages: _Stages, documents: list[tuple[int, DocumentReference]], pages: queue.Queue, extracted: queue.Queue
+    ) -> None:
+        with self._pool() as pool:
+            pending: deque[tuple[int, Future[DocumentReference | None]]] = deque()
+
+            def queue_pages() -> None:
+                index, future = pending.popleft()
+                document = future.result()
+                for i, entry in enumerate(document.items if document is not None else []):
+                    # shards of a document have the page numbers of the whole document
+                    stages.put(pages, ((index, i if entry.page is None else entry.page), entry))
+                count = len(document.items) if document is not None else 0
+                stages.put(extracted, _Counted(index, count, document is None))
+
+            for index, document in documents:
+                pending.append((index, pool.submit(_preprocess, self.preprocessors, self.outdir, document)))
+                # keep the workers busy while the pages of the oldest document are queued
+                if len(pending) >= 2 * self.preprocess_workers:
+                    queue_pages()
+            while pending:
+                queue_pages()
+        for _ in range(self.extract_workers):
+            stages.put(pages, _END)
+
+    def _extract_stage(self, stages: _Stages, pages: queue.Queue, extracted: queue.Queue) -> None:
+        batcher = copy.deepcopy(self.batcher) if self.batcher is not None else MicroBatcher(max_size=1, max_wait=None, adaptive=False)
+        dedup = PageDeduplicator[DocumentEntry](self.dedup_max_distance) if self.dedup_max_distance is not None else None
+        keep_images = needs_images(self.postprocessors)
+        for batch, results in batcher.process(stages.iterate(pages), partial(self._extract_batch, dedup)):
+            for (key, page), entry in zip(batch, results, strict=True):
+                # results from the cache come without the image, the page still has it
+                entry.image = page.image if keep_images else None
+                if self.store is not None:
+                    self.store.release(entry)
+                stages.put(extracted, (key, entry))
+
+    def _extract_batch(
+        self, dedup: PageDeduplicator[DocumentEntry] | None, batch: list[tuple[PageKey, DocumentEntry]]
+    ) -> list[DocumentEntry]:
+        return extract_unique(self.extractor, [entry for _, entry in batch], self.cache, dedup)
+
+    def _collect_stage(self, stages: _Stages, paths: list[Path], shards: list[int], extracted: queue.Queue, finished: queue.Queue) -> None:
+        """Put pages back together into documents, passing each on as soon as all of its pages are extracted."""
+        shards_left = [shards.count(i) for i in range(len(paths))]
+        expected = [0] * len(paths)
+        dropped = [False] * len(paths)
+        entries: list[list[tuple[PageKey, DocumentEntry]]] = [[] for _ in paths]
+
+        for item in stages.iterate(extracted):
+            if isinstance(item, _Counted):
+                index = item.document
+                shards_left[index] -= 1
+                expected[index] += item.pages
+                dropped[index] |= item.dropped
+            else:
+                index = item[0][0]
+                entries[index].append(item)
+            if shards_left[index] == 0 and len(entries[index]) == expected[index]:
+                items = [entry for _, entry in sorted(entries[index], key=lambda e: e[0])]
+                document = DocumentReference(path=paths[index], items=items, converted="\n\n".join(i.converted or "" for i in items))
+                # dropped documents are passed on as well, for ordered results not to wait for them
+                stages.put(finished, (index, None if dropped[index] else document))
+        for _ in range(self.postprocess_workers):
+            stages.put(finished, _END)
+
+    def _output_stage(self, stages: _Stages, finished: queue.Queue, done: queue.Queue) -> None:
+        for index, document in stages.iterate(finished):
+            results = list(finish_documents([document], self.postprocessors, self.format, self.outdir)) if document is not None else []
+            stages.put(done, (index, results))
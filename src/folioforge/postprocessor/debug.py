@@ -1,3 +1,4 @@
+import logging
 from collections.abc import Iterable
 from pathlib import Path
 
@@ -37,11 +38,19 @@ def _label_to_color(label: Label) -> tuple[int, int, int]:
 class DebugPostprocessor(Postprocessor):
     """Saves debug images with annotations."""
 
+    needs_images = True
+
     def process(self, documents: Iterable[DocumentReference], outdir: Path) -> Iterable[DocumentReference]:
         for document in documents:
             (outdir / document.path.stem / "debug").mkdir(parents=True, exist_ok=True)
             for item in document.items:
-                img = cv2.imread(str(item.path))
+                if item.image is None and not item.path.exists():
+                    logging.warning(f"Page image for {item.path.name} isn't available anymore, skipping debug output")
+                    continue
+                img = item.load_image()
+                if img is item.image or not img.flags.writeable:
+                    # don't draw onto the page buffer or a memory mapped page itself
+                    img = img.copy()
                 for area in item.layout:
                     color = _label_to_color(area.label)
                     img = cv2.rectangle(
@@ -84,5 +93,5 @@ class DebugPostprocessor(Postprocessor):
                                 thickness=1,
                             )
 
-                cv2.imwrite(str(outdir / document.path.stem / "debug" / item.path.name), img)
+                cv2.imwrite(str(outdir / document.path.stem / "debug" / item.path.with_suffix(".png").name), img)
             yield document
@@ -6,4 +6,8 @@ from folioforge.models.document import DocumentReference
 
 
 class Postprocessor(Protocol):
+    # whether the postprocessor reads the page images, so that executors keep them in memory after extraction instead of
+    # releasing them, as the page files may not exist (with in-memory pages) or have been evicted
+    needs_images: bool = False
+
     def process(self, documents: Iterable[DocumentReference], outdir: Path) -> Iterable[DocumentReference]: ...
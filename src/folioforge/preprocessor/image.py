@@ -1,63 +1,131 @@
 from pathlib import Path
+from typing import Protocol
 
 import cv2
 import numpy as np
 
-from folioforge.models.document import DocumentReference
+from folioforge.models.document import DocumentEntry, DocumentReference
 from folioforge.preprocessor.protocol import Preprocessor
 
 
-class AutoBrightness(Preprocessor):
+def _histogram(img: np.ndarray) -> np.ndarray:
+    flat = np.ascontiguousarray(img).reshape(img.shape[0], -1)
+    return cv2.calcHist([flat], [0], None, [256], [0, 256]).ravel()
+
+
+def _ink_density(histogram: np.ndarray, contrast: int) -> float:
+    # the median is the paper colour on all but the most crowded pages, ink is whatever differs from it by at least contrast,
+    # so this works for gray recycled paper and white on black alike
+    total = histogram.sum()
+    if total == 0:
+        return 0.0
+    cumulative = np.cumsum(histogram)
+    median = int(np.searchsorted(cumulative, total / 2))
+    levels = np.arange(256)
+    return float(histogram[np.abs(levels - median) >= contrast].sum() / total)
+
+
+def ink_density(img: np.ndarray, contrast: int = 64) -> float:
+    """Fraction of pixels that differ from the background by at least contrast, i.e. how much of an image is covered in ink."""
+    if img.size == 0:
+        return 0.0
+    return _ink_density(_histogram(img), contrast)
+
+
+class PageImage:
+    """A decoded page image together with statistics that are computed at most once and shared between transforms."""
+
+    def __init__(self, img: np.ndarray) -> None:
+        self.img = img
+        # histogram over all channels, used for brightness
+        self.histogram: np.ndarray | None = None
+        self.modified = False
+        # set if the page should not be extracted, with the reason
+        self.skipped: str | None = None
+
+    def update(self, img: np.ndarray, histogram: np.ndarray | None = None) -> None:
+        """Replace the image, the histogram can be passed if it can be derived without looking at the new image."""
+        self.img = img
+        self.histogram = histogram
+        self.modified = True
+
+    def brightness(self) -> float:
+        if self.histogram is None:
+            self.histogram = _histogram(self.img)
+        cols, rows = self.img.shape[:2]
+        return float(self.histogram @ np.arange(256)) / (255 * cols * rows)
+
+    def ink_density(self, contrast: int = 64) -> float:
+        if self.histogram is None:
+            self.histogram = _histogram(self.img)
+        return _ink_density(self.histogram, contrast)
+
+
+class ImageTransform(Preprocessor, Protocol):
+    """A preprocessor that transforms every page image on its own, so it can be fused with others in an ImageChain."""
+
+    # whether the transform works on grayscale images
+    grayscale: bool = False
+
+    def apply(self, page: PageImage) -> None: ...
+
+    def process(self, document: DocumentReference, outdir: Path) -> DocumentReference | None:
+        document.map_items(self.process_entry)
+        return document
+
+    def process_entry(self, entry: DocumentEntry) -> DocumentEntry:
+        page = PageImage(entry.load_image(grayscale=self.grayscale))
+        self.apply(page)
+        if page.modified:
+            entry.update_image(page.img)
+        if page.skipped is not None:
+            entry.skipped = page.skipped
+        return entry
+
+
+class AutoBrightness(ImageTransform):
     """Automatically adjust brightness for images with total brighness below min_brightness."""
 
     def __init__(self, min_brightness: float = 0.66) -> None:
         self.min_brightness = min_brightness
 
-    def process(self, document: DocumentReference, outdir: Path) -> DocumentReference | None:
-        for entry in document.items:
-            img = cv2.imread(str(entry.path))
-            assert img is not None
-            cols, rows = img.shape[:2]
-            brightness = np.sum(img) / (255 * cols * rows)
-            ratio = brightness / self.min_brightness
-            if ratio >= 1:
-                continue
-            img = cv2.convertScaleAbs(img, alpha=1 / ratio, beta=0)
-            cv2.imwrite(str(entry.path), img)
-        return document
+    def apply(self, page: PageImage) -> None:
+        ratio = page.brightness() / self.min_brightness
+        if ratio >= 1:
+            return
+        img = cv2.convertScaleAbs(page.img, alpha=1 / ratio, beta=0)
+        # convertScaleAbs is a per-value mapping, so the new histogram follows from the old one
+        lut = np.clip(np.rint(np.arange(256) / ratio), 0, 255).astype(np.intp)
+        page.update(img, histogram=np.bincount(lut, weights=page.histogram, minlength=256))
 
 
-class Grayscale(Preprocessor):
+class Grayscale(ImageTransform):
     """Turn image into grayscale."""
 
-    def process(self, document: DocumentReference, outdir: Path) -> DocumentReference | None:
-        for entry in document.items:
-            img = cv2.imread(str(entry.path))
-            assert img is not None
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            cv2.imwrite(str(entry.path), img)
-        return document
+    grayscale = True
 
+    def apply(self, page: PageImage) -> None:
+        page.update(page.img if page.img.ndim == 2 else cv2.cvtColor(page.img, cv2.COLOR_BGR2GRAY))
 
-class Threshold(Preprocessor):
+
+class Threshold(ImageTransform):
     """Turn image into black and white using Otsu binarization or with a fixed threshold."""
 
+    grayscale = True
+
     def __init__(self, threshold: int | None = 128) -> None:
         self.threshold = threshold
 
-    def process(self, document: DocumentReference, outdir: Path) -> DocumentReference | None:
-        for entry in document.items:
-            img = cv2.imread(str(entry.path), cv2.IMREAD_GRAYSCALE)
-            assert img is not None
-            if self.threshold is None:
-                img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
-            else:
-                img = cv2.threshold(img, self.threshold, 255, cv2.THRESH_BINARY)[1]
-            cv2.imwrite(str(entry.path), img)
-        return document
+    def apply(self, page: PageImage) -> None:
+        img = page.img if page.img.ndim == 2 else cv2.cvtColor(page.img, cv2.COLOR_BGR2GRAY)
+        if self.threshold is None:
+            img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+        else:
+            img = cv2.threshold(img, self.threshold, 255, cv2.THRESH_BINARY)[1]
+        page.update(img)
 
 
-class Invert(Preprocessor):
+class Invert(ImageTransform):
     """Invert image.
 
     threshold(float | None): if set, only invert if image brightness is below threshold.
@@ -66,13 +134,56 @@ class Invert(Preprocessor):
     def __init__(self, threshold: float | None = None) -> None:
         self.threshold = threshold
 
+    def apply(self, page: PageImage) -> None:
+        if self.threshold is None or page.brightness() < self.threshold:
+            page.update(cv2.bitwise_not(page.img), histogram=None if page.histogram is None else page.histogram[::-1])
+
+
+class BlankPageFilter(ImageTransform):
+    """Mark pages with (almost) no ink as blank, e.g. separator sheets or empty backs of duplex scans, so they aren't extracted.
+
+    min_ink_density(float): pages with a lower fraction of ink pixels are blank. The default tolerates some scanner noise.
+    contrast(int): how much darker or lighter than the paper a pixel has to be to count as ink.
+    """
+
+    grayscale = True
+
+    def __init__(self, min_ink_density: float = 0.001, contrast: int = 64) -> None:
+        self.min_ink_density = min_ink_density
+        self.contrast = contrast
+
+    def apply(self, page: PageImage) -> None:
+        if page.ink_density(self.contrast) < self.min_ink_density:
+            page.skipped = "blank"
+
+
+class ImageChain(Preprocessor):
+    """Apply several image transforms in one pass, decoding each page once and storing the result once.
+
+    transforms(list[ImageTransform]): the transforms to apply, in order.
+    write(bool): if False, the result is kept in memory on the entry for the next stage to consume instead of being written to disk.
+    """
+
+    def __init__(self, transforms: list[ImageTransform], write: bool = True) -> None:
+        self.transforms = transforms
+        self.write = write
+
     def process(self, document: DocumentReference, outdir: Path) -> DocumentReference | None:
-        for entry in document.items:
-            img = cv2.imread(str(entry.path))
-            assert img is not None
-            cols, rows = img.shape[:2]
-            brightness = np.sum(img) / (255 * cols * rows)
-            if self.threshold is None or brightness < self.threshold:
-                img = cv2.bitwise_not(img)
-                cv2.imwrite(str(entry.path), img)
+        document.map_items(self.process_entry)
         return document
+
+    def process_entry(self, entry: DocumentEntry) -> DocumentEntry:
+        if not self.transforms:
+            return entry
+        page = PageImage(entry.load_image(grayscale=self.transforms[0].grayscale))
+        for transform in self.transforms:
+            transform.apply(page)
+        if page.skipped is not None:
+            entry.skipped = page.skipped
+        if not page.modified:
+            return entry
+        if self.write:
+            entry.update_image(page.img)
+        else:
+            entry.image = page.img
+        return entry
@@ -1,54 +1,271 @@
+import threading
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Executor, Future
 from pathlib import Path
+from typing import Any
 
+import cv2
+import numpy as np
 import pypdfium2 as pypdfium
 
-from folioforge.models.document import DocumentEntry, DocumentReference
-from folioforge.preprocessor.protocol import Preprocessor
+from folioforge.models.document import BoundingBox, DocumentEntry, DocumentReference
+from folioforge.preprocessor.protocol import Preprocessor, ShardingPreprocessor
+from folioforge.preprocessor.store import PageStore
+
+# pdfium is not thread-safe, not even for different documents, so all calls into it from threads of a process go through this lock
+PDFIUM_LOCK = threading.RLock()
 
 
 class PymupdfPreprocessor(Preprocessor):
-    def __init__(self, filter_non_pdfs: bool = True) -> None:
+    """Renders PDF pages with pymupdf.
+
+    in_memory(bool): keep the rendered pages as decoded buffers on the entries instead of writing PNGs.
+    lazy(bool): only render pages once the pipeline iterates over them, instead of rendering the whole document upfront.
+    dpi(int): resolution to render at.
+    grayscale(bool): render grayscale pages, for when downstream stages don't need colour.
+    store(PageStore | None): store pages here instead of in the output folder.
+    """
+
+    def __init__(
+        self,
+        filter_non_pdfs: bool = True,
+        in_memory: bool = False,
+        lazy: bool = False,
+        dpi: int = 300,
+        grayscale: bool = False,
+        store: PageStore | None = None,
+    ) -> None:
         self.filter_non_pdfs = filter_non_pdfs
+        self.in_memory = in_memory
+        self.lazy = lazy
+        self.dpi = dpi
+        self.grayscale = grayscale
+        self.store = store
 
     def process(self, document: DocumentReference, outdir: Path) -> DocumentReference | None:
-        import pymupdf
-
-        if document.path.suffix != ".pdf" or len(document.items) > 0:
+        if document.path.suffix != ".pdf" or len(document.items) > 0 or document.pending is not None:
             if self.filter_non_pdfs:
                 return None
             return document
 
-        pdf = pymupdf.open(document.path)
-        pages_dir = Path(f"{outdir}/{document.path.stem}")
+        pages_dir = Path(f"{outdir}/{document.path.stem}") if self.store is None else self.store.page_dir(document.path)
         pages_dir.mkdir(parents=True, exist_ok=True)
-        items = []
-        for page_num, page in enumerate(pdf.pages()):
-            image = page.get_pixmap(dpi=300, alpha=False)
+        crop_dir = _crop_dir(outdir, document, self.store)
+        pages = _with_crop_dir(self._render(document.path, pages_dir), crop_dir)
+        if self.lazy:
+            return DocumentReference(path=document.path, items=[], converted=None, pending=pages)
+        return DocumentReference(path=document.path, items=list(pages), converted=None)
+
+    def _render(self, path: Path, pages_dir: Path) -> Iterator[DocumentEntry]:
+        import pymupdf
+
+        pdf = pymupdf.open(path)
+        try:
+            for page_num, page in enumerate(pdf.pages()):
+                image = page.get_pixmap(dpi=self.dpi, alpha=False, colorspace=pymupdf.csGRAY if self.grayscale else pymupdf.csRGB)
+
+                out_path = pages_dir / f"page{page_num}.png" if self.store is None else self.store.page_path(path, page_num)
+                entry = DocumentEntry(path=out_path, layout=[], converted=None, source=path, page=page_num, scale=self.dpi / 72)
+                if self.in_memory or self.store is not None:
+                    img = np.frombuffer(image.samples, dtype=np.uint8).reshape(image.height, image.width, image.n)
+                    img = img[:, :, 0] if self.grayscale else cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+                    if self.in_memory:
+                        entry.image = img
+                    else:
+                        assert self.store is not None
+                        self.store.write(out_path, img)
+                else:
+                    image.save(out_path)
+                yield entry
+        finally:
+            pdf.close()
+
+
+def render_pages(
+    path: Path,
+    pages_dir: Path,
+    start: int = 0,
+    stop: int | None = None,
+    in_memory: bool = False,
+    scale: float = 4,
+    max_size: int | None = None,
+    grayscale: bool = False,
+    store: PageStore | None = None,
+) -> Iterator[DocumentEntry]:
+    """Render the pages [start, stop) of a PDF with pdfium.
+
+    The document is opened by this function alone, pdfium is not thread-safe so this is also what runs in shard worker processes.
+    If max_size is set, each page is rendered so that its longer side has max_size pixels instead of using a fixed scale.
+    If a store is given, pages are written to it instead of to pages_dir.
+    """
+    with PDFIUM_LOCK:
+        pdf = pypdfium.PdfDocument(path)
+        num_pages = len(pdf)
+    try:
+        for page_num in range(start, num_pages if stop is None else min(stop, num_pages)):
+            # the lock is only held while rendering, encoding and writing the page can overlap with other threads
+            with PDFIUM_LOCK:
+                page = pdf[page_num]
+                page_scale = scale if max_size is None else max_size / max(page.get_size())
+                # pdfium renders BGR by default, which is what opencv expects. The array is a view on the bitmap buffer, no copy is made.
+                if grayscale:
+                    img = page.render(scale=page_scale, grayscale=True, force_bitmap_format=pypdfium.raw.FPDFBitmap_Gray).to_numpy()
+                else:
+                    img = page.render(scale=page_scale).to_numpy()
+                page.close()
+            out_path = pages_dir / f"page{page_num}.png" if store is None else store.page_path(path, page_num)
+            entry = DocumentEntry(path=out_path, layout=[], converted=None, source=path, page=page_num, scale=page_scale)
+            if in_memory:
+                entry.image = img
+            elif store is not None:
+                store.write(out_path, img)
+            else:
+                cv2.imwrite(str(out_path), img)
+            yield entry
+    finally:
+        with PDFIUM_LOCK:
+            pdf.close()
+
+
+def _crop_dir(outdir: Path, document: DocumentReference, store: PageStore | None) -> Path | None:
+    """Where image crops go when pages are in a store, i.e. the folder pages would be in without one, as the store is temporary."""
+    if store is None:
+        return None
+    crop_dir = outdir / document.path.stem
+    crop_dir.mkdir(parents=True, exist_ok=True)
+    return crop_dir
+
 
-            out_path = pages_dir / f"page{page_num}.png"
-            image.save(out_path)
-            items.append(DocumentEntry(path=out_path, layout=[], converted=None))
-        return DocumentReference(path=document.path, items=items, converted=None)
+def _with_crop_dir(pages: Iterator[DocumentEntry], crop_dir: Path | None) -> Iterator[DocumentEntry]:
+    for entry in pages:
+        entry.crop_dir = crop_dir
+        yield entry
 
 
-class PDFPreprocessor(Preprocessor):
-    def __init__(self, filter_non_pdfs: bool = True) -> None:
+def _render_shard(path: Path, pages_dir: Path, start: int, stop: int, **options: Any) -> list[DocumentEntry]:
+    return list(render_pages(path, pages_dir, start, stop, **options))
+
+
+class PageRegionRenderer:
+    """Renders regions of a single PDF page at a fixed resolution, e.g. to OCR layout areas at a higher resolution than the page.
+
+    Regions are given in PDF points (1/72 inch) with the origin at the top left, see DocumentEntry.scale.
+    """
+
+    def __init__(self, path: Path, page: int, scale: float) -> None:
+        self.scale = scale
+        with PDFIUM_LOCK:
+            self.pdf = pypdfium.PdfDocument(path)
+            self.page = self.pdf[page]
+            self.width, self.height = self.page.get_size()
+
+    def render(self, bbox: BoundingBox) -> np.ndarray:
+        x0, y0 = max(bbox.x0, 0), max(bbox.y0, 0)
+        x1, y1 = min(bbox.x1, self.width), min(bbox.y1, self.height)
+        # crop is the amount cut off from each side (left, bottom, right, top), with pdfium's origin at the bottom left
+        with PDFIUM_LOCK:
+            return self.page.render(scale=self.scale, crop=(x0, self.height - y1, self.width - x1, y0)).to_numpy()
+
+    def close(self) -> None:
+        with PDFIUM_LOCK:
+            self.page.close()
+            self.pdf.close()
+
+
+class PDFPreprocessor(ShardingPreprocessor):
+    """Renders PDF pages with pdfium.
+
+    in_memory(bool): keep the rendered pages as decoded buffers on the entries instead of writing PNGs.
+    lazy(bool): only render pages once the pipeline iterates over them, instead of rendering the whole document upfront.
+    scale(float): resolution to render at, in pixels per PDF point (4 is about 288 DPI).
+    max_size(int | None): if set, render each page so its longer side has this many pixels instead, e.g. the input size of a layout model.
+    grayscale(bool): render grayscale pages directly with pdfium, for when downstream stages don't need colour.
+    shard_size(int | None): split documents into page ranges of this size that can be rendered independently.
+    executor(Executor | None): render shards in parallel on this executor (e.g. a ProcessPoolExecutor), requires shard_size.
+    max_pending_shards(int): how many shards are submitted to the executor ahead of the pages being consumed.
+    store(PageStore | None): store pages here instead of in the output folder.
+    """
+
+    def __init__(
+        self,
+        filter_non_pdfs: bool = True,
+        in_memory: bool = False,
+        lazy: bool = False,
+        shard_size: int | None = None,
+        executor: Executor | None = None,
+        max_pending_shards: int = 4,
+        scale: float = 4,
+        max_size: int | None = None,
+        grayscale: bool = False,
+        store: PageStore | None = None,
+    ) -> None:
         self.filter_non_pdfs = filter_non_pdfs
+        self.in_memory = in_memory
+        self.lazy = lazy
+        self.scale = scale
+        self.max_size = max_size
+        self.grayscale = grayscale
+        self.shard_size = shard_size
+        self.executor = executor
+        self.max_pending_shards = max_pending_shards
+        self.store = store
+
+    def __getstate__(self) -> dict[str, Any]:
+        # executors can't be pickled, when shipped to e.g. a dask worker, shards are rendered in place
+        return {**self.__dict__, "executor": None}
+
+    def shard(self, document: DocumentReference, default_size: int | None = None) -> list[DocumentReference]:
+        shard_size = self.shard_size if self.shard_size is not None else default_size
+        if shard_size is None or document.path.suffix != ".pdf" or len(document.items) > 0 or document.page_range is not None:
+            return [document]
+        with PDFIUM_LOCK:
+            pdf = pypdfium.PdfDocument(document.path)
+            num_pages = len(pdf)
+            pdf.close()
+        return [
+            DocumentReference(path=document.path, items=[], converted=None, page_range=(start, min(start + shard_size, num_pages)))
+            for start in range(0, num_pages, shard_size)
+        ]
 
     def process(self, document: DocumentReference, outdir: Path) -> DocumentReference | None:
-        if document.path.suffix != ".pdf" or len(document.items) > 0:
+        if document.path.suffix != ".pdf" or len(document.items) > 0 or document.pending is not None:
             if self.filter_non_pdfs:
                 return None
             return document
 
-        pdf = pypdfium.PdfDocument(document.path)
-        pages_dir = Path(f"{outdir}/{document.path.stem}")
+        pages_dir = Path(f"{outdir}/{document.path.stem}") if self.store is None else self.store.page_dir(document.path)
         pages_dir.mkdir(parents=True, exist_ok=True)
-        items = []
-        for page_num, page in enumerate(pdf):
-            out_path = pages_dir / f"page{page_num}.png"
-            bitmap = page.render(scale=4)
-            pil_image = bitmap.to_pil()
-            pil_image.save(out_path)
-            items.append(DocumentEntry(path=out_path, layout=[], converted=None))
-        return DocumentReference(path=document.path, items=items, converted=None)
+        crop_dir = _crop_dir(outdir, document, self.store)
+        pages: Iterator[DocumentEntry]
+        if document.page_range is not None:
+            pages = render_pages(document.path, pages_dir, *document.page_range, **self._render_options())
+        elif self.executor is not None and self.shard_size is not None:
+            pages = self._render_sharded(document, pages_dir)
+        else:
+            pages = render_pages(document.path, pages_dir, **self._render_options())
+        pages = _with_crop_dir(pages, crop_dir)
+        if self.lazy:
+            return DocumentReference(path=document.path, items=[], converted=None, pending=pages, page_range=document.page_range)
+        return DocumentReference(path=document.path, items=list(pages), converted=None, page_range=document.page_range)
+
+    def _render_sharded(self, document: DocumentReference, pages_dir: Path) -> Iterator[DocumentEntry]:
+        """Render shards on the executor, yielding pages in order while keeping at most max_pending_shards in flight."""
+        assert self.executor is not None
+        pending: deque[Future[list[DocumentEntry]]] = deque()
+        for shard in self.shard(document):
+            assert shard.page_range is not None
+            pending.append(self.executor.submit(_render_shard, document.path, pages_dir, *shard.page_range, **self._render_options()))
+            if len(pending) >= self.max_pending_shards:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+    def _render_options(self) -> dict[str, Any]:
+        return {
+            "in_memory": self.in_memory,
+            "scale": self.scale,
+            "max_size": self.max_size,
+            "grayscale": self.grayscale,
+            "store": self.store,
+        }
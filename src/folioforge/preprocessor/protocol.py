@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Protocol
+from typing import Protocol, runtime_checkable
 
 from folioforge.models.document import DocumentReference
 
@@ -8,3 +8,12 @@ class Preprocessor(Protocol):
     """Preprocesses documents, potentially modifying them or parsing them to individual items."""
 
     def process(self, document: DocumentReference, outdir: Path) -> DocumentReference | None: ...
+
+
+@runtime_checkable
+class ShardingPreprocessor(Preprocessor, Protocol):
+    """A preprocessor that can split a document into shards that get processed independently, e.g. page ranges."""
+
+    def shard(self, document: DocumentReference, default_size: int | None = None) -> list[DocumentReference]:
+        """Split a document into shards, of default_size pages (or the like) if the preprocessor doesn't have a size of its own."""
+        ...
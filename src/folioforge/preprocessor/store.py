@@ -0,0 +1,71 @@
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from folioforge.models.document import DocumentEntry, write_page_image
+
+
+class PageStore:
+    """Stores rendered page images on disk, under keys that don't collide between documents and within a disk budget.
+
+    directory(Path): where to store pages, in a folder per source document. It's left in place, whoever creates it removes it.
+    raw(bool): store pages as uncompressed .npy files instead of PNGs. They take more space, but don't need to be encoded and are
+        memory mapped when read, so cropping an area only reads that area instead of decoding the whole page.
+    max_bytes(int | None): disk budget for pages. Once exceeded, pages that were released (i.e. are extracted) are deleted, least
+        recently released first. Pages that are still being worked on are never deleted. Image crops aren't written to the store
+        but to the output folder (see DocumentEntry.crop_dir), so they outlive it.
+        Pages are accounted in the process that writes or releases them, so the budget is tracked per process and isn't enforced
+        across processes, e.g. dask workers or the staged executor's preprocessing processes, which may use max_bytes each.
+    """
+
+    def __init__(self, directory: Path, raw: bool = True, max_bytes: int | None = None) -> None:
+        self.directory = directory
+        self.raw = raw
+        self.max_bytes = max_bytes
+        self._sizes: dict[Path, int] = {}
+        self._released: OrderedDict[Path, None] = OrderedDict()
+        self._used = 0
+
+    def page_dir(self, source: Path) -> Path:
+        # documents with the same name in different folders get different directories
+        digest = hashlib.sha1(str(source.resolve()).encode()).hexdigest()[:12]
+        return self.directory / f"{source.stem}-{digest}"
+
+    def page_path(self, source: Path, page: int) -> Path:
+        return self.page_dir(source) / f"page{page}{'.npy' if self.raw else '.png'}"
+
+    def write(self, path: Path, img: np.ndarray) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_page_image(path, img)
+        self._track(path)
+        self._evict()
+
+    def release(self, entry: DocumentEntry) -> None:
+        """Mark the page of entry as no longer needed by the pipeline, so it can be evicted."""
+        if entry.path not in self._sizes and not self._track(entry.path):
+            return
+        self._released[entry.path] = None
+        self._released.move_to_end(entry.path)
+        self._evict()
+
+    def _track(self, path: Path) -> bool:
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return False
+        self._used += size - self._sizes.get(path, 0)
+        self._sizes[path] = size
+        return True
+
+    def _evict(self) -> None:
+        if self.max_bytes is None:
+            return
+        while self._used > self.max_bytes and self._released:
+            path, _ = self._released.popitem(last=False)
+            self._used -= self._sizes.pop(path)
+            path.unlink(missing_ok=True)
+            # encoded copies made for tools that only read image files
+            if path.suffix == ".npy":
+                path.with_suffix(".png").unlink(missing_ok=True)
@@ -2,6 +2,7 @@ import shutil
 import tempfile
 from pathlib import Path
 
+import pypdfium2 as pypdfium
 import pytest
 
 from folioforge.models.document import DocumentEntry, DocumentReference
@@ -12,6 +13,18 @@ def pdf_file():
     return Path(__file__).parent / "assets" / "test.pdf"
 
 
+@pytest.fixture
+def multipage_pdf_file():
+    tmpdir = Path(tempfile.mkdtemp(prefix="folioforge_pdf"))
+    pdf = pypdfium.PdfDocument.new()
+    for i in range(5):
+        pdf.new_page(200 + i * 10, 300)
+    dest = tmpdir / "multipage.pdf"
+    pdf.save(dest)
+    pdf.close()
+    return dest
+
+
 @pytest.fixture
 def image_file():
     tmpdir = Path(tempfile.mkdtemp(prefix="folioforge_image"))
@@ -1,8 +1,100 @@
-from folioforge.extraction.docling import DoclingExtractor
+import json
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+from docling.datamodel.pipeline_options import TableFormerMode
+
+from folioforge.extraction.docling import DoclingExtractor, DoclingOptions, DoclingPreset
+from folioforge.extraction.gemini import GeminiClient, GeminiExtractor
 from folioforge.extraction.layout.doclayout_yolo import DoclayoutYOLOD4LA
+from folioforge.extraction.layout.protocol import LayoutDetector
+from folioforge.extraction.ocr.lines import assign_lines
 from folioforge.extraction.ocr.paddle import PaddleOcrExtractor
+from folioforge.extraction.ocr.protocol import OcrExtractor
+from folioforge.extraction.ocr.text_layer import PdfTextLayerExtractor
 from folioforge.extraction.two_phase import TwoPhaseExtractor
-from folioforge.models.document import DocumentReference
+from folioforge.models.document import BoundingBox, DocumentEntry, DocumentReference, Image, Table, TableCell, Text
+from folioforge.models.labels import Label
+from folioforge.preprocessor.pdf import render_pages
+
+
+class FakeOcrExtractor(OcrExtractor):
+    supports_pickle = True
+
+    def __init__(self) -> None:
+        self.seen: list[Label] = []
+
+    def extract(self, document: DocumentEntry) -> DocumentEntry:
+        for area in document.layout:
+            self.seen.append(area.label)
+            area.converted = "ocr"
+        return document
+
+
+class StubGeminiClient(GeminiClient):
+    """Answers with a single text block per page after a delay, failing the first request."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.uploads: list[tuple[bytes, str]] = []
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def upload(self, data: bytes, mime_type: str, name: str | None = None) -> tuple[bytes, str]:
+        with self.lock:
+            self.uploads.append((data, mime_type))
+        return data, mime_type
+
+    def generate(self, parts: list, schema: dict | None = None) -> str:
+        with self.lock:
+            self.requests += 1
+            if self.requests == 1:
+                raise ConnectionError("unavailable")
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        block = {"label": "TEXT", "boundingBox": {"x": 0.1, "y": 0.1, "width": 0.5, "height": 0.1}, "text": "gemini"}
+        # all uploads but the example are pages
+        pages = sum(isinstance(part, tuple) for part in parts) - 1
+        response = [[block]] * pages if schema and schema["items"]["type"] == "array" else [block]
+        return f"```json\n{json.dumps(response)}\n```"
+
+
+class FlakyUploadGeminiClient(StubGeminiClient):
+    """Fails the first page upload as well."""
+
+    def upload(self, data: bytes, mime_type: str, name: str | None = None) -> tuple[bytes, str]:
+        with self.lock:
+            failed = len(self.uploads) == 1
+        result = super().upload(data, mime_type, name)
+        if failed:
+            raise ConnectionError("unavailable")
+        return result
+
+
+class FakeLayoutDetector(LayoutDetector):
+    """Detects a single text area covering the page, counting how often it's called."""
+
+    supports_pickle = True
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def detect(self, document: DocumentEntry) -> DocumentEntry:
+        return self.detect_batch([document])[0]
+
+    def detect_batch(self, documents: list[DocumentEntry]) -> list[DocumentEntry]:
+        self.calls += 1
+        for document in documents:
+            document.layout.append(Text(bbox=BoundingBox(x0=0, y0=0, x1=10, y1=10), label=Label.TEXT, confidence=1, converted=None))
+        return documents
 
 
 def test_docling(document_preprocessed: DocumentReference):
@@ -14,6 +106,17 @@ def test_docling(document_preprocessed: DocumentReference):
     assert "If you can read this, you have Adobe Acrobat Reader installed on your computer" in entry.converted
 
 
+def test_docling_presets():
+    options = DoclingOptions.preset(DoclingPreset.fast).pipeline_options(False)
+    assert not options.do_ocr
+    assert options.table_structure_options.mode == TableFormerMode.FAST
+    options = DoclingOptions.preset(DoclingPreset.accurate).pipeline_options(True)
+    assert options.table_structure_options.mode == TableFormerMode.ACCURATE
+
+    extractor = DoclingExtractor(options=DoclingPreset.fast)
+    assert extractor.options == DoclingOptions(ocr=False, accurate_tables=False)
+
+
 def test_doclayout_yolo(document_preprocessed: DocumentReference):
     extractor = TwoPhaseExtractor(layout_detector=DoclayoutYOLOD4LA(), ocr_extractor=PaddleOcrExtractor())
     entry = extractor.extract(document_preprocessed.items[0])
@@ -21,3 +124,120 @@ def test_doclayout_yolo(document_preprocessed: DocumentReference):
     assert (
         entry.converted == "This is a test PDF document.\nIf you can read this, you have Adobe Acrobat Reader installed on your computer."
     )
+
+
+def test_doclayout_yolo_batch(document_preprocessed: DocumentReference):
+    extractor = TwoPhaseExtractor(layout_detector=DoclayoutYOLOD4LA(), ocr_extractor=PaddleOcrExtractor(batch_size=2))
+    entry = document_preprocessed.items[0]
+    copy = entry.model_copy(update={"layout": []})
+    entries = extractor.extract_batch([entry, copy])
+    assert entries[0].converted == entries[1].converted
+    assert entries[0].converted and "This is a test PDF document." in entries[0].converted
+
+
+def test_text_layer(pdf_file: Path):
+    entry = next(render_pages(pdf_file, Path(tempfile.mkdtemp(prefix="folioforge")), in_memory=True, scale=2))
+    entry.layout = [
+        Text(bbox=BoundingBox(x0=0, y0=0, x1=1224, y1=400), label=Label.TEXT, confidence=1, converted=None),
+        Text(bbox=BoundingBox(x0=0, y0=1200, x1=1224, y1=1500), label=Label.TEXT, confidence=1, converted=None),
+        Image(bbox=BoundingBox(x0=0, y0=1000, x1=100, y1=1100), label=Label.IMAGE, confidence=1, converted=None),
+    ]
+    fallback = FakeOcrExtractor()
+    entry = PdfTextLayerExtractor(fallback=fallback).extract(entry)
+    assert entry.layout[0].converted == (
+        "This is a test PDF document. If you can read this, you have Adobe Acrobat Reader installed on your computer."
+    )
+    # the empty area and the image go to OCR
+    assert sorted(fallback.seen) == [Label.IMAGE, Label.TEXT]
+
+    entry.layout = [Text(bbox=BoundingBox(x0=0, y0=0, x1=1224, y1=400), label=Label.TEXT, confidence=1, converted=None)]
+    fallback = FakeOcrExtractor()
+    entry = PdfTextLayerExtractor(fallback=fallback, min_page_chars=1000).extract(entry)
+    assert entry.converted == "ocr"
+
+
+def test_two_phase_batch(tmp_path: Path):
+    detector = FakeLayoutDetector()
+    extractor = TwoPhaseExtractor(layout_detector=detector, ocr_extractor=FakeOcrExtractor())
+    entries = [DocumentEntry(path=tmp_path / f"page{i}.png", layout=[], converted=None) for i in range(3)]
+    entries = extractor.extract_batch(entries)
+    assert detector.calls == 1
+    assert all(len(e.layout) == 1 and e.layout[0].converted == "ocr" for e in entries)
+
+
+def test_assign_lines():
+    cell = TableCell(
+        bbox=BoundingBox(x0=0, y0=100, x1=50, y1=120),
+        row_span=1,
+        col_span=1,
+        start_row=1,
+        start_col=0,
+        end_row=2,
+        end_col=1,
+        converted=None,
+    )
+    table = Table(bbox=BoundingBox(x0=0, y0=90, x1=100, y1=130), label=Label.TABLE, confidence=1, converted=None, headers=[], cells=[cell])
+    first = Text(bbox=BoundingBox(x0=0, y0=0, x1=100, y1=40), label=Label.TEXT, confidence=1, converted=None)
+    second = Text(bbox=BoundingBox(x0=0, y0=40, x1=100, y1=80), label=Label.TEXT, confidence=1, converted=None)
+    lines = np.array(
+        [
+            [5, 5, 95, 15],
+            [5, 20, 95, 30],
+            # straddles both text areas, mostly in the second one
+            [5, 35, 95, 55],
+            # within the cell and the table, the cell wins
+            [2, 102, 48, 118],
+            # outside of the layout
+            [5, 200, 95, 210],
+        ]
+    )
+    assign_lines(lines, ["a", "b", "c", "d", "e"], [first, second, table])
+    assert first.converted == "a b"
+    assert second.converted == "c"
+    assert cell.converted == "d"
+    assert table.converted is None
+
+
+def test_docling_source_pdf(pdf_file: Path):
+    extractor = DoclingExtractor(use_source_pdf=True)
+    outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
+    small = extractor.extract_batch(list(render_pages(pdf_file, outdir, in_memory=True, scale=1)))[0]
+    large = extractor.extract_batch(list(render_pages(pdf_file, outdir, in_memory=True, scale=2)))[0]
+    assert large.converted and "This is a test PDF document" in large.converted
+    # boxes are in page image pixels, not PDF points
+    assert large.layout and [a.bbox for a in large.layout] == [a.bbox.scaled(2) for a in small.layout]
+
+
+def test_gemini_concurrency(image_file: Path):
+    client = StubGeminiClient()
+    extractor = GeminiExtractor(client=client, concurrency=4, backoff=0)
+    entries = [DocumentEntry(path=image_file, layout=[], converted=None) for _ in range(8)]
+    entries = extractor.extract_batch(entries)
+    assert all(len(e.layout) == 1 and e.layout[0].converted == "gemini" for e in entries)
+    # the failed request is retried
+    assert client.requests == 9
+    assert 1 < client.max_in_flight <= 4
+
+
+def test_gemini_payload(image_file: Path):
+    client = StubGeminiClient()
+    extractor = GeminiExtractor(client=client, backoff=0, max_pixels=10_000, jpeg_quality=80, pages_per_request=3)
+    entries = [DocumentEntry(path=image_file, layout=[], converted=None) for _ in range(5)]
+    entries = extractor.extract_batch(entries)
+    assert all(len(e.layout) == 1 and e.layout[0].converted == "gemini" for e in entries)
+    # two requests and a retry
+    assert client.requests == 3
+    page = cv2.imdecode(np.frombuffer(client.uploads[-1][0], np.uint8), cv2.IMREAD_UNCHANGED)
+    assert page is not None
+    assert client.uploads[-1][1] == "image/jpeg"
+    assert page.shape[0] * page.shape[1] <= 10_000
+
+
+def test_gemini_upload_retry(image_file: Path):
+    client = FlakyUploadGeminiClient()
+    extractor = GeminiExtractor(client=client, backoff=0, pages_per_request=2)
+    entries = [DocumentEntry(path=image_file, layout=[], converted=None) for _ in range(2)]
+    entries = extractor.extract_batch(entries)
+    assert all(len(e.layout) == 1 and e.layout[0].converted == "gemini" for e in entries)
+    # the example, the failed upload, its retry and the second page
+    assert len(client.uploads) == 4
@@ -0,0 +1,433 @@
+import pickle
+import threading
+import time
+from collections.abc import Iterator
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+from dask.distributed import Client
+
+from folioforge.extraction.protocol import Extractor
+from folioforge.models.document import BoundingBox, DocumentEntry, Heading, Image, Table
+from folioforge.models.labels import Label
+from folioforge.output.markdown import MarkdownGenerator
+from folioforge.output.passthrough import PassthroughGenerator
+from folioforge.pipeline.batching import MicroBatcher, extract_unique
+from folioforge.pipeline.cache import ExtractionCache, extractor_fingerprint
+from folioforge.pipeline.dask import DaskPipelineExecutor
+from folioforge.pipeline.dedup import PageDeduplicator, perceptual_hash, thumbnail
+from folioforge.pipeline.factory import ExtractorFactory
+from folioforge.pipeline.process import ProcessPipelineExecutor
+from folioforge.pipeline.simple import SimplePipelineExecutor
+from folioforge.pipeline.staged import StagedPipelineExecutor
+from folioforge.postprocessor.debug import DebugPostprocessor
+from folioforge.preprocessor.image import BlankPageFilter
+from folioforge.preprocessor.pdf import PDFPreprocessor
+
+
+class PageNameExtractor(Extractor):
+    """Fake extractor that converts a page to its file name."""
+
+    supports_pickle = True
+    supports_fork = True
+    cache_fields = ("min_confidence",)
+
+    def __init__(self, min_confidence: float = 0.2) -> None:
+        self.min_confidence = min_confidence
+        self.had_image: list[bool] = []
+        self.batch_sizes: list[int] = []
+
+    def extract(self, entry: DocumentEntry) -> DocumentEntry:
+        self.had_image.append(entry.image is not None)
+        entry.converted = entry.path.name
+        return entry
+
+    def extract_batch(self, entries: list[DocumentEntry]) -> list[DocumentEntry]:
+        self.batch_sizes.append(len(entries))
+        return [self.extract(entry) for entry in entries]
+
+
+def test_simple_pipeline_streaming(pdf_file: Path):
+    extractor = PageNameExtractor()
+    executor = SimplePipelineExecutor.setup(
+        preprocessors=[PDFPreprocessor(in_memory=True, lazy=True)], extractor=extractor, format=PassthroughGenerator(), page_window=2
+    )
+    result = executor.execute([pdf_file])
+    assert len(result) == 1
+    document, text = result[0]
+    assert text == "page0.png"
+    assert extractor.had_image == [True]
+    assert all(entry.image is None for entry in document.items)
+
+
+@pytest.mark.parametrize("executor_cls", [SimplePipelineExecutor, ProcessPipelineExecutor])
+def test_streaming_debug(multipage_pdf_file: Path, tmp_path: Path, executor_cls: type[SimplePipelineExecutor]):
+    # in-memory pages have no file, so their images are kept for the debug output
+    with executor_cls.setup(
+        preprocessors=[PDFPreprocessor(in_memory=True, lazy=True)],
+        extractor=ExtractorFactory(PageNameExtractor),
+        format=PassthroughGenerator(),
+        postprocessors=[DebugPostprocessor()],
+        outdir=tmp_path,
+    ) as executor:
+        executor.execute([multipage_pdf_file])
+    debug = tmp_path / multipage_pdf_file.stem / "debug"
+    assert sorted(path.name for path in debug.iterdir()) == [f"page{i}.png" for i in range(5)]
+
+
+def test_extraction_cache(pdf_file: Path, tmp_path: Path):
+    cache = ExtractionCache(tmp_path / "cache")
+    extractor = PageNameExtractor()
+    for _ in range(2):
+        executor = SimplePipelineExecutor.setup(
+            preprocessors=[PDFPreprocessor(in_memory=True)], extractor=extractor, format=PassthroughGenerator(), cache=cache
+        )
+        result = executor.execute([pdf_file])
+        assert result[0][1] == "page0.png"
+    # the second run is served from the cache
+    assert len(extractor.had_image) == 1
+
+    # a different configuration is a different result
+    other = PageNameExtractor(min_confidence=0.5)
+    SimplePipelineExecutor.setup(
+        preprocessors=[PDFPreprocessor(in_memory=True)], extractor=other, format=PassthroughGenerator(), cache=cache
+    ).execute([pdf_file])
+    assert len(other.had_image) == 1
+
+
+def test_extractor_fingerprint():
+    class WrappingExtractor(PageNameExtractor):
+        cache_fields = ("min_confidence", "inner")
+
+        def __init__(self, inner: Extractor, batch_size: int) -> None:
+            super().__init__()
+            self.inner = inner
+            self.batch_size = batch_size
+
+    # only result-affecting fields are part of the key, nested extractors included
+    fingerprint = extractor_fingerprint(WrappingExtractor(PageNameExtractor(min_confidence=0.5), batch_size=4))
+    assert fingerprint["inner"] == {"type": f"{__name__}.PageNameExtractor", "min_confidence": 0.5}
+    assert "batch_size" not in fingerprint
+    assert fingerprint == extractor_fingerprint(WrappingExtractor(PageNameExtractor(min_confidence=0.5), batch_size=8))
+
+
+def test_extraction_cache_eviction(tmp_path: Path):
+    cache = ExtractionCache(tmp_path / "cache", max_bytes=1500)
+    entries = [DocumentEntry(path=tmp_path / f"page{i}.png", layout=[], converted="x" * 500) for i in range(4)]
+    for i, entry in enumerate(entries):
+        cache.put(f"{i:02d}key", entry)
+    # the oldest results were evicted to get below max_bytes
+    assert cache.get("00key", entries[0]) is None
+    assert cache.get("03key", entries[3]) is not None
+
+
+def test_extraction_cache_low_water(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    cache = ExtractionCache(tmp_path / "cache", max_bytes=10_000, low_water=0.5)
+    evictions = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: evictions.append(1) or evict())
+    for i in range(40):
+        cache.put(f"{i:02d}key", DocumentEntry(path=tmp_path / f"page{i}.png", layout=[], converted="x" * 500))
+    # each eviction makes room for several results, rather than one
+    assert cache._size is not None and cache._size <= 10_000
+    assert 1 <= len(evictions) <= 4
+
+
+def test_extraction_cache_result(tmp_path: Path):
+    cache = ExtractionCache(tmp_path / "cache", max_bytes=10_000)
+    crop = tmp_path / "image_page0_0.png"
+    crop.write_bytes(b"crop")
+    bbox = BoundingBox(x0=0, y0=0, x1=10, y1=10)
+    entry = DocumentEntry(
+        path=tmp_path / "page0.png",
+        layout=[
+            Heading(bbox=bbox, label=Label.SECTION_HEADER, confidence=1, converted="title", level=2),
+            Table(bbox=bbox, label=Label.TABLE, confidence=1, converted="a", headers=[], cells=[]),
+            Image(bbox=bbox, label=Label.IMAGE, confidence=1, converted=None, path=crop),
+        ],
+        converted="title",
+    )
+    for _ in range(3):
+        cache.put("key", entry)
+    # overwriting a result doesn't add to the size
+    assert cache._size == (tmp_path / "cache" / "ke" / "key.json").stat().st_size
+
+    other = tmp_path / "other"
+    other.mkdir()
+    cached = cache.get("key", DocumentEntry(path=other / "page7.png", layout=[], converted=None))
+    assert cached is not None
+    assert [type(area) for area in cached.layout] == [Heading, Table, Image]
+    heading, _, image = cached.layout
+    assert isinstance(heading, Heading) and heading.label == Label.SECTION_HEADER and heading.level == 2
+    assert isinstance(image, Image) and image.path is not None
+    assert image.path == other / "image_page7_0.png" and image.path.read_bytes() == b"crop"
+
+
+def test_skip_blank_pages(multipage_pdf_file: Path):
+    extractor = PageNameExtractor()
+    executor = SimplePipelineExecutor.setup(
+        preprocessors=[PDFPreprocessor(in_memory=True), BlankPageFilter()], extractor=extractor, format=MarkdownGenerator()
+    )
+    result = executor.execute([multipage_pdf_file])
+    assert extractor.had_image == []
+    assert "<!-- page0 skipped: blank -->" in result[0][1]
+
+
+def test_perceptual_hash(lenna_file: Path):
+    img = cv2.imread(str(lenna_file))
+    assert img is not None
+    noisy = np.clip(img.astype(np.int16) + np.random.default_rng(0).integers(-10, 10, img.shape), 0, 255).astype(np.uint8)
+    distance = (perceptual_hash(img) ^ perceptual_hash(noisy)).bit_count()
+    assert distance <= 4
+    assert (perceptual_hash(img) ^ perceptual_hash(cv2.flip(img, 1))).bit_count() > 16
+
+    assert thumbnail(img).shape == (32, 32, 3)
+
+
+def test_page_deduplicator():
+    dedup = PageDeduplicator[str](max_distance=2, max_difference=2)
+    white, gray, black = (np.full((32, 32), value, dtype=np.uint8) for value in (255, 128, 0))
+    dedup.add(((10, 10), 0b1111, white), "a")
+    assert dedup.find(((10, 10), 0b1100, white)) == "a"
+    assert dedup.find(((10, 10), 0b1000, white)) is None
+    assert dedup.find(((10, 20), 0b1111, white)) is None
+    # close hashes of different pages
+    assert dedup.find(((10, 10), 0b1111, black)) is None
+    assert dedup.find(((10, 10), 0b1111, white - 2)) == "a"
+    signatures = [((1, 1), 0, white), ((1, 1), 0xFF, gray), ((1, 1), 1, white - 1), ((1, 1), 0xFE, gray), ((1, 1), 0, black)]
+    assert dedup.group(signatures) == [0, 1, 0, 1, 4]
+
+
+def test_dedup_noisy_pages(lenna_file: Path, tmp_path: Path):
+    page = cv2.imread(str(lenna_file), cv2.IMREAD_GRAYSCALE)
+    assert page is not None
+    noisy = np.clip(page + np.random.default_rng(0).normal(0, 1, page.shape), 0, 255).astype(np.uint8)
+    shifted = np.roll(page, 1, axis=1)
+    entries = [
+        DocumentEntry(path=tmp_path / f"page{i}.png", image=image, layout=[], converted=None)
+        for i, image in enumerate([page, noisy, shifted, cv2.flip(page, 1)])
+    ]
+    extractor = PageNameExtractor()
+    results = extract_unique(extractor, entries, None, PageDeduplicator[DocumentEntry]())
+    # scan noise and a shift by a pixel still make a duplicate, a mirrored page doesn't
+    assert len(extractor.had_image) == 2
+    assert [entry.converted for entry in results] == ["page0.png", "page0.png", "page0.png", "page3.png"]
+
+
+def test_simple_pipeline_dedup(multipage_pdf_file: Path, tmp_path: Path):
+    # same pages in a different document
+    copy = tmp_path / "copy.pdf"
+    copy.write_bytes(multipage_pdf_file.read_bytes())
+    extractor = PageNameExtractor()
+    executor = SimplePipelineExecutor.setup(
+        preprocessors=[PDFPreprocessor(in_memory=True)], extractor=extractor, format=PassthroughGenerator(), dedup_max_distance=0
+    )
+    result = executor.execute([multipage_pdf_file, copy])
+    # pages have different sizes, so only the pages of the copy are duplicates
+    assert len(extractor.had_image) == 5
+    assert result[1][0].items[3].converted == "page3.png"
+
+
+def test_micro_batcher():
+    batcher = MicroBatcher(max_size=3, adaptive=False)
+    assert list(batcher.batches(range(7))) == [[0, 1, 2], [3, 4, 5], [6]]
+    # everything is late, so no batch waits for more than one item
+    batcher = MicroBatcher(max_size=3, max_wait=0, adaptive=False)
+    assert list(batcher.batches(range(3))) == [[0], [1], [2]]
+
+    batcher = MicroBatcher(max_size=8)
+    assert batcher.size == 1
+    batcher.record(1, 1.0)
+    assert batcher.size == 2
+    # twice the pages in the same time is better, so it keeps growing
+    batcher.record(2, 1.0)
+    assert batcher.size == 4
+    # but not if throughput drops
+    batcher.record(4, 8.0)
+    assert batcher.size == 2
+    # a partial batch is recorded by its own size, and can be the best one
+    batcher.record(3, 1.0)
+    assert batcher.size == 3
+
+
+def test_micro_batcher_max_wait():
+    released = threading.Event()
+
+    def slow_pages() -> Iterator[int]:
+        yield from range(2)
+        # the input blocks until the partial batch has been passed on
+        released.wait(5)
+        raise ValueError("broken page")
+
+    batcher = MicroBatcher(max_size=4, max_wait=0.05, adaptive=False)
+    batches = batcher.batches(slow_pages())
+    started = time.monotonic()
+    assert next(batches) == [0, 1]
+    assert time.monotonic() - started < 1
+    released.set()
+    # errors of the input are raised by the batcher
+    with pytest.raises(ValueError, match="broken page"):
+        next(batches)
+
+
+def test_simple_pipeline_batching(multipage_pdf_file: Path, pdf_file: Path):
+    extractor = PageNameExtractor()
+    executor = SimplePipelineExecutor.setup(
+        preprocessors=[PDFPreprocessor(in_memory=True, lazy=True)],
+        extractor=extractor,
+        format=PassthroughGenerator(),
+        batcher=MicroBatcher(max_size=4, max_wait=None, adaptive=False),
+    )
+    result = executor.execute([multipage_pdf_file, pdf_file])
+    # pages of both documents end up in the same batch
+    assert extractor.batch_sizes == [4, 2]
+    assert [len(document.items) for document, _ in result] == [5, 1]
+    assert result[1][1] == "page0.png"
+
+
+def test_extractor_factory(pdf_file: Path):
+    factory = ExtractorFactory(PageNameExtractor, min_confidence=0.5)
+    extractor = factory.get()
+    assert extractor.min_confidence == 0.5
+    assert factory.get() is extractor
+    # copies, e.g. on a worker, share the extractor of the process
+    assert pickle.loads(pickle.dumps(factory)).get() is extractor
+    assert ExtractorFactory(PageNameExtractor).get() is not extractor
+
+    # factories among the arguments are built as well
+    assert ExtractorFactory(dict, inner=factory).get() == {"inner": extractor}
+
+    with SimplePipelineExecutor.setup(preprocessors=[PDFPreprocessor()], extractor=factory, format=PassthroughGenerator()) as executor:
+        assert executor.extractor is extractor
+        assert executor.execute([pdf_file])[0][1] == "page0.png"
+    # closing the executor releases the extractor, and those of factories among the arguments
+    assert factory.get() is not extractor
+    wrapper = ExtractorFactory(dict, inner=factory)
+    wrapper.get()
+    wrapper.release()
+    assert factory.key not in ExtractorFactory._instances and wrapper.key not in ExtractorFactory._instances
+
+
+def test_dask_pipeline_client(multipage_pdf_file: Path, pdf_file: Path):
+    with Client(processes=False, n_workers=1, threads_per_worker=2) as client:
+        factory = ExtractorFactory(PageNameExtractor)
+        with DaskPipelineExecutor.setup(
+            preprocessors=[PDFPreprocessor(shard_size=2)],
+            extractor=factory,
+            format=PassthroughGenerator(),
+            client=client,
+        ) as executor:
+            for _ in range(2):
+                # documents keep their order, the same path twice gives two documents
+                result = executor.execute([multipage_pdf_file, pdf_file, multipage_pdf_file])
+                assert [document.path for document, _ in result] == [multipage_pdf_file, pdf_file, multipage_pdf_file]
+                assert result[0][1] == result[2][1] == "\n\n".join(f"page{i}.png" for i in range(5))
+                assert executor.client is client
+        # the client was passed in, so it's left open, but its (in-process) workers dropped the extractor
+        assert client.status == "running"
+        assert factory.key not in ExtractorFactory._instances
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_staged_pipeline(multipage_pdf_file: Path, pdf_file: Path, processes: bool):
+    extractor = PageNameExtractor()
+    executor = StagedPipelineExecutor.setup(
+        preprocessors=[PDFPreprocessor(shard_size=2, lazy=True)],
+        extractor=extractor,
+        format=PassthroughGenerator(),
+        preprocess_workers=2,
+        processes=processes,
+        extract_workers=2,
+        queue_size=2,
+        batcher=MicroBatcher(max_size=2, max_wait=None, adaptive=False),
+    )
+    result = executor.execute([multipage_pdf_file, pdf_file, multipage_pdf_file])
+    assert [document.path for document, _ in result] == [multipage_pdf_file, pdf_file, multipage_pdf_file]
+    assert result[0][1] == result[2][1] == "\n\n".join(f"page{i}.png" for i in range(5))
+    assert result[1][1] == "page0.png"
+    assert sum(extractor.batch_sizes) == 11
+
+
+def test_staged_pipeline_error(multipage_pdf_file: Path):
+    class FailingExtractor(PageNameExtractor):
+        def extract(self, entry: DocumentEntry) -> DocumentEntry:
+            raise RuntimeError(f"can't extract {entry.path.name}")
+
+    executor = StagedPipelineExecutor.setup(
+        preprocessors=[PDFPreprocessor()], extractor=FailingExtractor(), format=PassthroughGenerator(), processes=False, queue_size=1
+    )
+    with pytest.raises(RuntimeError, match="can't extract"):
+        executor.execute([multipage_pdf_file] * 4)
+
+
+def test_execute_iter(multipage_pdf_file: Path, pdf_file: Path):
+    extractor = PageNameExtractor()
+    executor = SimplePipelineExecutor.setup(
+        preprocessors=[PDFPreprocessor(lazy=True)], extractor=extractor, format=PassthroughGenerator(), page_window=2
+    )
+    results = executor.execute_iter([pdf_file, multipage_pdf_file])
+    document, text = next(results)
+    assert document.path == pdf_file and text == "page0.png"
+    # the first document is done before the pages of the second one are extracted
+    assert sum(extractor.batch_sizes) == 2
+    assert [document.path for document, _ in results] == [multipage_pdf_file]
+
+    executor = StagedPipelineExecutor.setup(
+        preprocessors=[PDFPreprocessor()], extractor=PageNameExtractor(), format=PassthroughGenerator(), processes=False, queue_size=1
+    )
+    results = executor.execute_iter([multipage_pdf_file, pdf_file] * 2, ordered=False)
+    assert sorted(text for _, text in results) == ["page0.png"] * 2 + ["\n\n".join(f"page{i}.png" for i in range(5))] * 2
+    # stopping early stops the stages
+    results = executor.execute_iter([multipage_pdf_file] * 8)
+    next(results)
+    results.close()
+
+
+@pytest.mark.parametrize("preload", [True, False])
+def test_process_pipeline(multipage_pdf_file: Path, pdf_file: Path, preload: bool):
+    factory = ExtractorFactory(PageNameExtractor)
+    with ProcessPipelineExecutor.setup(
+        preprocessors=[PDFPreprocessor(in_memory=True)], extractor=factory, format=PassthroughGenerator(), workers=2, preload=preload
+    ) as executor:
+        result = executor.execute([multipage_pdf_file, pdf_file, multipage_pdf_file])
+        assert [document.path for document, _ in result] == [multipage_pdf_file, pdf_file, multipage_pdf_file]
+        assert result[0][1] == result[2][1] == "\n\n".join(f"page{i}.png" for i in range(5))
+        assert all(entry.image is None for document, _ in result for entry in document.items)
+        # only built here to be shared with forked workers
+        assert (factory.key in ExtractorFactory._instances) == executor.preload
+    # and released again on close
+    assert factory.key not in ExtractorFactory._instances
+
+
+def test_process_pipeline_spawn():
+    class UnforkableExtractor(PageNameExtractor):
+        supports_fork = False
+
+    executor = ProcessPipelineExecutor.setup(
+        preprocessors=[], extractor=ExtractorFactory(UnforkableExtractor), format=PassthroughGenerator()
+    )
+    assert not executor.preload
+
+
+def test_dask_pipeline_dedup(multipage_pdf_file: Path, pdf_file: Path, tmp_path: Path):
+    notes = tmp_path / "notes.txt"
+    notes.write_text("not a pdf")
+    factory = ExtractorFactory(PageNameExtractor)
+    with (
+        Client(processes=False, n_workers=1, threads_per_worker=2) as client,
+        DaskPipelineExecutor.setup(
+            preprocessors=[PDFPreprocessor(in_memory=True)],
+            extractor=factory,
+            format=PassthroughGenerator(),
+            client=client,
+            dedup_max_distance=0,
+        ) as executor,
+    ):
+        result = executor.execute([multipage_pdf_file, notes, pdf_file, multipage_pdf_file])
+    # documents dropped by a preprocessor are left out
+    assert [document.path for document, _ in result] == [multipage_pdf_file, pdf_file, multipage_pdf_file]
+    assert result[0][1] == result[2][1] == "\n\n".join(f"page{i}.png" for i in range(5))
+    # the pages of the second copy are copies of the first
+    assert sum(factory.get().batch_sizes) <= 6
@@ -1,11 +1,17 @@
 import filecmp
 import shutil
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-from folioforge.models.document import DocumentReference
-from folioforge.preprocessor.image import AutoBrightness, Grayscale, Threshold
-from folioforge.preprocessor.pdf import PDFPreprocessor, PymupdfPreprocessor
+import cv2
+import numpy as np
+import pytest
+
+from folioforge.models.document import BoundingBox, DocumentReference
+from folioforge.preprocessor.image import AutoBrightness, BlankPageFilter, Grayscale, ImageChain, Invert, Threshold, ink_density
+from folioforge.preprocessor.pdf import PageRegionRenderer, PDFPreprocessor, PymupdfPreprocessor, render_pages
+from folioforge.preprocessor.store import PageStore
 
 
 def test_pdf_preprocessor(pdf_file: Path):
@@ -19,6 +25,113 @@ def test_pdf_preprocessor(pdf_file: Path):
     assert document.items[0].path.parent.name == pdf_file.stem
 
 
+def test_pdf_preprocessor_in_memory(pdf_file: Path):
+    preprocessor = PDFPreprocessor(in_memory=True)
+    outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
+    document = preprocessor.process(DocumentReference(path=pdf_file, items=[], converted=None), outdir)
+    assert document
+    assert len(document.items) == 1
+    entry = document.items[0]
+    assert entry.image is not None
+    assert entry.image.ndim == 3
+    assert not entry.path.exists()
+    assert entry.load_image() is entry.image
+    assert entry.write_image().exists()
+
+
+def test_pdf_preprocessor_lazy(pdf_file: Path):
+    preprocessor = PDFPreprocessor(in_memory=True, lazy=True)
+    outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
+    document = preprocessor.process(DocumentReference(path=pdf_file, items=[], converted=None), outdir)
+    assert document
+    assert not document.items
+    document = Grayscale().process(document, outdir)
+    assert document
+    entries = list(document.iter_items())
+    assert len(entries) == 1
+    assert entries[0].image is not None
+    assert entries[0].image.ndim == 2
+    assert document.items == entries
+    assert document.pending is None
+
+
+def test_pdf_preprocessor_sharded(multipage_pdf_file: Path):
+    preprocessor = PDFPreprocessor(in_memory=True, shard_size=2, executor=ProcessPoolExecutor(max_workers=2))
+    reference = DocumentReference(path=multipage_pdf_file, items=[], converted=None)
+    assert [s.page_range for s in preprocessor.shard(reference)] == [(0, 2), (2, 4), (4, 5)]
+    # a size of its own takes precedence, the default only applies without one
+    assert len(preprocessor.shard(reference, default_size=4)) == 3
+    assert [s.page_range for s in PDFPreprocessor().shard(reference, default_size=4)] == [(0, 4), (4, 5)]
+    assert PDFPreprocessor().shard(reference) == [reference]
+    outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
+    document = preprocessor.process(reference, outdir)
+    assert document
+    assert [e.page for e in document.items] == [0, 1, 2, 3, 4]
+    assert [e.path.name for e in document.items] == [f"page{i}.png" for i in range(5)]
+    # pages have different widths, so this checks each image ended up on the right entry
+    widths = [e.image.shape[1] for e in document.items if e.image is not None]
+    assert widths == sorted(widths)
+    assert len(set(widths)) == 5
+
+
+def test_pdf_preprocessor_resolution(pdf_file: Path):
+    preprocessor = PDFPreprocessor(in_memory=True, max_size=1024, grayscale=True)
+    outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
+    document = preprocessor.process(DocumentReference(path=pdf_file, items=[], converted=None), outdir)
+    assert document
+    entry = document.items[0]
+    assert entry.image is not None
+    assert entry.image.ndim == 2
+    assert max(entry.image.shape) == 1024
+    assert entry.scale is not None
+    assert entry.source == pdf_file
+    assert entry.page == 0
+
+    # re-rendering a region at a higher resolution gives the same region as cutting it from a page rendered at that resolution
+    full = next(render_pages(pdf_file, outdir, in_memory=True, scale=2)).image
+    assert full is not None
+    bbox = BoundingBox(x0=100, y0=150, x1=400, y1=300)
+    renderer = PageRegionRenderer(pdf_file, 0, scale=2)
+    region = renderer.render(bbox)
+    renderer.close()
+    assert region.shape[:2] == (300, 600)
+    assert (region == full[300:600, 200:800]).all()
+
+
+def test_page_store(pdf_file: Path, tmp_path: Path):
+    store = PageStore(tmp_path / "pages", raw=True)
+    preprocessor = PDFPreprocessor(store=store)
+    # same name in a different folder
+    other_file = tmp_path / pdf_file.name
+    shutil.copyfile(pdf_file, other_file)
+    documents = [preprocessor.process(DocumentReference(path=p, items=[], converted=None), tmp_path) for p in [pdf_file, other_file]]
+    entries = [d.items[0] for d in documents if d is not None]
+    assert len(entries) == 2
+    assert entries[0].path != entries[1].path
+    assert entries[0].path.name == "page0.npy"
+    assert entries[0].path.parent.parent == tmp_path / "pages"
+    # crops go to the output folder, not the store
+    assert entries[0].crop_path("image_page0_0.png") == tmp_path / pdf_file.stem / "image_page0_0.png"
+    assert entries[0].crop_dir is not None and entries[0].crop_dir.is_dir()
+
+    img = entries[0].load_image()
+    assert isinstance(img, np.memmap)
+    assert img.ndim == 3
+    assert (img == next(render_pages(pdf_file, tmp_path, in_memory=True)).image).all()
+    assert entries[0].write_image().suffix == ".png"
+
+
+def test_page_store_budget(multipage_pdf_file: Path, tmp_path: Path):
+    store = PageStore(tmp_path / "pages", raw=False, max_bytes=1)
+    document = PDFPreprocessor(store=store).process(DocumentReference(path=multipage_pdf_file, items=[], converted=None), tmp_path)
+    assert document
+    # pages that weren't released are kept even if they exceed the budget
+    assert all(e.path.exists() for e in document.items)
+    store.release(document.items[0])
+    assert not document.items[0].path.exists()
+    assert all(e.path.exists() for e in document.items[1:])
+
+
 def test_pymupdfpdf_preprocessor(pdf_file: Path):
     preprocessor = PymupdfPreprocessor()
     outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
@@ -67,3 +180,61 @@ def test_threshold_preprocessor(document_preprocessed_lenna: DocumentReference):
     assert document
     assert len(document.items) == 1
     assert not filecmp.cmp(document.items[0].path, original_file)
+
+
+def test_image_preprocessors_in_memory(document_preprocessed_lenna: DocumentReference):
+    entry = document_preprocessed_lenna.items[0]
+    entry.image = cv2.imread(str(entry.path))
+    original_file = Path(tempfile.mkdtemp(prefix="folioforge")) / "original.png"
+    shutil.copyfile(entry.path, original_file)
+    document = Grayscale().process(document_preprocessed_lenna, Path("."))
+    assert document
+    document = Threshold().process(document, Path("."))
+
+    assert document
+    assert document.items[0].image is not None
+    assert document.items[0].image.ndim == 2
+    assert set(document.items[0].image.flatten().tolist()) <= {0, 255}
+    assert filecmp.cmp(entry.path, original_file, shallow=False)
+
+
+def test_image_chain(document_preprocessed_lenna_dark: DocumentReference):
+    entry = document_preprocessed_lenna_dark.items[0]
+    expected = DocumentReference(path=entry.path, items=[entry.model_copy(update={"image": entry.load_image()})], converted=None)
+    for transform in [AutoBrightness(min_brightness=0.9), Invert(threshold=2.5), Grayscale(), Threshold(threshold=None)]:
+        transform.process(expected, Path("."))
+
+    chain = ImageChain([AutoBrightness(min_brightness=0.9), Invert(threshold=2.5), Grayscale(), Threshold(threshold=None)], write=False)
+    document = chain.process(document_preprocessed_lenna_dark, Path("."))
+
+    assert document
+    assert document.items[0].image is not None
+    assert expected.items[0].image is not None
+    assert (document.items[0].image == expected.items[0].image).all()
+    # the page on disk is left alone when the result is kept in memory
+    on_disk = cv2.imread(str(entry.path))
+    assert on_disk is not None and on_disk.shape[2] == 3
+
+
+def test_blank_page_filter(pdf_file: Path, multipage_pdf_file: Path):
+    preprocessor = PDFPreprocessor(in_memory=True)
+    outdir = Path(tempfile.mkdtemp(prefix="folioforge"))
+    blank = preprocessor.process(DocumentReference(path=multipage_pdf_file, items=[], converted=None), outdir)
+    text = preprocessor.process(DocumentReference(path=pdf_file, items=[], converted=None), outdir)
+    assert blank and text
+
+    blank = BlankPageFilter().process(blank, outdir)
+    text = BlankPageFilter().process(text, outdir)
+    assert blank and text
+    assert all(e.skipped == "blank" for e in blank.items)
+    assert text.items[0].skipped is None
+
+
+def test_ink_density():
+    img = np.full((100, 100), 230, dtype=np.uint8)
+    assert ink_density(img) == 0
+    img[10:20, :] = 20
+    assert ink_density(img) == pytest.approx(0.1)
+    # white on black
+    assert ink_density(255 - img) == pytest.approx(0.1)
+    assert ink_density(img[:0]) == 0